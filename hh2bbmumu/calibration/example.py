@@ -7,7 +7,10 @@ Exemplary calibration methods.
 from columnflow.calibration import Calibrator, calibrator
 from columnflow.production.cms.seeds import deterministic_seeds
 from columnflow.util import maybe_import
-from columnflow.columnar_util import set_ak_column
+from columnflow.columnar_util import flat_np_view
+
+from hh2bbmumu.calibration.jets import VariationBuffer
+from hh2bbmumu.production.kinematics import collection_offsets
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -24,19 +27,18 @@ def example(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     # add deterministic seeds that could (e.g.) be used for smearings
     events = self[deterministic_seeds](events, **kwargs)
 
+    # nominal and variation factors of all jets in a single buffer
+    buf = VariationBuffer(["jec_up", "jec_down"], collection_offsets(events.Jet))
+    pt = flat_np_view(events.Jet.pt, axis=1)
+
     # a)
-    pt_mask = ak.flatten(events.Jet.pt < 30)
-    n_jet_pt = np.asarray(ak.flatten(events.Jet.pt))
-    n_jet_mass = np.asarray(ak.flatten(events.Jet.mass))
-    n_jet_pt[pt_mask] *= 1.1
-    n_jet_pt[~pt_mask] *= 0.9
-    n_jet_mass[pt_mask] *= 1.1
-    n_jet_mass[~pt_mask] *= 0.9
+    buf["nominal"][:] = np.where(pt < 30, 1.1, 0.9)
 
     # b)
-    events = set_ak_column(events, "Jet.pt_jec_up", events.Jet.pt * 1.05)
-    events = set_ak_column(events, "Jet.mass_jec_up", events.Jet.mass * 1.05)
-    events = set_ak_column(events, "Jet.pt_jec_down", events.Jet.pt * 0.95)
-    events = set_ak_column(events, "Jet.mass_jec_down", events.Jet.mass * 0.95)
+    np.multiply(buf["nominal"], 1.05, out=buf["jec_up"])
+    np.multiply(buf["nominal"], 0.95, out=buf["jec_down"])
+
+    events = buf.set_columns(events, "Jet.pt", pt)
+    events = buf.set_columns(events, "Jet.mass", flat_np_view(events.Jet.mass, axis=1))
 
     return events
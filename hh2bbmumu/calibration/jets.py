@@ -0,0 +1,285 @@
+# coding: utf-8
+
+"""
+Batched jet energy calibration that computes the nominal jet momenta as well as all JEC source and
+JER variations in a single pass over one (n_jets x n_variations) float32 buffer of scale factors.
+Columns of the buffer are contiguous and exposed as jagged awkward columns without copying.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.calibration import Calibrator, calibrator
+from columnflow.production.cms.seeds import deterministic_seeds
+from columnflow.columnar_util import set_ak_column, flat_np_view
+from columnflow.types import Sequence
+from columnflow.util import maybe_import
+
+from hh2bbmumu.corrections import load_correction_set, evaluate_correction, evaluate_variations
+from hh2bbmumu.production.kinematics import collection_offsets
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def jet_variation_names(jec_sources: Sequence[str], jer: bool = True) -> list[str]:
+    """
+    Returns the names of the variations of *jec_sources* and, if *jer* is set, of the JER, matching
+    the names of the corresponding shifts in the config. All up variations of JEC sources are
+    followed by all down variations so that both form consecutive columns of a
+    :py:class:`VariationBuffer`.
+    """
+    names = [f"jec_{source}_{direction}" for direction in ("up", "down") for source in jec_sources]
+    if jer:
+        names += ["jer_up", "jer_down"]
+    return names
+
+
+class VariationBuffer(object):
+    """
+    Scale factors of all jets for the nominal calibration and the variations *names*, stored in a
+    column-major (n_jets x n_variations) buffer so that each variation is a contiguous array. The
+    jets per event are defined by *offsets*.
+
+    .. code-block:: python
+
+        buf = VariationBuffer(["jec_up", "jec_down"], offsets)
+        buf["jec_up"][:] = 1.05
+        buf["jec_down"][:] = 0.95
+        events = buf.set_columns(events, "Jet.pt", pt)
+    """
+
+    def __init__(
+        self,
+        names: Sequence[str],
+        offsets: np.ndarray,
+        dtype: np.dtype = np.float32,
+    ) -> None:
+        super().__init__()
+
+        self.names = ["nominal"] + list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.factors = np.ones((int(self.offsets[-1]), len(self.names)), dtype=dtype, order="F")
+
+    def __len__(self) -> int:
+        return self.factors.shape[0]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.factors[:, self.index[name]]
+
+    def slice(self, names: Sequence[str]) -> slice:
+        """
+        Returns a slice of the consecutive columns of the variations *names*.
+        """
+        start = self.index[names[0]] if names else 0
+        if [self.index[name] for name in names] != list(range(start, start + len(names))):
+            raise ValueError(f"variations {names} are not stored in consecutive columns")
+        return slice(start, start + len(names))
+
+    def scale(self, values: np.ndarray) -> np.ndarray:
+        """
+        Returns a new buffer with flat *values* multiplied by the factors of all variations.
+        """
+        out = np.empty(self.factors.shape, dtype=self.factors.dtype, order="F")
+        np.multiply(np.asarray(values, dtype=self.factors.dtype)[:, None], self.factors, out=out)
+        return out
+
+    def to_jagged(self, buffer: np.ndarray, name: str) -> ak.Array:
+        """
+        Returns the column of variation *name* in *buffer* as a jagged array sharing its memory.
+        """
+        content = ak.contents.NumpyArray(buffer[:, self.index[name]])
+        return ak.Array(ak.contents.ListOffsetArray(ak.index.Index64(self.offsets), content))
+
+    def set_columns(self, events: ak.Array, route: str, values: np.ndarray) -> ak.Array:
+        """
+        Scales the flat *values* by all factors and sets the nominal column *route* and the
+        variation columns ``<route>_<name>`` in *events*.
+        """
+        buffer = self.scale(values)
+        for name in self.names:
+            column = route if name == "nominal" else f"{route}_{name}"
+            events = set_ak_column(events, column, self.to_jagged(buffer, name))
+        return events
+
+    def segment_sums(self, values: np.ndarray) -> np.ndarray:
+        """
+        Returns the per-event sums of the flat (n_jets x n_variations) *values* as an
+        (n_events x n_variations) column-major array in double precision.
+        """
+        cumsum = np.zeros((len(self) + 1, values.shape[1]), dtype=np.float64, order="F")
+        np.cumsum(values, axis=0, out=cumsum[1:])
+        return np.asfortranarray(cumsum[self.offsets[1:]] - cumsum[self.offsets[:-1]])
+
+    def propagate_met(
+        self,
+        pt: np.ndarray,
+        phi: np.ndarray,
+        met_pt: np.ndarray,
+        met_phi: np.ndarray,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Propagates the change of jet momenta relative to the flat, uncalibrated *pt* (with
+        azimuthal angles *phi*) to the missing transverse momentum (*met_pt*, *met_phi*) for all
+        variations at once, and returns two (n_events x n_variations) arrays of pt and phi.
+        """
+        delta = self.scale(pt) - np.asarray(pt, dtype=self.factors.dtype)[:, None]
+        dpx = self.segment_sums(delta * np.cos(phi)[:, None])
+        dpy = self.segment_sums(delta * np.sin(phi)[:, None])
+        px = np.asarray(met_pt)[:, None] * np.cos(met_phi)[:, None] - dpx
+        py = np.asarray(met_pt)[:, None] * np.sin(met_phi)[:, None] - dpy
+        return np.hypot(px, py).astype(np.float32), np.arctan2(py, px).astype(np.float32)
+
+
+def normal_from_seeds(seeds: np.ndarray) -> np.ndarray:
+    """
+    Returns one standard normal random number per integer seed in *seeds*, derived from two
+    splitmix64 hashes of the seed through a Box-Muller transform, so that numbers are reproducible
+    per object independent of the chunking.
+    """
+    def splitmix64(z: np.ndarray) -> np.ndarray:
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+    with np.errstate(over="ignore"):
+        z1 = splitmix64(np.asarray(seeds).astype(np.uint64))
+        z2 = splitmix64(z1)
+    # uniform numbers in (0, 1) from the upper 53 bits
+    u1 = ((z1 >> np.uint64(11)).astype(np.float64) + 0.5) / 2**53
+    u2 = ((z2 >> np.uint64(11)).astype(np.float64) + 0.5) / 2**53
+    return np.sqrt(-2.0 * np.log(u1)) * np.cos(2.0 * np.pi * u2)
+
+
+@calibrator(
+    uses={"Jet.{pt,eta,phi,mass}"},
+    produces={"Jet.{pt,mass}"},
+    # jec uncertainty sources, defaulting to cfg.x.jec.Jet.uncertainty_sources when None
+    jec_sources=None,
+    # whether to apply stochastic jer smearing and to produce jer variations
+    jer=True,
+    # whether to propagate all variations to the missing transverse momentum
+    propagate_met=True,
+    rho_column="Rho.fixedGridRhoFastjetAll",
+    # function to determine the jerc correction file
+    get_jerc_file=(lambda self, external_files: external_files.jet_jerc),
+)
+def batched_jets(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Calibrates jets with all JEC source and JER variations (mc only) filled into a single
+    :py:class:`VariationBuffer`, producing ``Jet.{pt,mass}`` and ``Jet.{pt,mass}_<variation>`` as
+    referenced by the shift aliases in the config. The JEC of the input jets is kept as nominal.
+    JER smearing follows the stochastic method with resolutions and scale factors from the jerc file
+    and random numbers from deterministic jet seeds. Uncertainties are evaluated once per source
+    over all jets, and all variations of pt, mass and the missing transverse momentum are obtained
+    by single broadcast operations, so that the cost of adding sources is small.
+    """
+    offsets = collection_offsets(events.Jet)
+    pt = flat_np_view(events.Jet.pt, axis=1)
+    eta = flat_np_view(events.Jet.eta, axis=1)
+    phi = flat_np_view(events.Jet.phi, axis=1)
+    mass = flat_np_view(events.Jet.mass, axis=1)
+    buf = VariationBuffer(self.variation_names, offsets)
+
+    # jer smearing factors with the same random numbers for the nominal and both variations
+    if self.apply_jer:
+        events = self[deterministic_seeds](events, **kwargs)
+        z = normal_from_seeds(flat_np_view(events.Jet.deterministic_seed, axis=1))
+        rho = np.repeat(np.asarray(events[self.rho_column], dtype=np.float32), np.diff(offsets))
+        resolution = evaluate_correction(self.jer_resolution, JetEta=eta, JetPt=pt, Rho=rho)
+        sfs = evaluate_variations(self.jer_scale_factor, ["nom", "up", "down"], JetEta=eta, JetPt=pt)
+        for name, sf in zip(["nominal", "jer_up", "jer_down"], sfs):
+            buf[name][:] = np.maximum(1.0 + resolution * z * np.sqrt(np.maximum(sf**2 - 1.0, 0.0)), 0.0)
+
+    # relative jec uncertainties of all sources, applied on top of the nominal factors
+    if self.jec_source_names:
+        unc = np.empty((len(buf), len(self.jec_source_names)), dtype=np.float32, order="F")
+        for i, correction in enumerate(self.jec_uncertainties):
+            unc[:, i] = evaluate_correction(correction, JetEta=eta, JetPt=pt)
+        nominal = buf["nominal"][:, None]
+        up = buf.slice([f"jec_{source}_up" for source in self.jec_source_names])
+        down = buf.slice([f"jec_{source}_down" for source in self.jec_source_names])
+        np.multiply(nominal, 1.0 + unc, out=buf.factors[:, up])
+        np.multiply(nominal, 1.0 - unc, out=buf.factors[:, down])
+
+    # missing transverse momentum
+    if self.propagate_met:
+        met = events[self.met_name]
+        met_pt, met_phi = buf.propagate_met(pt, phi, np.asarray(met.pt), np.asarray(met.phi))
+        for i, name in enumerate(buf.names):
+            postfix = "" if name == "nominal" else f"_{name}"
+            events = set_ak_column(events, f"{self.met_name}.pt{postfix}", met_pt[:, i])
+            events = set_ak_column(events, f"{self.met_name}.phi{postfix}", met_phi[:, i])
+
+    # jet columns, sharing the memory of the scaled buffers
+    events = buf.set_columns(events, "Jet.pt", pt)
+    events = buf.set_columns(events, "Jet.mass", mass)
+
+    return events
+
+
+@batched_jets.init
+def batched_jets_init(self: Calibrator) -> None:
+    dataset_inst = getattr(self, "dataset_inst", None)
+    is_mc = dataset_inst is None or dataset_inst.is_mc
+
+    sources = self.config_inst.x.jec.Jet.uncertainty_sources if self.jec_sources is None else self.jec_sources
+    self.jec_source_names = list(sources) if is_mc else []
+    self.apply_jer = bool(self.jer) and is_mc
+    self.variation_names = jet_variation_names(self.jec_source_names, jer=self.apply_jer)
+
+    # declare the shifts of all variations so that they resolve to this calibrator and their
+    # column aliases are applied downstream
+    self.shifts |= {name for name in self.variation_names if self.config_inst.has_shift(name)}
+
+    if self.apply_jer:
+        self.uses |= {deterministic_seeds, self.rho_column}
+    self.produces |= {f"Jet.{{pt,mass}}_{name}" for name in self.variation_names}
+
+    self.met_name = self.config_inst.x.met_name
+    if self.propagate_met:
+        self.uses.add(f"{self.met_name}.{{pt,phi}}")
+        self.produces.add(f"{self.met_name}.{{pt,phi}}")
+        self.produces |= {f"{self.met_name}.{{pt,phi}}_{name}" for name in self.variation_names}
+
+
+@batched_jets.requires
+def batched_jets_requires(self: Calibrator, task: law.Task, reqs: dict) -> None:
+    if "external_files" in reqs:
+        return
+
+    from columnflow.tasks.external import BundleExternalFiles
+    reqs["external_files"] = BundleExternalFiles.req(task)
+
+
+@batched_jets.setup
+def batched_jets_setup(
+    self: Calibrator,
+    task: law.Task,
+    reqs: dict,
+    inputs: dict,
+    reader_targets: law.util.InsertableDict,
+) -> None:
+    self.jec_uncertainties = []
+    self.jer_scale_factor = self.jer_resolution = None
+    if not self.jec_source_names and not self.apply_jer:
+        return
+
+    correction_set = load_correction_set(
+        self.get_jerc_file(reqs["external_files"].files),
+        self.get_jerc_file(self.config_inst.x.external_files)[1],
+    )
+
+    jec = self.config_inst.x.jec.Jet
+    self.jec_uncertainties = [
+        correction_set[f"{jec.campaign}_{jec.version}_MC_{source}_{jec.jet_type}"]
+        for source in self.jec_source_names
+    ]
+
+    if self.apply_jer:
+        jer = self.config_inst.x.jer.Jet
+        self.jer_scale_factor = correction_set[f"{jer.campaign}_{jer.version}_MC_ScaleFactor_{jer.jet_type}"]
+        self.jer_resolution = correction_set[f"{jer.campaign}_{jer.version}_MC_PtResolution_{jer.jet_type}"]
@@ -0,0 +1,277 @@
+# coding: utf-8
+
+"""
+Adaptive chunk sizing for tasks reading events in chunks. The first chunk of a task is a small sample
+that is processed as usual while the resident set size is sampled, and the peak memory per event
+measured on it, together with a memory budget taken from *htcondor_memory*, determines the size of
+all remaining chunks, which are read through the same :py:class:`AdaptiveChunkedIOHandler`.
+
+The feature is enabled via ``chunked_io_adaptive`` in the ``[analysis]`` section of the law config
+and applied to all tasks inheriting from columnflow's ``ChunkedIOMixin`` (e.g. ``cf.CalibrateEvents``,
+``cf.SelectEvents`` and ``cf.ProduceColumns``) through
+:py:func:`~hh2bbmumu.columnflow_patches.patch_chunked_io_adaptive_chunk_size`.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import math
+import resource
+import threading
+
+import law
+
+from columnflow.columnar_util import ChunkedIOHandler
+from columnflow.types import Any, Generator
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def get_rss() -> int:
+    """
+    Returns the current resident set size of this process in bytes, falling back to the peak
+    resident set size on systems without ``/proc``.
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macos
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PeakRSSMonitor(object):
+    """
+    Context manager that samples the resident set size (see :py:func:`get_rss`) every *interval*
+    seconds in a background thread and keeps track of its maximum in :py:attr:`peak`.
+
+    .. code-block:: python
+
+        with PeakRSSMonitor() as monitor:
+            process(chunk)
+        print(monitor.peak)
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        super().__init__()
+
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss())
+
+    def __enter__(self) -> PeakRSSMonitor:
+        self.peak = get_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.peak = max(self.peak, get_rss())
+
+
+def get_memory_budget(task: law.Task) -> float:
+    """
+    Returns the memory budget of *task* in bytes, taken from its *htcondor_memory* parameter (in
+    MB) if set, or from the ``htcondor_memory`` and ``chunked_io_adaptive_memory`` (both in MB)
+    options in the ``[analysis]`` section of the law config, in that order.
+    """
+    memory = getattr(task, "htcondor_memory", None)
+    if memory is None or memory <= 0:
+        memory = law.config.get_expanded_float("analysis", "htcondor_memory", -1.0)
+    if memory <= 0:
+        memory = law.config.get_expanded_float("analysis", "chunked_io_adaptive_memory", 2000.0)
+    return float(memory) * 1024**2
+
+
+def nbytes_of(obj: Any) -> int:
+    """
+    Returns the number of bytes held by awkward or numpy arrays in *obj*, which can also be a
+    (nested) sequence of arrays.
+    """
+    if isinstance(obj, (ak.Array, np.ndarray)):
+        return int(obj.nbytes)
+    if isinstance(obj, (list, tuple)):
+        return sum(map(nbytes_of, obj))
+    return 0
+
+
+def compute_chunk_size(
+    bytes_per_event: float,
+    budget: float,
+    baseline: float = 0.0,
+    read_bytes_per_event: float = 0.0,
+    pool_size: int = 0,
+    min_size: int = 1000,
+    max_size: int = 1000000,
+    granularity: int = 1000,
+) -> int:
+    """
+    Returns the number of events per chunk so that the chunk being processed and *pool_size*
+    chunks read ahead fit into the memory *budget* (minus the *baseline* memory already in use).
+
+    :param bytes_per_event: Peak memory per event in bytes while processing a chunk.
+    :param budget: Total memory budget in bytes.
+    :param baseline: Memory in use before reading chunks in bytes.
+    :param read_bytes_per_event: Memory of the read columns per event in bytes, held by each chunk
+        that is read ahead.
+    :param pool_size: Number of chunks that are read ahead while another chunk is processed.
+    :param min_size: Minimum chunk size.
+    :param max_size: Maximum chunk size.
+    :param granularity: Chunk sizes are rounded down to a multiple of this number.
+    :return: The chunk size.
+    """
+    bytes_per_event = max(float(bytes_per_event), 1.0) + pool_size * max(float(read_bytes_per_event), 0.0)
+    available = max(budget - baseline, 0.0)
+    size = available / bytes_per_event
+    size = int(size // granularity * granularity)
+    return int(np.clip(size, min_size, max_size))
+
+
+class AdaptiveChunkedIOHandler(ChunkedIOHandler):
+    """
+    :py:class:`~columnflow.columnar_util.ChunkedIOHandler` whose first chunk contains the first
+    *sample_size* events and whose remaining chunks have a size determined from the peak memory
+    measured while the first chunk is processed (see :py:func:`compute_chunk_size`) and the
+    *budget* in bytes. All other arguments are forwarded to the base handler, with *chunk_size*
+    only being used to estimate the number of chunks before the sample is processed.
+
+    Chunk indices are consecutive and follow the order of entries. Remaining chunks are read on a
+    regular grid of the adapted chunk size, as expected by columnflow's readers, except
+    for the first one that starts after the sample. Parquet readers, which derive their mapping of
+    chunks to row groups from the first chunk they read, are reopened once after the sample.
+    """
+
+    def __init__(self, *args, sample_size: int = 1000, budget: float = 0.0, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+
+        self.sample_size = max(int(sample_size), 1)
+        self.budget = budget
+
+        # first entry after the sample and index of the first grid chunk after it, set once adapted
+        self.sample_stop = None
+        self.first_grid_chunk = 0
+
+    @property
+    def n_chunks(self) -> int:
+        if self.n_entries is None:
+            raise AttributeError("cannot determine number of chunks before open()")
+        if self.sample_stop is None:
+            # estimate before adapting
+            if self.n_entries <= self.sample_size:
+                return super().n_chunks
+            return 1 + int(math.ceil((self.n_entries - self.sample_size) / self.chunk_size))
+        # number of remaining grid chunks after the sample
+        return int(math.ceil(self.n_entries / self.chunk_size)) - self.first_grid_chunk
+
+    def create_chunk_position(
+        self,
+        n_entries: int,
+        chunk_size: int,
+        chunk_index: int,
+    ) -> ChunkedIOHandler.ChunkPosition:
+        pos = super().create_chunk_position(n_entries, chunk_size, self.first_grid_chunk + chunk_index)
+        if self.sample_stop is not None and pos.entry_start < self.sample_stop:
+            pos = pos._replace(entry_start=self.sample_stop)
+        return pos
+
+    def _read(self, chunk_pos: ChunkedIOHandler.ChunkPosition) -> ak.Array | list[ak.Array]:
+        chunks = [
+            source_handler.read(
+                obj,
+                chunk_pos,
+                read_options=read_options,
+                read_columns=(sorted(read_columns) if read_columns else read_columns),
+            )
+            for obj, source_handler, read_options, read_columns in zip(
+                self.source_objects,
+                self.source_handlers,
+                self.read_options_list,
+                self.read_columns_list,
+            )
+        ]
+        return chunks if self.is_multi else chunks[0]
+
+    def _reopen_parquet_sources(self) -> None:
+        for i, source_handler in enumerate(self.source_handlers):
+            if source_handler.type != "awkward_parquet":
+                continue
+            read_columns = self.read_columns_list[i]
+            source_handler.close(self.source_objects[i])
+            self.source_objects[i], _ = source_handler.open(
+                self.source_list[i],
+                open_options=self.open_options_list[i],
+                read_columns=(sorted(read_columns) if read_columns else read_columns),
+            )
+
+    def _iter_impl(self) -> Generator[tuple[Any, ChunkedIOHandler.ChunkPosition], None, None]:
+        if self.closed:
+            raise Exception(f"cannot iterate through closed {self.__class__.__name__}")
+
+        # no adaptation when the sample covers all events
+        self.sample_stop = None
+        self.first_grid_chunk = 0
+        if self.n_entries <= self.sample_size:
+            yield from super()._iter_impl()
+            return
+
+        # read and yield the sample as the first chunk, recording the peak memory while processed
+        sample_pos = self.ChunkPosition(0, 0, self.sample_size, self.sample_size, self.n_chunks)
+        baseline = get_rss()
+        with PeakRSSMonitor() as monitor:
+            chunk = self._read(sample_pos)
+            read_bytes = nbytes_of(chunk)
+            if self.iter_message:
+                print(self.iter_message.format(pos=sample_pos))
+                sys.stdout.flush()
+            yield chunk, sample_pos
+            del chunk
+
+        # adapt the chunk size
+        read_bytes_per_event = read_bytes / self.sample_size
+        bytes_per_event = max(monitor.peak - baseline, read_bytes) / self.sample_size
+        self.chunk_size = compute_chunk_size(
+            bytes_per_event,
+            self.budget,
+            baseline=baseline,
+            read_bytes_per_event=read_bytes_per_event,
+            pool_size=self.pool_size,
+        )
+        self.sample_stop = self.sample_size
+        self.first_grid_chunk = self.sample_stop // self.chunk_size
+        n_chunks = 1 + self.n_chunks
+        logger.info(
+            f"adaptive chunk size of {self.chunk_size} events for the remaining {n_chunks - 1} chunks "
+            f"({bytes_per_event / 1024:.2f} kB/event peak, {read_bytes_per_event / 1024:.2f} kB/event read "
+            f"from {self.sample_size} events, budget {self.budget / 1024**2:.0f} MB, baseline "
+            f"{baseline / 1024**2:.0f} MB)",
+        )
+
+        # iterate through the remaining chunks on the grid of the adapted chunk size, with indices
+        # following that of the sample
+        self._reopen_parquet_sources()
+        iter_message, self.iter_message = self.iter_message, None
+        try:
+            for chunk, pos in super()._iter_impl():
+                pos = pos._replace(index=pos.index - self.first_grid_chunk + 1, n_chunks=n_chunks)
+                if iter_message:
+                    print(iter_message.format(pos=pos))
+                    sys.stdout.flush()
+                yield chunk, pos
+        finally:
+            self.iter_message = iter_message
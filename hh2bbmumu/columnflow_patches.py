@@ -34,6 +34,276 @@ def patch_bundle_repo_exclude_files():
     logger.debug("patched exclude_files of cf.BundleRepo")
 
 
+@memoize
+def patch_chunked_io_adaptive_chunk_size():
+    """
+    Patches the chunked event iteration of all columnflow tasks using ``ChunkedIOMixin`` to
+    determine the chunk size adaptively (see :py:mod:`hh2bbmumu.chunking`) when enabled via
+    ``chunked_io_adaptive`` in the law config and no explicit chunk size is requested.
+    """
+    from columnflow.tasks.framework.mixins import ChunkedIOMixin
+    from columnflow.columnar_util import ChunkedIOHandler
+
+    iter_chunked_io_orig = ChunkedIOMixin.iter_chunked_io
+
+    def iter_chunked_io(self, *args, **kwargs):
+        adaptive = (
+            law.config.get_expanded_bool("analysis", "chunked_io_adaptive", False) and
+            kwargs.get("chunk_size") is None and
+            not (len(args) == 1 and isinstance(args[0], ChunkedIOHandler))
+        )
+        if adaptive:
+            from hh2bbmumu.chunking import AdaptiveChunkedIOHandler, get_memory_budget
+
+            # same defaults as in the original method, with the chunk size only used to estimate
+            # the number of chunks
+            for key in ["chunk_size", "pool_size"]:
+                if kwargs.get(key) is None:
+                    kwargs[key] = law.config.get_expanded_int(
+                        "analysis",
+                        f"{self.task_family}__chunked_io_{key}",
+                        getattr(self, f"default_{key}"),
+                    )
+                if kwargs.get(key) is None:
+                    kwargs.pop(key, None)
+            kwargs.setdefault(
+                "sample_size",
+                law.config.get_expanded_int("analysis", "chunked_io_adaptive_sample_size", 10000),
+            )
+            kwargs.setdefault("budget", get_memory_budget(self))
+            args = (AdaptiveChunkedIOHandler(*args, **kwargs),)
+            kwargs = {}
+
+        yield from iter_chunked_io_orig(self, *args, **kwargs)
+
+    ChunkedIOMixin.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched iter_chunked_io of cf.ChunkedIOMixin")
+
+
+@memoize
+def patch_array_function_profiling():
+    """
+    When enabled via ``array_function_profiling`` in the law config, records all nested array
+    function calls (see :py:mod:`hh2bbmumu.profiling.array_functions`) during the chunked event
+    iteration of tasks using ``ChunkedIOMixin`` and writes a report per task branch afterwards.
+    """
+    if not law.config.get_expanded_bool("analysis", "array_function_profiling", False):
+        return
+
+    from columnflow.columnar_util import ArrayFunction, TaskArrayFunction
+    from columnflow.tasks.framework.mixins import ChunkedIOMixin
+    from hh2bbmumu.profiling.array_functions import profiler
+
+    for cls in (ArrayFunction, TaskArrayFunction):
+        if "__call__" in cls.__dict__:
+            cls.__call__ = profiler.wrap(cls.__dict__["__call__"])
+
+    iter_chunked_io_orig = ChunkedIOMixin.iter_chunked_io
+
+    def iter_chunked_io(self, *args, **kwargs):
+        profiler.reset()
+        try:
+            for obj in iter_chunked_io_orig(self, *args, **kwargs):
+                profiler.n_chunks += 1
+                yield obj
+        finally:
+            profiler.stop()
+
+        branch = getattr(self, "branch", -1)
+        profile_dir = law.config.get_expanded("analysis", "array_function_profiling_dir")
+        path = os.path.join(profile_dir, self.task_family, f"{law.util.create_hash(self.task_id)}_{branch}")
+        json_path, html_path = profiler.write(path, task_id=self.task_id, branch=branch)
+        logger.info(f"written array function profile of {self.task_family} to {json_path} and {html_path}")
+
+    ChunkedIOMixin.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched array function calls and iter_chunked_io of cf.ChunkedIOMixin for profiling")
+
+
+@memoize
+def patch_metrics_flush():
+    """
+    Resets the metrics buffer (see :py:mod:`hh2bbmumu.metrics`) before the chunked event iteration
+    of tasks using ``ChunkedIOMixin`` and writes recorded metrics once per task branch afterwards
+    into ``metrics_dir`` configured in the law config.
+    """
+    metrics_dir = law.config.get_expanded("analysis", "metrics_dir", None)
+    if not metrics_dir:
+        return
+
+    from columnflow.tasks.framework.mixins import ChunkedIOMixin
+    from hh2bbmumu.metrics import metrics
+
+    formats = law.config.get_expanded("analysis", "metrics_formats", "json", split_csv=True)
+    iter_chunked_io_orig = ChunkedIOMixin.iter_chunked_io
+
+    def iter_chunked_io(self, *args, **kwargs):
+        metrics.reset()
+        n_chunks = 0
+        for obj in iter_chunked_io_orig(self, *args, **kwargs):
+            n_chunks += 1
+            yield obj
+
+        if not metrics:
+            return
+        branch = getattr(self, "branch", -1)
+        meta = {"task_family": self.task_family, "branch": branch, "n_chunks": n_chunks}
+        for attr in ("config", "dataset", "shift"):
+            if getattr(self, attr, None):
+                meta[attr] = getattr(self, attr)
+        path = os.path.join(
+            metrics_dir,
+            self.task_family,
+            *(meta[attr] for attr in ("config", "dataset") if attr in meta),
+            f"{law.util.create_hash(self.task_id)}_{branch}",
+        )
+        paths = metrics.flush(path, formats=formats, **meta)
+        logger.debug(f"written metrics of {self.task_family} to {', '.join(paths)}")
+
+    ChunkedIOMixin.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched iter_chunked_io of cf.ChunkedIOMixin for writing metrics")
+
+
+@memoize
+def patch_correctionlib_cache():
+    """
+    When enabled via ``correction_cache`` in the law config, routes correction sets that are loaded
+    from files or strings (e.g. by columnflow producers in their setup) through a process-wide cache
+    (see :py:mod:`hh2bbmumu.corrections`) so that each file is parsed and compiled only once.
+    """
+    if not law.config.get_expanded_bool("analysis", "correction_cache", False):
+        return
+
+    try:
+        import correctionlib
+    except ImportError:
+        return
+
+    import hashlib
+    from hh2bbmumu.corrections import load_correction_set
+
+    CorrectionSet = correctionlib.CorrectionSet
+    from_string_orig = CorrectionSet.from_string.__func__
+    string_cache = {}
+
+    def from_file(cls, filename):
+        return load_correction_set(str(filename))
+
+    def from_string(cls, data):
+        key = hashlib.sha1(data.encode("utf-8") if isinstance(data, str) else data).hexdigest()
+        if key not in string_cache:
+            string_cache[key] = from_string_orig(cls, data)
+        return string_cache[key]
+
+    # the cache itself loads files through the original method
+    from_file.__wrapped__ = CorrectionSet.from_file
+    CorrectionSet.from_file = classmethod(from_file)
+    CorrectionSet.from_string = classmethod(from_string)
+
+    logger.debug("patched correctionlib.CorrectionSet.from_{file,string} for caching")
+
+
+@memoize
+def patch_external_store():
+    """
+    When *HH2BBMUMU_EXTERNAL_STORE* is set and contains all external files of a config with matching
+    sources, lets ``cf.BundleExternalFiles`` resolve its files from the store (see
+    :py:mod:`hh2bbmumu.external_store`) and consider itself complete, so that files are neither
+    fetched nor bundled again.
+    """
+    from hh2bbmumu.external_store import ExternalStore
+
+    store = ExternalStore.from_env()
+    if store is None:
+        return
+
+    from columnflow.tasks.external import BundleExternalFiles
+
+    files_orig = BundleExternalFiles.files
+    complete_orig = BundleExternalFiles.complete
+
+    def use_store(task) -> bool:
+        if getattr(task, "_use_external_store", None) is None:
+            task._use_external_store = store.has_all(task.config_inst.x.external_files)
+        return task._use_external_store
+
+    def files(self):
+        if not use_store(self):
+            return files_orig.fget(self)
+        if getattr(self, "_external_store_files", None) is None:
+            self._external_store_files = store.targets(self.config_inst.x.external_files)
+        return self._external_store_files
+
+    def complete(self):
+        return use_store(self) or complete_orig(self)
+
+    BundleExternalFiles.files = property(files)
+    BundleExternalFiles.complete = complete
+
+    logger.debug(f"patched cf.BundleExternalFiles to use the external file store {store.store_dir}")
+
+
+@memoize
+def patch_shift_overlay_storage():
+    """
+    When enabled via ``shift_overlay_storage`` in the law config, converts the column outputs of
+    shifted runs of the task families in ``shift_overlay_tasks`` into overlays of their nominal
+    outputs, and resolves overlays when reading parquet files (see :py:mod:`hh2bbmumu.shift_overlay`).
+    """
+    if not law.config.get_expanded_bool("analysis", "shift_overlay_storage", False):
+        return
+
+    import functools
+    import awkward as ak
+    from columnflow.tasks.calibration import CalibrateEvents
+    from columnflow.tasks.production import ProduceColumns
+    from hh2bbmumu.shift_overlay import read_parquet, write_overlay
+
+    # readers
+    from_parquet_orig = ak.from_parquet
+
+    @functools.wraps(from_parquet_orig)
+    def from_parquet(path, *args, **kwargs):
+        return read_parquet(from_parquet_orig, path, *args, **kwargs)
+
+    ak.from_parquet = from_parquet
+
+    # writers
+    families = law.config.get_expanded("analysis", "shift_overlay_tasks", [], split_csv=True)
+    for cls in (CalibrateEvents, ProduceColumns):
+        if cls.get_task_family() not in families:
+            continue
+
+        def run(self, run_orig=cls.run):
+            ret = run_orig(self)
+            if self.local_shift_inst.is_nominal:
+                return ret
+
+            output = self.output()["columns"]
+            nominal_output = self.req(self, shift="nominal").output()["columns"]
+            if not isinstance(output, law.LocalFileTarget) or not isinstance(nominal_output, law.LocalFileTarget):
+                logger.warning(f"shift overlays of {self.task_family} are only supported for local outputs")
+            elif not nominal_output.exists():
+                logger.warning(f"nominal output of {self.task_family} missing, storing all columns")
+            else:
+                columns = write_overlay(output.abspath, nominal_output.abspath)
+                self.publish_message(f"stored {len(columns)} changed columns as overlay of the nominal output")
+
+            return ret
+
+        cls.run = run
+
+    logger.debug("patched ak.from_parquet and column outputs of shifted tasks for shift overlays")
+
+
 @memoize
 def patch_all():
     patch_bundle_repo_exclude_files()
+    patch_chunked_io_adaptive_chunk_size()
+    patch_array_function_profiling()
+    patch_metrics_flush()
+    patch_correctionlib_cache()
+    patch_external_store()
+    patch_shift_overlay_storage()
@@ -4,10 +4,12 @@
 Configuration of the HH -> bbmumu analysis.
 """
 from __future__ import annotations
+import os
 import importlib
 import order as od
 import law
 from hh2bbmumu.config.configs_bbmm import add_config
+from hh2bbmumu.config.snapshot import cached_config
 
 
 
@@ -59,20 +61,35 @@ def add_lazy_config(
     add_limited: bool = False,
     **kwargs,
 ):
+    # lazy dataset registration within configs, configurable through the environment
+    kwargs.setdefault("lazy", law.util.flag_to_bool(os.getenv("HH2BBMUMU_LAZY_CONFIG", "false")))
+
     def create_factory(
         config_id: int,
         config_name_postfix: str = "",
         limit_dataset_files: int | None = None,
     ):
         def factory(configs: od.UniqueObjectIndex):
-            # import the campaign
-            mod = importlib.import_module(campaign_module)
-            campaign = getattr(mod, campaign_attr)
-
-            return add_config(
-                analysis_bbmm,
-                campaign.copy(),
-                config_name=config_name + config_name_postfix,
+            def create():
+                # import the campaign
+                mod = importlib.import_module(campaign_module)
+                campaign = getattr(mod, campaign_attr)
+
+                return add_config(
+                    analysis_bbmm,
+                    campaign.copy(),
+                    config_name=config_name + config_name_postfix,
+                    config_id=config_id,
+                    limit_dataset_files=limit_dataset_files,
+                    **kwargs,
+                )
+
+            # load the config from a snapshot if possible
+            return cached_config(
+                create,
+                config_name + config_name_postfix,
+                campaign_module,
+                campaign_attr=campaign_attr,
                 config_id=config_id,
                 limit_dataset_files=limit_dataset_files,
                 **kwargs,
@@ -33,7 +33,13 @@ def add_config(
     config_id: int | None = None,
     limit_dataset_files: int | None = None,
     sync_mode: bool = False,
+    lazy: bool = False,
 ) -> od.Config:
+    """
+    Creates the config for a *campaign*. When *lazy* is *True*, datasets are not added right away
+    but only when first accessed through the config via lazy factories, and the verification of
+    dataset processes is skipped.
+    """
     # gather campaign data
     run = campaign.x.run
     year = campaign.x.year
@@ -353,9 +359,8 @@ def add_config(
 
 
 
-    for dataset_name in dataset_names:
-        # add the dataset
-        dataset = cfg.add_dataset(campaign.get_dataset(dataset_name))
+    def prepare_dataset(dataset_name: str) -> od.Dataset:
+        dataset = campaign.get_dataset(dataset_name)
 
         # add tags to datasets
         if dataset.name.startswith("tt_"):
@@ -390,8 +395,24 @@ def add_config(
             for info in dataset.info.values():
                 info.n_files = min(info.n_files, limit_dataset_files)
 
-    # verify that the root process of each dataset is part of any of the registered processes
-    verify_config_processes(cfg, warn=True)
+        return dataset
+
+    if lazy:
+        # register factories that add datasets (including their per-dataset event weights defined
+        # below) only when they are first requested
+        def create_dataset_factory(dataset_name: str):
+            def factory(datasets: od.UniqueObjectIndex):
+                return add_dataset_event_weights(prepare_dataset(dataset_name))
+            return factory
+
+        for dataset_name in dataset_names:
+            cfg.datasets.add_lazy_factory(dataset_name, create_dataset_factory(dataset_name))
+    else:
+        for dataset_name in dataset_names:
+            cfg.add_dataset(prepare_dataset(dataset_name))
+
+        # verify that the root process of each dataset is part of any of the registered processes
+        verify_config_processes(cfg, warn=True)
 
 
     ################################################################################################
@@ -462,6 +483,12 @@ def add_config(
     }
     cfg.x.default_selector_steps = "default"
 
+    # bit positions of selector steps in the packed cutflow.step_bits column written in packed
+    # selection mode (steps can be appended, but must not be reordered to keep outputs consistent)
+    cfg.x.selector_step_bits = [
+        "json", "trigger", "met_filter", "jet_veto_map", "lepton", "jet", "bjet", "electron", "muon",
+    ]
+
     cfg.x.custom_style_config_groups = {
         "small_legend": {
             "legend_cfg": {"ncols": 2, "fontsize": 16, "columnspacing": 0.6},
@@ -738,6 +765,22 @@ def add_config(
     else:
         assert False
 
+    # muon id working points evaluated in one pass by the muon_id_bits selector, each defined by
+    # cuts on Muon fields ("min", "max" and "max_abs" map fields to thresholds, "all" and "any" list
+    # boolean fields), stored in bits of Muon.id_bits in the order of muon_id_bit
+    cfg.x.muon_id_working_points = DotDict.wrap({
+        # kinematic and impact parameter requirements of all analysis muons
+        "base": {"min": {"pt": 20.0}, "max_abs": {"eta": 2.4, "dxy": 0.5, "dz": 1.0}},
+        # particle-flow muon, reconstructed as global or tracker muon
+        "loose": {"all": ["isPFcand"], "any": ["isGlobal", "isTracker"]},
+        "medium": {"all": ["mediumId"]},
+        # tight id flag, which already includes its impact parameter cuts
+        "tight": {"all": ["tightId"]},
+        # pf-based relative isolation in a cone of dR < 0.4
+        "loose_iso": {"max": {"pfRelIso04_all": 0.25}},
+        "tight_iso": {"max": {"pfRelIso04_all": 0.15}},
+    })
+
     ################################################################################################
     # b tagging
     ################################################################################################
@@ -1175,9 +1218,14 @@ def add_config(
     })
 
     # define per-dataset event weights
-    for dataset in cfg.datasets:
+    def add_dataset_event_weights(dataset: od.Dataset) -> od.Dataset:
         if dataset.has_tag("is_ttbar"):
             dataset.x.event_weights = {"top_pt_weight": get_shifts("top_pt")}
+        return dataset
+
+    if not lazy:
+        for dataset in cfg.datasets:
+            add_dataset_event_weights(dataset)
 
     # add categories
     from hh2bbmumu.config.categories import add_categories
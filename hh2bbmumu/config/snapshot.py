@@ -0,0 +1,225 @@
+# coding: utf-8
+
+"""
+Cache of pickled config snapshots that allows to skip the python-level construction of configs at
+startup. Snapshots are keyed by a hash of the files defining the config, the cmsdb campaign and
+process definitions, the columnflow version and revision, and the arguments passed to the config
+factory.
+
+Snapshots are opt-in and enabled by setting the *HH2BBMUMU_CONFIG_SNAPSHOT_DIR* environment
+variable to the directory in which they are stored.
+
+A comparison of cold and warm startup times can be obtained via
+
+.. code-block:: bash
+
+    python -m hh2bbmumu.config.snapshot run3_2023_preBPix_nano_v12
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import glob
+import pickle
+import hashlib
+import importlib.util
+
+import law
+import order as od
+
+from columnflow.types import Callable
+
+
+logger = law.logger.get_logger(__name__)
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+#: Files in this directory whose content defines configs.
+snapshot_key_files = ["configs_bbmm.py", "variables.py", "categories.py", "jec_sources.yaml"]
+
+
+def get_snapshot_dir() -> str | None:
+    """
+    Returns the directory in which config snapshots are stored, or *None* if snapshots are disabled.
+    """
+    snapshot_dir = os.getenv("HH2BBMUMU_CONFIG_SNAPSHOT_DIR")
+    return os.path.expandvars(os.path.expanduser(snapshot_dir)) if snapshot_dir else None
+
+
+def _update_hash_with_files(h: hashlib._Hash, paths: list[str]) -> None:
+    for path in sorted(paths):
+        h.update(path.encode("utf-8"))
+        if not os.path.exists(path):
+            h.update(b"<missing>")
+            continue
+        with open(path, "rb") as f:
+            h.update(f.read())
+
+
+def get_columnflow_revision() -> str:
+    """
+    Returns the version of columnflow, extended by the commit of its git checkout (e.g. the submodule)
+    if available, since columnflow objects and helpers are pickled into snapshots.
+    """
+    import subprocess
+    import columnflow
+
+    revision = str(getattr(columnflow, "__version__", ""))
+    cf_dir = os.path.dirname(os.path.abspath(columnflow.__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "-C", cf_dir, "rev-parse", "HEAD"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        # uncommitted changes to the package
+        dirty = subprocess.run(
+            ["git", "-C", cf_dir, "diff", "HEAD", "--", "."],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return revision
+
+    revision += f",{commit}"
+    if dirty:
+        revision += f",{hashlib.sha256(dirty.encode('utf-8')).hexdigest()}"
+    return revision
+
+
+def get_snapshot_key(campaign_module: str, **kwargs) -> str:
+    """
+    Returns the hash of all files that define a config created from *campaign_module*, and of
+    additional *kwargs* passed to :py:func:`~hh2bbmumu.config.configs_bbmm.add_config`.
+    """
+    h = hashlib.sha256()
+
+    # analysis files
+    _update_hash_with_files(h, [os.path.join(thisdir, name) for name in snapshot_key_files])
+
+    # cmsdb version, campaign and process definitions, located without importing the campaign
+    import cmsdb
+    h.update(str(getattr(cmsdb, "__version__", "")).encode("utf-8"))
+    cmsdb_dir = os.path.dirname(os.path.abspath(cmsdb.__file__))
+    campaign_spec = importlib.util.find_spec(campaign_module)
+    campaign_files = [campaign_spec.origin]
+    if campaign_spec.submodule_search_locations:
+        for loc in campaign_spec.submodule_search_locations:
+            campaign_files.extend(glob.glob(os.path.join(loc, "**", "*.py"), recursive=True))
+    process_files = glob.glob(os.path.join(cmsdb_dir, "processes", "**", "*.py"), recursive=True)
+    _update_hash_with_files(h, list(set(campaign_files)) + process_files)
+
+    # factory arguments and library versions
+    h.update(repr(sorted(kwargs.items())).encode("utf-8"))
+    h.update(f"{sys.version_info[:2]},{od.__version__},{pickle.HIGHEST_PROTOCOL}".encode("utf-8"))
+    h.update(get_columnflow_revision().encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def load_snapshot(path: str) -> od.Config | None:
+    """
+    Loads and returns a config snapshot from *path*, or *None* if it does not exist or is corrupt.
+    """
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning(f"could not load config snapshot {path}: {e}")
+        return None
+
+
+def save_snapshot(path: str, config: od.Config) -> None:
+    """
+    Saves a *config* snapshot at *path*, writing to a temporary file first so that concurrent
+    processes never read incomplete snapshots.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(config, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"could not save config snapshot {path}: {e}")
+
+
+def cached_config(
+    create_func: Callable[[], od.Config],
+    config_name: str,
+    campaign_module: str,
+    **kwargs,
+) -> od.Config:
+    """
+    Returns the config *config_name*, either loaded from a snapshot or created with *create_func*
+    (and stored as a new snapshot). *campaign_module* and *kwargs* (usually those passed to
+    :py:func:`~hh2bbmumu.config.configs_bbmm.add_config`) are used to compute the snapshot key.
+    Configs with lazily added datasets are not cached since their factories cannot be pickled.
+    """
+    snapshot_dir = get_snapshot_dir()
+    if not snapshot_dir or kwargs.get("lazy"):
+        return create_func()
+
+    key = get_snapshot_key(campaign_module, config_name=config_name, **kwargs)
+    path = os.path.join(snapshot_dir, f"{config_name}_{key[:16]}.pkl")
+
+    config = load_snapshot(path)
+    if config is not None:
+        logger.debug(f"loaded config {config_name} from snapshot {path}")
+        return config
+
+    config = create_func()
+    save_snapshot(path, config)
+    logger.debug(f"saved config {config_name} as snapshot {path}")
+
+    return config
+
+
+def benchmark(config_name: str, n_warm: int = 3) -> dict[str, float | list[float]]:
+    """
+    Measures the time of loading the config *config_name* in fresh processes, once without
+    snapshots, once when creating the snapshot, and *n_warm* times when loading from it.
+    """
+    import tempfile
+    import subprocess
+
+    cmd = [
+        sys.executable, "-c",
+        "import time; t0 = time.perf_counter(); "
+        "from hh2bbmumu.config.analysis_bbmm import analysis_bbmm; "
+        f"analysis_bbmm.get_config({config_name!r}); "
+        "print(time.perf_counter() - t0)",
+    ]
+
+    def measure(snapshot_dir: str) -> float:
+        env = dict(os.environ, HH2BBMUMU_CONFIG_SNAPSHOT_DIR=snapshot_dir)
+        out = subprocess.run(cmd, env=env, check=True, capture_output=True, text=True).stdout
+        return float(out.strip().splitlines()[-1])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        return {
+            "disabled": measure(""),
+            "cold": measure(tmp_dir),
+            "warm": [measure(tmp_dir) for _ in range(n_warm)],
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="benchmark cold vs. warm config startup")
+    parser.add_argument("config", help="name of the config to load")
+    parser.add_argument("--n-warm", type=int, default=3, help="number of warm measurements")
+    args = parser.parse_args()
+
+    res = benchmark(args.config, n_warm=args.n_warm)
+    print(f"no snapshot  : {res['disabled']:.3f}s")
+    print(f"cold snapshot: {res['cold']:.3f}s")
+    for i, t in enumerate(res["warm"]):
+        print(f"warm snapshot: {t:.3f}s (#{i})")
@@ -0,0 +1,157 @@
+# coding: utf-8
+
+"""
+Process-wide cache of compiled correctionlib correction sets and batched evaluation of systematic
+variations.
+
+External correction files are parsed once per process, keyed by their path and version as set in
+``add_external`` in the config, and their evaluators are kept in memory for all chunks (and
+branches processed by the same process). Compressed files can additionally be kept decompressed in
+``correction_cache_dir`` configured in the ``[analysis]`` section of the law config. Correction sets
+loaded by columnflow producers can be cached as well by enabling ``correction_cache``, see
+:py:func:`~hh2bbmumu.columnflow_patches.patch_correctionlib_cache`.
+"""
+
+from __future__ import annotations
+
+import os
+import gzip
+import shutil
+
+import law
+
+from columnflow.types import Any, Sequence
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+correctionlib = maybe_import("correctionlib")
+
+
+logger = law.logger.get_logger(__name__)
+
+# process-wide cache of correction sets, mapping (path, version) to compiled correction sets
+_correction_set_cache: dict[tuple[str, str], Any] = {}
+
+# corrections whose evaluation with arrays of strings is not supported, identified by the id of their
+# correction set and their name, as different files can contain corrections with the same name
+_unbatchable_corrections: set[tuple[int, str]] = set()
+
+
+def get_cache_dir() -> str | None:
+    """
+    Returns the directory for decompressed copies of correction files configured as
+    ``correction_cache_dir`` in the law config, or *None* when not set.
+    """
+    return law.config.get_expanded("analysis", "correction_cache_dir", None) or None
+
+
+def decompressed_path(path: str, version: str, cache_dir: str | None = None) -> str:
+    """
+    Returns the path of a decompressed copy of the gzipped file at *path* in *cache_dir* (defaulting
+    to :py:func:`get_cache_dir`), creating it if it does not exist yet. *path* is returned unchanged
+    for uncompressed files or when no cache directory is configured.
+    """
+    if cache_dir is None:
+        cache_dir = get_cache_dir()
+    if not cache_dir or not path.endswith(".gz"):
+        return path
+
+    name = os.path.basename(path)[:-3]
+    local_path = os.path.join(cache_dir, f"{law.util.create_hash((os.path.realpath(path), version))}_{name}")
+    if not os.path.exists(local_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{local_path}.{os.getpid()}.tmp"
+        with gzip.open(path, "rb") as f_in, open(tmp_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(tmp_path, local_path)
+        logger.debug(f"decompressed correction file {path} to {local_path}")
+
+    return local_path
+
+
+def load_correction_set(target: str | law.FileSystemFileTarget, version: str | None = None) -> Any:
+    """
+    Returns the compiled correctionlib correction set of the file *target* (a path or a local file
+    target), loading it only once per process and *version*. When *version* is *None*, the
+    modification time of the file is used instead.
+
+    .. code-block:: python
+
+        correction_set = load_correction_set(
+            self.get_muon_file(reqs["external_files"].files),
+            self.get_muon_file(self.config_inst.x.external_files)[1],
+        )
+    """
+    path = os.path.realpath(os.path.expandvars(os.path.expanduser(getattr(target, "abspath", target))))
+    if version is None:
+        version = str(os.stat(path).st_mtime_ns)
+
+    key = (path, str(version))
+    if key not in _correction_set_cache:
+        # bypass the caching loader installed by patch_correctionlib_cache
+        from_file = correctionlib.CorrectionSet.from_file
+        from_file = getattr(from_file, "__wrapped__", from_file)
+        _correction_set_cache[key] = from_file(decompressed_path(path, str(version)))
+        logger.debug(f"loaded correction set {path} ({version})")
+
+    return _correction_set_cache[key]
+
+
+def _correction_key(correction: Any) -> tuple[int, str]:
+    """
+    Returns a key identifying *correction* by the id of the correction set it was taken from and its
+    name. Corrections that do not refer to their correction set are identified by their own id.
+    """
+    correction_set = getattr(correction, "_context", None)
+    return id(correction if correction_set is None else correction_set), correction.name
+
+
+def evaluate_correction(correction: Any, **inputs) -> np.ndarray:
+    """
+    Evaluates a correctionlib *correction* with *inputs* matched to its inputs by name.
+    """
+    return correction.evaluate(*(inputs[inp.name] for inp in correction.inputs))
+
+
+def evaluate_variations(
+    correction: Any,
+    variations: Sequence[str],
+    **inputs,
+) -> np.ndarray:
+    """
+    Evaluates a correctionlib *correction* for all systematic *variations* and returns an array
+    with shape (n_variations, n). *inputs* are matched to the inputs of the correction by name, and
+    the systematic is passed to the only string input that is not part of *inputs*.
+
+    All variations are evaluated in a single call with tiled inputs. For corrections that do not
+    support arrays of strings, evaluation falls back to one call per variation.
+
+    .. code-block:: python
+
+        sf_nom, sf_up, sf_down = evaluate_variations(correction, ["nom", "up", "down"], JetEta=eta, JetPt=pt)
+    """
+    syst_names = [inp.name for inp in correction.inputs if inp.type == "string" and inp.name not in inputs]
+    if len(syst_names) != 1:
+        raise ValueError(
+            f"cannot determine the systematic input of correction '{correction.name}' given inputs "
+            f"{list(inputs)}, candidates are {syst_names}",
+        )
+    syst_name = syst_names[0]
+    n = max((len(v) for v in inputs.values() if np.ndim(v) > 0), default=1)
+
+    key = _correction_key(correction)
+    if key not in _unbatchable_corrections:
+        tiled = {name: (np.tile(v, len(variations)) if np.ndim(v) > 0 else v) for name, v in inputs.items()}
+        tiled[syst_name] = np.repeat(np.asarray(variations, dtype=str), n)
+        try:
+            values = correction.evaluate(*(tiled[inp.name] for inp in correction.inputs))
+            return np.asarray(values).reshape(len(variations), n)
+        except (TypeError, ValueError, RuntimeError):
+            _unbatchable_corrections.add(key)
+            logger.debug(f"correction '{correction.name}' does not support batched variations")
+
+    values = np.empty((len(variations), n), dtype=np.float64)
+    for i, variation in enumerate(variations):
+        args = {**inputs, syst_name: variation}
+        values[i] = correction.evaluate(*(args[inp.name] for inp in correction.inputs))
+    return values
@@ -0,0 +1,231 @@
+# coding: utf-8
+
+"""
+Content-addressed store of external files (see ``add_external`` in the config), keyed by their
+name (e.g. ``lumi.golden``) and version. Files are stored once per content hash, tarballs are
+unpacked once next to them, and a reference file per (name, version) points to the content and
+records its source location. Stored files are only used when their recorded source matches the one
+in the config, so that changing the location of a file without bumping its version is detected.
+
+The store is filled with :py:class:`~hh2bbmumu.tasks.external.FillExternalStore` and used by
+workers through the *HH2BBMUMU_EXTERNAL_STORE* environment variable, in which case
+``cf.BundleExternalFiles`` resolves all files of a config from the store without fetching and
+bundling them (see :py:func:`~hh2bbmumu.columnflow_patches.patch_external_store`). This also
+allows to run fully offline against a local mirror. As with the bundle, tarballs are resolved to the
+archive files themselves, their unpacked content is accessible through
+:py:meth:`ExternalStore.path` with *unpacked* set.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+
+import law
+
+from columnflow.types import Any, Generator
+from columnflow.util import DotDict
+
+
+logger = law.logger.get_logger(__name__)
+
+#: File extensions of external files that are unpacked in the store.
+tarball_extensions = (".tar.gz", ".tgz", ".tar")
+
+
+def get_store_dir() -> str | None:
+    """
+    Returns the directory of the external file store set in *HH2BBMUMU_EXTERNAL_STORE*, or *None*
+    if not set.
+    """
+    store_dir = os.getenv("HH2BBMUMU_EXTERNAL_STORE")
+    return os.path.expandvars(os.path.expanduser(store_dir)) if store_dir else None
+
+
+def iter_external_files(external_files: dict, prefix: str = "") -> Generator[tuple[str, str, str], None, None]:
+    """
+    Recursively iterates through the (nested) mapping *external_files* as created by
+    ``add_external`` and yields tuples of dot-separated names, source locations and versions.
+    """
+    for key, value in external_files.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from iter_external_files(value, prefix=f"{name}.")
+        elif isinstance(value, (tuple, list)):
+            yield name, value[0], str(value[1])
+        else:
+            yield name, value, "v1"
+
+
+def is_tarball(path: str) -> bool:
+    return path.endswith(tarball_extensions)
+
+
+class ExternalStore(object):
+    """
+    Content-addressed file store in the directory *path* with the layout
+
+    .. code-block:: text
+
+        objects/<hash[:2]>/<hash>/<basename>   # file content
+        objects/<hash[:2]>/<hash>/unpacked/    # unpacked content of tarballs
+        refs/<name>/<version>.json             # reference to the content of (name, version)
+
+    .. code-block:: python
+
+        store = ExternalStore.from_env()
+        path = store.path("lumi.golden", "v1")
+        model_dir = store.path("res_pdnn", "v1", unpacked=True)
+    """
+
+    @classmethod
+    def from_env(cls) -> ExternalStore | None:
+        store_dir = get_store_dir()
+        return cls(store_dir) if store_dir else None
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+
+        self.store_dir = os.path.abspath(path)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.store_dir}'>"
+
+    def ref_path(self, name: str, version: str) -> str:
+        return os.path.join(self.store_dir, "refs", name, f"{version}.json")
+
+    def object_dir(self, content_hash: str) -> str:
+        return os.path.join(self.store_dir, "objects", content_hash[:2], content_hash)
+
+    def lookup(self, name: str, version: str, source: str | None = None) -> dict[str, Any] | None:
+        """
+        Returns the reference information of (*name*, *version*), or *None* if not in the store or,
+        when *source* is given, if it was added from a different source location.
+        """
+        ref_path = self.ref_path(name, version)
+        if not os.path.exists(ref_path):
+            return None
+        with open(ref_path, "r") as f:
+            ref = json.load(f)
+        if source is not None and ref["source"] != source:
+            logger.debug(
+                f"external file {name} ({version}) in {self!r} was added from {ref['source']}, "
+                f"expected {source}",
+            )
+            return None
+        return ref
+
+    def __contains__(self, key: tuple[str, str]) -> bool:
+        return os.path.exists(self.ref_path(*key))
+
+    def path(
+        self,
+        name: str,
+        version: str,
+        unpacked: bool = False,
+        source: str | None = None,
+    ) -> str | None:
+        """
+        Returns the path of the file (*name*, *version*), or of its unpacked content when *unpacked*
+        is set, or *None* if it is not in the store or was added from a different *source*.
+        """
+        ref = self.lookup(name, version, source=source)
+        if ref is None:
+            return None
+        obj_dir = self.object_dir(ref["hash"])
+        if unpacked:
+            if not ref.get("unpacked"):
+                raise ValueError(f"external file {name} ({version}) is not an unpacked tarball")
+            return os.path.join(obj_dir, "unpacked")
+        return os.path.join(obj_dir, ref["basename"])
+
+    def add(self, name: str, version: str, src_path: str, source: str | None = None) -> dict[str, Any]:
+        """
+        Adds the local file at *src_path* as (*name*, *version*) to the store, copying its content
+        only if not stored yet and unpacking tarballs once, and returns the reference information.
+        *source* is the original location that is saved for bookkeeping.
+        """
+        basename = os.path.basename(source or src_path)
+
+        # hash the content
+        h = hashlib.sha256()
+        with open(src_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        content_hash = h.hexdigest()
+
+        # copy the content, using temporary names and renames to be safe against concurrent writers
+        obj_dir = self.object_dir(content_hash)
+        obj_path = os.path.join(obj_dir, basename)
+        os.makedirs(obj_dir, exist_ok=True)
+        if not os.path.exists(obj_path):
+            tmp_path = f"{obj_path}.{os.getpid()}.tmp"
+            shutil.copyfile(src_path, tmp_path)
+            os.replace(tmp_path, obj_path)
+
+        # unpack tarballs
+        unpacked = is_tarball(basename)
+        unpacked_dir = os.path.join(obj_dir, "unpacked")
+        if unpacked and not os.path.exists(unpacked_dir):
+            tmp_dir = f"{unpacked_dir}.{os.getpid()}.tmp"
+            with tarfile.open(obj_path, "r:*") as tar:
+                tar.extractall(tmp_dir)
+            try:
+                os.rename(tmp_dir, unpacked_dir)
+            except OSError:
+                # unpacked concurrently
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # write the reference
+        ref = {
+            "name": name,
+            "version": version,
+            "source": source or src_path,
+            "basename": basename,
+            "hash": content_hash,
+            "unpacked": unpacked,
+        }
+        ref_path = self.ref_path(name, version)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        tmp_path = f"{ref_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(ref, f, indent=4)
+        os.replace(tmp_path, ref_path)
+
+        logger.debug(f"added external file {name} ({version}) to {self!r} as {content_hash}")
+
+        return ref
+
+    def has_all(self, external_files: dict) -> bool:
+        """
+        Returns whether all files in the (nested) mapping *external_files* are in the store and were
+        added from the source locations given in the mapping.
+        """
+        return all(
+            self.lookup(name, version, source=source) is not None
+            for name, source, version in iter_external_files(external_files)
+        )
+
+    def targets(self, external_files: dict) -> DotDict:
+        """
+        Returns a structure like *external_files* with local file targets of all stored files. Same
+        as for ``cf.BundleExternalFiles``, targets of tarballs refer to the archive files.
+        """
+        def walk(struct: dict, prefix: str = "") -> DotDict:
+            result = DotDict()
+            for key, value in struct.items():
+                name = f"{prefix}{key}"
+                if isinstance(value, dict):
+                    result[key] = walk(value, prefix=f"{name}.")
+                    continue
+                source, version = (value[0], str(value[1])) if isinstance(value, (tuple, list)) else (value, "v1")
+                path = self.path(name, version, source=source)
+                if path is None:
+                    raise KeyError(f"external file {name} ({version}) from {source} not in {self!r}")
+                result[key] = law.LocalFileTarget(path)
+            return result
+
+        return walk(external_files)
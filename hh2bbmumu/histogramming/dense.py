@@ -0,0 +1,357 @@
+# coding: utf-8
+
+"""
+Single-pass filling of dense histograms for many variables, categories, processes and weight shifts.
+Bin indices are computed once per variable and chunk, via arithmetic for uniform binnings and
+``np.searchsorted`` otherwise, and sums of weights are accumulated into preallocated arrays with one
+``np.bincount`` per shift. Arrays are converted into ``hist.Hist`` objects only at the end.
+"""
+
+from __future__ import annotations
+
+import order as od
+
+from columnflow.types import Any, Sequence
+from columnflow.util import maybe_import
+
+from hh2bbmumu.histogramming.sparse import SparseHist, create_variable_axis, set_flow_view
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+hist = maybe_import("hist")
+
+
+class BinIndexer(object):
+    """
+    Computes bin indices for the variable axis of a histogram, given either *n_bins* uniform bins
+    between *x_min* and *x_max* or explicit bin *edges*. *axis_type* is one of the axis types that
+    columnflow creates for variables, i.e., ``"variable"``, ``"regular"`` or ``"integer"``, the
+    latter having one bin per integer between the first and the last edge and receiving the floor of
+    values. Indices follow the layout of histogram views including flow bins, i.e., 0 is the
+    underflow bin, 1 to *n_bins* are the regular bins and *n_bins* + 1 is the overflow bin (also
+    receiving NaN values). When *last_edge_inclusive* is *True*, values exactly on the upper edge of
+    variable axes are assigned to the last regular bin, as done by ``columnflow.hist_util.fill_hist``.
+    """
+
+    AXIS_TYPES = {
+        "variable": "variable",
+        "var": "variable",
+        "regular": "regular",
+        "reg": "regular",
+        "integer": "integer",
+        "int": "integer",
+    }
+
+    @classmethod
+    def from_variable(cls, variable_inst: od.Variable, last_edge_inclusive: bool | None = None) -> BinIndexer:
+        """
+        Returns an indexer for the axis that ``columnflow.hist_util.create_hist_from_variables``
+        creates for *variable_inst*, i.e., an integer axis for discrete variables and a variable axis
+        otherwise, unless configured by its ``axis_type`` auxiliary field. When *last_edge_inclusive*
+        is *None*, it is enabled for non-circular variable axes.
+        """
+        default_axis_type = "integer" if variable_inst.discrete_x else "variable"
+        axis_type = variable_inst.x("axis_type", default_axis_type).lower()
+        if axis_type not in cls.AXIS_TYPES:
+            raise ValueError(f"unsupported axis type '{axis_type}' of variable {variable_inst.name}")
+        axis_type = cls.AXIS_TYPES[axis_type]
+
+        if last_edge_inclusive is None:
+            last_edge_inclusive = not variable_inst.x("axis_kwargs", {}).get("circular", False)
+
+        return cls(edges=variable_inst.bin_edges, axis_type=axis_type, last_edge_inclusive=last_edge_inclusive)
+
+    def __init__(
+        self,
+        n_bins: int | None = None,
+        x_min: float | None = None,
+        x_max: float | None = None,
+        edges: Sequence[float] | None = None,
+        axis_type: str = "variable",
+        last_edge_inclusive: bool = False,
+    ) -> None:
+        super().__init__()
+
+        if axis_type not in self.AXIS_TYPES:
+            raise ValueError(f"unknown axis type '{axis_type}'")
+        self.axis_type = self.AXIS_TYPES[axis_type]
+
+        if edges is not None:
+            edges = np.asarray(edges, dtype=np.float64)
+        elif n_bins is not None and x_min is not None and x_max is not None:
+            edges = np.linspace(x_min, x_max, int(n_bins) + 1)
+        else:
+            raise ValueError("either edges or n_bins, x_min and x_max must be given")
+
+        if self.axis_type == "integer":
+            edges = np.arange(int(edges[0]), int(edges[-1]) + 1, dtype=np.float64)
+        elif self.axis_type == "regular":
+            edges = np.linspace(edges[0], edges[-1], len(edges))
+        self.edges = edges
+        self.n_bins = len(self.edges) - 1
+
+        if self.n_bins < 1:
+            raise ValueError(f"invalid number of bins: {self.n_bins}")
+
+        # whether bins can be computed arithmetically, requiring a correction against the edges of
+        # variable axes to account for rounding
+        widths = np.diff(self.edges)
+        self.uniform = self.axis_type != "variable" or bool(np.allclose(widths, widths[0], rtol=1e-9, atol=0.0))
+
+        # columnflow only shifts values on the last edge of variable axes
+        self.last_edge_inclusive = bool(last_edge_inclusive) and self.axis_type == "variable"
+
+        # edges padded with infinities, such that bin i covers [_bounds[i], _bounds[i + 1])
+        self._bounds = np.concatenate([[-np.inf], self.edges, [np.inf]])
+
+    @property
+    def x_min(self) -> float:
+        return float(self.edges[0])
+
+    @property
+    def x_max(self) -> float:
+        return float(self.edges[-1])
+
+    @property
+    def n_flow_bins(self) -> int:
+        return self.n_bins + 2
+
+    @property
+    def axis(self) -> dict[str, Any]:
+        """
+        Description of the axis as used by :py:class:`~hh2bbmumu.histogramming.sparse.SparseHist`.
+        """
+        if self.axis_type == "integer":
+            return {"type": "integer", "start": int(self.x_min), "stop": int(self.x_max)}
+        if self.axis_type == "regular":
+            return {"type": "regular", "n_bins": self.n_bins, "x_min": self.x_min, "x_max": self.x_max}
+        return {"type": "variable", "edges": self.edges.tolist()}
+
+    def __call__(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+
+        if self.axis_type == "integer":
+            z = np.floor(values) - self.x_min
+        elif self.uniform:
+            # same arithmetic as boost-histogram's regular axis
+            z = np.floor((values - self.x_min) / (self.x_max - self.x_min) * self.n_bins)
+        else:
+            # nan values are sorted to the end, ending up in the overflow bin
+            z = None
+            idx = np.searchsorted(self.edges, values, side="right").astype(np.intp)
+
+        if z is not None:
+            with np.errstate(invalid="ignore"):
+                idx = np.clip(z, -1, self.n_bins).astype(np.intp) + 1
+            idx[np.isnan(z)] = self.n_bins + 1
+
+            # variable axes compare values to edges, so correct arithmetic indices that are off by one
+            if self.axis_type == "variable":
+                idx -= values < self._bounds[idx]
+                idx += (values >= self._bounds[idx + 1]) & (idx <= self.n_bins)
+
+        if self.last_edge_inclusive:
+            idx[values == self.x_max] = self.n_bins
+
+        return idx
+
+
+def _lookup(known: list[int], ids: np.ndarray) -> np.ndarray:
+    """
+    Returns the positions of *ids* in *known*, appending ids that are not yet contained.
+    """
+    uniques, inverse = np.unique(ids, return_inverse=True)
+    positions = {v: i for i, v in enumerate(known)}
+    for value in uniques.tolist():
+        if value not in positions:
+            positions[value] = len(known)
+            known.append(value)
+    mapping = np.array([positions[value] for value in uniques.tolist()], dtype=np.intp)
+    return mapping[inverse.reshape(-1)]
+
+
+def _cross(pair_event: np.ndarray, offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Given the events of (event, category) pairs in *pair_event* and the *offsets* of objects per
+    event, returns the pair index and the flat object index of all (pair, object) combinations.
+    """
+    n_obj = (offsets[1:] - offsets[:-1])[pair_event]
+    pair_idx = np.repeat(np.arange(len(pair_event)), n_obj)
+    starts = np.cumsum(n_obj) - n_obj
+    obj_idx = np.arange(n_obj.sum()) - np.repeat(starts - offsets[:-1][pair_event], n_obj)
+    return pair_idx, obj_idx
+
+
+class DenseHistFiller(object):
+    """
+    Fills one-dimensional histograms of *variable_insts* for all categories, processes and shifts in
+    a single pass per chunk. Sums of weights and of squared weights are stored in dense float64
+    arrays of shape (n_categories, n_processes, n_shifts, n_bins + 2), following the axis order of
+    columnflow histograms. Categories and processes are registered when first seen, while
+    *shift_ids* are fixed and define the order of weights passed to :py:meth:`fill`.
+
+    .. code-block:: python
+
+        filler = DenseHistFiller([config_inst.get_variable("jet1_pt")], shift_ids=[0, 9, 10])
+        for events in chunks:
+            filler.fill(
+                {"jet1_pt": events.Jet.pt[:, 0]},
+                category_ids=events.category_ids,
+                process_ids=events.process_id,
+                weights=weights,  # shape (3, len(events))
+            )
+        histograms = filler.to_hists()
+    """
+
+    def __init__(
+        self,
+        variable_insts: Sequence[od.Variable],
+        shift_ids: Sequence[int],
+        last_edge_inclusive: bool | None = None,
+    ) -> None:
+        super().__init__()
+
+        self.variable_insts = {variable_inst.name: variable_inst for variable_inst in variable_insts}
+        self.indexers = {
+            name: BinIndexer.from_variable(variable_inst, last_edge_inclusive=last_edge_inclusive)
+            for name, variable_inst in self.variable_insts.items()
+        }
+        self.shift_ids = list(shift_ids)
+        self.category_ids: list[int] = []
+        self.process_ids: list[int] = []
+
+        # dense sums of weights and squared weights per variable
+        self.sumw = {
+            name: np.zeros((0, 0, len(self.shift_ids), indexer.n_flow_bins), dtype=np.float64)
+            for name, indexer in self.indexers.items()
+        }
+        self.sumw2 = {name: arr.copy() for name, arr in self.sumw.items()}
+
+    def _grow(self) -> None:
+        n_cat, n_proc = len(self.category_ids), len(self.process_ids)
+        for sums in (self.sumw, self.sumw2):
+            for name, arr in sums.items():
+                if arr.shape[:2] != (n_cat, n_proc):
+                    pad = ((0, n_cat - arr.shape[0]), (0, n_proc - arr.shape[1]), (0, 0), (0, 0))
+                    sums[name] = np.pad(arr, pad)
+
+    def fill(
+        self,
+        values: dict[str, ak.Array | np.ndarray],
+        category_ids: ak.Array,
+        process_ids: ak.Array | np.ndarray,
+        weights: np.ndarray,
+        masks: dict[str, np.ndarray] | None = None,
+    ) -> None:
+        """
+        Fills all variables for one chunk of events.
+
+        :param values: Mapping of variable names to per-event values, either flat or jagged with one
+            list of values per event.
+        :param category_ids: Jagged array with the ids of all categories of each event.
+        :param process_ids: Process id per event.
+        :param weights: Array of shape (n_shifts, n_events) with weights in the order of
+            :py:attr:`shift_ids`.
+        :param masks: Optional mapping of variable names to boolean event masks of events to fill.
+        """
+        weights = np.asarray(weights)
+        n_events = len(process_ids)
+        if weights.shape != (len(self.shift_ids), n_events):
+            raise ValueError(
+                f"weights must have shape ({len(self.shift_ids)}, {n_events}), got {weights.shape}",
+            )
+        masks = masks or {}
+
+        # (event, category) pairs that are shared by all variables
+        category_ids = ak.Array(category_ids)
+        pair_event = np.repeat(np.arange(n_events), ak.to_numpy(ak.num(category_ids, axis=1)))
+        pair_cat = _lookup(self.category_ids, ak.to_numpy(ak.flatten(category_ids, axis=1)))
+        proc = _lookup(self.process_ids, np.asarray(process_ids))
+        self._grow()
+        n_groups = len(self.category_ids) * len(self.process_ids)
+        pair_group = pair_cat * len(self.process_ids) + proc[pair_event]
+
+        for name, indexer in self.indexers.items():
+            arr = values[name]
+            if isinstance(arr, ak.Array) and arr.ndim > 1:
+                # one entry per pair and object
+                counts = ak.to_numpy(ak.fill_none(ak.num(arr, axis=1), 0))
+                offsets = np.concatenate([[0], np.cumsum(counts)])
+                flat = ak.to_numpy(ak.fill_none(ak.flatten(arr, axis=1), np.nan))
+                pair_idx, obj_idx = _cross(pair_event, offsets)
+                entry_event = pair_event[pair_idx]
+                entry_group = pair_group[pair_idx]
+                entry_bin = indexer(flat)[obj_idx]
+            else:
+                flat = ak.to_numpy(ak.fill_none(arr, np.nan)) if isinstance(arr, ak.Array) else np.asarray(arr)
+                entry_event = pair_event
+                entry_group = pair_group
+                entry_bin = indexer(flat)[pair_event]
+
+            if name in masks:
+                keep = np.asarray(masks[name], dtype=bool)[entry_event]
+                entry_event, entry_group, entry_bin = entry_event[keep], entry_group[keep], entry_bin[keep]
+
+            # one bincount per shift over the combined (category, process, bin) key
+            key = entry_group * indexer.n_flow_bins + entry_bin
+            size = n_groups * indexer.n_flow_bins
+            shape = (len(self.category_ids), len(self.process_ids), indexer.n_flow_bins)
+            for i, shift_weights in enumerate(weights):
+                w = shift_weights[entry_event].astype(np.float64)
+                self.sumw[name][:, :, i] += np.bincount(key, weights=w, minlength=size).reshape(shape)
+                self.sumw2[name][:, :, i] += np.bincount(key, weights=w**2, minlength=size).reshape(shape)
+
+    def get_axis(self, name: str) -> dict[str, Any]:
+        """
+        Returns the description of the variable axis of *name* as used by
+        :py:class:`~hh2bbmumu.histogramming.sparse.SparseHist`, including the ``axis_kwargs`` of the
+        variable.
+        """
+        variable_inst = self.variable_insts[name]
+        axis = {"name": name, "label": variable_inst.get_full_x_title(), **self.indexers[name].axis}
+        axis_kwargs = dict(variable_inst.x("axis_kwargs", {}))
+        if axis_kwargs:
+            axis["kwargs"] = axis_kwargs
+        return axis
+
+    def to_hist(self, name: str) -> hist.Hist:
+        """
+        Returns a ``hist.Hist`` with weight storage for the variable *name*, with the same axes as
+        created by ``columnflow.hist_util.create_hist_from_variables``.
+        """
+        h = hist.Hist(
+            hist.axis.IntCategory(self.category_ids, name="category", label="Category Id", growth=True),
+            hist.axis.IntCategory(self.process_ids, name="process", label="Process Id", growth=True),
+            hist.axis.IntCategory(self.shift_ids, name="shift", label="Shift Id", growth=True),
+            create_variable_axis(self.get_axis(name)),
+            storage=hist.storage.Weight(),
+        )
+        set_flow_view(h, self.sumw[name], self.sumw2[name])
+
+        return h
+
+    def to_hists(self) -> dict[str, hist.Hist]:
+        """
+        Returns a mapping of variable names to ``hist.Hist`` objects.
+        """
+        return {name: self.to_hist(name) for name in self.variable_insts}
+
+    def to_sparse(self, name: str) -> SparseHist:
+        """
+        Returns a :py:class:`~hh2bbmumu.histogramming.sparse.SparseHist` for the variable *name*,
+        containing only non-empty (category, process, shift) slices.
+        """
+        return SparseHist.from_dense(
+            self.get_axis(name),
+            self.sumw[name],
+            self.sumw2[name],
+            self.category_ids,
+            self.process_ids,
+            self.shift_ids,
+        )
+
+    def to_sparse_hists(self) -> dict[str, SparseHist]:
+        """
+        Returns a mapping of variable names to sparse histograms.
+        """
+        return {name: self.to_sparse(name) for name in self.variable_insts}
@@ -8,28 +8,37 @@ from columnflow.histogramming import HistProducer
 from columnflow.histogramming.default import cf_default
 from columnflow.util import maybe_import
 from columnflow.config_util import get_shifts_from_sources
-from columnflow.columnar_util import Route
+from columnflow.columnar_util import set_ak_column
+
+from hh2bbmumu.weight.products import WeightProducts, get_shift_aliases
 
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
 
 
 # extend columnflow's default hist producer
-@cf_default.hist_producer()
+@cf_default.hist_producer(
+    # whether to also compute the weights of all dependent shifts and attach them as columns
+    # "shift_weights.<shift>", so that all weight shifts can be filled from a single nominal run
+    shift_batching=False,
+)
 def example(self: HistProducer, events: ak.Array, **kwargs) -> ak.Array:
     # build the full event weight
-    weight = ak.Array(np.ones(len(events), dtype=np.float32))
+    if not self.dataset_inst.is_mc or not len(events):
+        return events, ak.Array(np.ones(len(events), dtype=np.float32))
 
-    if self.dataset_inst.is_mc and len(events):
-        for column in self.weight_columns:
-            weight = weight * Route(column).apply(events)
+    # nominal weight in the first row, followed by shifted weights
+    weights = self.weight_products.products(events)
+    for shift, weight in zip(self.weight_products.shifts[1:], weights[1:]):
+        events = set_ak_column(events, f"shift_weights.{shift}", weight)
 
-    return events, weight
+    return events, ak.Array(weights[0])
 
 
 @example.init
 def example_init(self: HistProducer) -> None:
-    self.weight_columns = {}
+    self.weight_columns = set()
+    self.weight_products = WeightProducts(self.weight_columns)
 
     if self.dataset_inst.is_data:
         return
@@ -40,4 +49,15 @@ def example_init(self: HistProducer) -> None:
 
     # declare shifts that the produced event weight depends on
     shift_sources = {"mu"}
-    self.shifts |= set(get_shifts_from_sources(self.config_inst, *shift_sources))
+    shifts = set(get_shifts_from_sources(self.config_inst, *shift_sources))
+    self.shifts |= shifts
+
+    # weights of all shifts, reading the shifted weight columns once
+    shift_aliases = get_shift_aliases(self.config_inst, shifts) if self.shift_batching else None
+    self.weight_products = WeightProducts(self.weight_columns, shift_aliases)
+    self.uses |= set(self.weight_products.columns)
+    self.produces |= {f"shift_weights.{shift}" for shift in self.weight_products.shifts[1:]}
+
+
+# variant attaching the weights of all dependent shifts, see hh2bbmumu.CreateHistogramsSinglePass
+example_batched = example.derive("example_batched", cls_dict={"shift_batching": True})
@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""
+Compiled evaluation of variable expressions. String expressions such as ``Jet.pt[:,0]`` are parsed
+once into a canonical form where the slice is applied to the collection (``Jet[:,0]``) followed by
+the field lookup (``pt``), so that variables sharing a collection slice, e.g. ``Jet.pt[:,0]`` and
+``Jet.eta[:,0]``, share the padded and sliced collection. All sub-expressions are evaluated at most
+once per chunk.
+"""
+
+from __future__ import annotations
+
+import ast
+
+import order as od
+
+from columnflow.columnar_util import Route
+from columnflow.types import Any, Callable, Sequence
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def _parse_index(node: ast.AST) -> Any:
+    """
+    Converts an ast node of a subscript item into an int, slice, *None* or *Ellipsis*.
+    """
+    if isinstance(node, ast.Slice):
+        return slice(*(None if n is None else ast.literal_eval(n) for n in (node.lower, node.upper, node.step)))
+    value = ast.literal_eval(node)
+    if value is Ellipsis or value is None or isinstance(value, int):
+        return value
+    raise ValueError(f"unsupported index {value!r}")
+
+
+def parse_expression(expression: str) -> tuple[tuple[str, ...], tuple | None, tuple[str, ...]] | None:
+    """
+    Parses a string *expression* made of field lookups and at most one subscript with integers and
+    slices into a tuple (collection fields, index items, leaf fields), e.g. ``("Jet",), (slice(None),
+    0), ("pt",)`` for ``Jet.pt[:,0]``. Expressions without subscript have *None* index items and no
+    leaf fields. Returns *None* for expressions that cannot be represented this way.
+    """
+    try:
+        node = ast.parse(expression.strip(), mode="eval").body
+    except SyntaxError:
+        return None
+
+    fields, items = [], None
+    try:
+        while True:
+            if isinstance(node, ast.Name):
+                fields.insert(0, node.id)
+                break
+            if isinstance(node, ast.Attribute):
+                fields.insert(0, node.attr)
+                node = node.value
+            elif isinstance(node, ast.Subscript):
+                if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+                    fields.insert(0, node.slice.value)
+                elif items is not None:
+                    return None
+                else:
+                    elts = node.slice.elts if isinstance(node.slice, ast.Tuple) else [node.slice]
+                    items = tuple(map(_parse_index, elts))
+                node = node.value
+            else:
+                return None
+    except ValueError:
+        return None
+
+    if items is None:
+        return tuple(fields), None, ()
+
+    # move the subscript to the collection, i.e., the first field
+    return tuple(fields[:1]), items, tuple(fields[1:])
+
+
+class ExpressionEvaluator(object):
+    """
+    Compiles the expressions of *variable_insts* once and evaluates them per chunk through an
+    :py:class:`ExpressionCache`. String expressions that cannot be compiled by
+    :py:func:`parse_expression` fall back to :py:class:`~columnflow.columnar_util.Route`, callable
+    expressions are called with the events.
+
+    .. code-block:: python
+
+        evaluator = ExpressionEvaluator(variable_insts)
+        for events in chunks:
+            values = evaluator.evaluate(events)  # {"jet1_pt": ..., "jet1_eta": ..., ...}
+    """
+
+    def __init__(self, variable_insts: Sequence[od.Variable]) -> None:
+        super().__init__()
+
+        self.variable_insts = {variable_inst.name: variable_inst for variable_inst in variable_insts}
+
+        # compiled form per variable: ("compiled", (fields, index, leaf)), ("route", route) or ("callable", func)
+        self.compiled: dict[str, tuple[str, Any]] = {}
+        for name, variable_inst in self.variable_insts.items():
+            expr = variable_inst.expression
+            if callable(expr):
+                self.compiled[name] = ("callable", expr)
+                continue
+            parsed = parse_expression(expr)
+            self.compiled[name] = ("compiled", parsed) if parsed else ("route", Route(expr))
+
+    @property
+    def n_sub_expressions(self) -> int:
+        """
+        Number of distinct sub-expressions that are evaluated per chunk.
+        """
+        keys = set()
+        for name, (kind, obj) in self.compiled.items():
+            null_value = self.variable_insts[name].null_value
+            if kind == "compiled":
+                fields, index, leaf = obj
+                keys.add(("column", fields))
+                if index is not None:
+                    keys.add(("slice", fields, repr(index), null_value is not None))
+            keys.add((kind, name if kind == "callable" else str(obj), null_value))
+        return len(keys)
+
+    def bind(self, events: ak.Array) -> ExpressionCache:
+        """
+        Returns an :py:class:`ExpressionCache` for one chunk of *events*.
+        """
+        return ExpressionCache(self, events)
+
+    def evaluate(self, events: ak.Array) -> dict[str, ak.Array]:
+        """
+        Returns a mapping of all variable names to their values for one chunk of *events*.
+        """
+        cache = self.bind(events)
+        return {name: cache[name] for name in self.variable_insts}
+
+
+class ExpressionCache(object):
+    """
+    Lazily evaluates and caches variable values and their sub-expressions for one chunk of *events*
+    as compiled by the *evaluator*. Instances should be dropped with the chunk.
+    """
+
+    def __init__(self, evaluator: ExpressionEvaluator, events: ak.Array) -> None:
+        super().__init__()
+
+        self.evaluator = evaluator
+        self.events = events
+        self._cache: dict[tuple, ak.Array] = {}
+
+    def _get(self, key: tuple, func: Callable[[], ak.Array]) -> ak.Array:
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def column(self, fields: tuple[str, ...]) -> ak.Array:
+        """
+        Returns the column at *fields*, reusing the column of the parent fields.
+        """
+        if not fields:
+            return self.events
+        return self._get(("column", fields), lambda: self.column(fields[:-1])[fields[-1]])
+
+    def sliced(self, fields: tuple[str, ...], index: tuple, pad: bool) -> ak.Array:
+        """
+        Returns the column at *fields* sliced with *index* items. When *pad* is *True*, axes indexed
+        with integers are padded with *None* first so that missing entries do not raise.
+        """
+        def func():
+            arr = self.column(fields)
+            if pad and Ellipsis not in index and None not in index:
+                for axis, item in enumerate(index):
+                    if isinstance(item, int) and axis > 0:
+                        arr = ak.pad_none(arr, item + 1 if item >= 0 else -item, axis=axis)
+            return arr[index]
+
+        return self._get(("slice", fields, repr(index), pad), func)
+
+    def __getitem__(self, name: str) -> ak.Array:
+        variable_inst = self.evaluator.variable_insts[name]
+        kind, obj = self.evaluator.compiled[name]
+        null_value = variable_inst.null_value
+
+        if kind == "callable":
+            return self._get(("callable", name), lambda: obj(self.events))
+
+        if kind == "route":
+            return self._get(("route", str(obj), null_value), lambda: obj.apply(self.events, null_value=null_value))
+
+        fields, index, leaf = obj
+
+        def func():
+            if index is None:
+                arr = self.column(fields)
+            else:
+                arr = self.sliced(fields, index, null_value is not None)
+                for field in leaf:
+                    arr = arr[field]
+            if null_value is not None:
+                arr = ak.fill_none(arr, null_value, axis=None)
+            return arr
+
+        return self._get(("value", fields, repr(index), leaf, null_value), func)
@@ -0,0 +1,468 @@
+# coding: utf-8
+
+"""
+Sparse storage of histograms with the axes of columnflow histograms, i.e., category, process, shift
+and one variable axis. Only non-empty (category, process, shift) slices are stored, each as a dense
+array of weight sums and squared weight sums over all bins including flow bins. Collections of
+sparse histograms are saved into compressed ``.npz`` files with one member per slice, so that single
+slices can be loaded lazily, e.g. for plotting or datacards, and merging scales with the number of
+non-empty slices rather than with the full grid.
+
+Slices are always keyed by integer ids. The translation of ids into names, as done by the default
+post-processing of columnflow histograms, can be stored alongside as *labels* and is applied when
+converting to ``hist.Hist`` objects.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+
+from columnflow.types import Any, Iterable, Sequence
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+hist = maybe_import("hist")
+
+
+#: Name of the npz member containing the axis information of all histograms.
+META_MEMBER = "__meta__"
+
+#: Name of the npz member containing additional attributes.
+ATTRS_MEMBER = "__attrs__"
+
+#: Attribute containing the translation of ids into names per categorical axis.
+LABELS_ATTR = "labels"
+
+#: Names of the categorical axes, in the order of slice keys.
+CATEGORICAL_AXES = ("category", "process", "shift")
+
+#: Key of a slice, i.e., (category id, process id, shift id).
+SliceKey = tuple[int, int, int]
+
+#: Translation of ids into names per categorical axis.
+Labels = dict[str, dict[int, str]]
+
+
+def get_axis_type(axis: dict[str, Any]) -> str:
+    """
+    Returns the type of the variable *axis*, inferred from its binning if not stored explicitly.
+    """
+    if "type" in axis:
+        return axis["type"]
+    return "variable" if "edges" in axis else "regular"
+
+
+def create_variable_axis(axis: dict[str, Any]) -> hist.axis.AxesMixin:
+    """
+    Creates the variable axis described by the dictionary *axis*, containing its ``name``, ``label``,
+    ``type``, optional ``kwargs`` passed to the axis, and depending on the type, ``edges`` for
+    variable axes, ``n_bins``, ``x_min`` and ``x_max`` for regular axes, or ``start`` and ``stop``
+    for integer axes.
+    """
+    kwargs = {"name": axis["name"], "label": axis.get("label", ""), **axis.get("kwargs", {})}
+    axis_type = get_axis_type(axis)
+    if axis_type == "variable":
+        return hist.axis.Variable(axis["edges"], **kwargs)
+    if axis_type == "integer":
+        return hist.axis.Integer(int(axis["start"]), int(axis["stop"]), **kwargs)
+    if axis_type == "regular":
+        return hist.axis.Regular(int(axis["n_bins"]), axis["x_min"], axis["x_max"], **kwargs)
+    raise ValueError(f"unknown axis type '{axis_type}'")
+
+
+def set_flow_view(h: hist.Hist, sumw: np.ndarray, sumw2: np.ndarray) -> None:
+    """
+    Sets the values and variances of *h* to *sumw* and *sumw2*, which include under- and overflow
+    bins of the last axis. Flow bins are dropped for axes without them.
+    """
+    var_axis = h.axes[-1]
+    start = 0 if var_axis.traits.underflow else 1
+    stop = sumw.shape[-1] - (0 if var_axis.traits.overflow else 1)
+    view = h.view(flow=True)
+    view.value = sumw[..., start:stop]
+    view.variance = sumw2[..., start:stop]
+
+
+class SparseHist(object):
+    """
+    Sparse histogram over (category, process, shift) slices. *axis* describes the variable axis as a
+    dictionary (see :py:func:`create_variable_axis`). *slices* maps (category id, process id, shift
+    id) keys to arrays of shape (2, n_bins + 2) containing sums of weights and squared weights. When
+    loaded from a file, slices are read lazily on first access.
+
+    .. code-block:: python
+
+        hists = load_sparse_hists("hists.npz")
+        values, variances = hists["jet1_pt"][(category_id, process_id, shift_id)]
+        h = hists["jet1_pt"].to_hist(shifts=[0])
+    """
+
+    def __init__(
+        self,
+        axis: dict[str, Any],
+        slices: dict[SliceKey, np.ndarray] | None = None,
+    ) -> None:
+        super().__init__()
+
+        self.axis = dict(axis)
+        self.axis.setdefault("type", get_axis_type(self.axis))
+        if self.axis["type"] == "variable":
+            self.axis["edges"] = [float(e) for e in self.axis["edges"]]
+            self.n_bins = len(self.axis["edges"]) - 1
+        elif self.axis["type"] == "integer":
+            self.n_bins = int(self.axis["stop"]) - int(self.axis["start"])
+        else:
+            self.n_bins = int(self.axis["n_bins"])
+        self.n_flow_bins = self.n_bins + 2
+
+        self._slices: dict[SliceKey, np.ndarray] = {}
+        # lazily loaded slices, mapping keys to npz members
+        self._source = None
+        self._members: dict[SliceKey, str] = {}
+
+        for key, arr in (slices or {}).items():
+            self[key] = arr
+
+    @property
+    def name(self) -> str:
+        return self.axis["name"]
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __contains__(self, key: SliceKey) -> bool:
+        return tuple(key) in self._slices or tuple(key) in self._members
+
+    def __iter__(self) -> Iterable[SliceKey]:
+        return iter(self.keys())
+
+    def keys(self) -> list[SliceKey]:
+        return sorted(set(self._slices) | set(self._members))
+
+    def __getitem__(self, key: SliceKey) -> np.ndarray:
+        key = tuple(key)
+        if key not in self._slices:
+            if key not in self._members:
+                # empty slice
+                return np.zeros((2, self.n_flow_bins), dtype=np.float64)
+            self._slices[key] = np.asarray(self._source[self._members.pop(key)], dtype=np.float64)
+        return self._slices[key]
+
+    def __setitem__(self, key: SliceKey, arr: np.ndarray) -> None:
+        arr = np.asarray(arr, dtype=np.float64)
+        if arr.shape != (2, self.n_flow_bins):
+            raise ValueError(f"slice must have shape (2, {self.n_flow_bins}), got {arr.shape}")
+        key = tuple(int(i) for i in key)
+        self._members.pop(key, None)
+        self._slices[key] = arr
+
+    def __delitem__(self, key: SliceKey) -> None:
+        key = tuple(key)
+        self._slices.pop(key, None)
+        self._members.pop(key, None)
+
+    @property
+    def category_ids(self) -> list[int]:
+        return sorted({key[0] for key in self.keys()})
+
+    @property
+    def process_ids(self) -> list[int]:
+        return sorted({key[1] for key in self.keys()})
+
+    @property
+    def shift_ids(self) -> list[int]:
+        return sorted({key[2] for key in self.keys()})
+
+    def compatible(self, other: SparseHist) -> bool:
+        return self.axis == other.axis
+
+    def add(self, other: SparseHist, factor: float = 1.0) -> SparseHist:
+        """
+        Adds all slices of *other*, with weights scaled by *factor*, in place and returns this
+        instance. Weight sums are scaled by *factor* and squared weight sums by *factor* squared,
+        keeping the sign of *factor*, so that adding the same histogram with *factor* and -*factor*
+        restores both. Slices that become empty are removed.
+        """
+        if not self.compatible(other):
+            raise ValueError(f"cannot add histograms with different axes {self.axis} and {other.axis}")
+        factors = np.array([[factor], [np.sign(factor) * factor**2]], dtype=np.float64)
+        for key in other.keys():
+            arr = factors * other[key]
+            if key in self:
+                arr = self[key] + arr
+            if arr.any():
+                self[key] = arr
+            else:
+                del self[key]
+        return self
+
+    def __iadd__(self, other: SparseHist) -> SparseHist:
+        return self.add(other)
+
+    def __isub__(self, other: SparseHist) -> SparseHist:
+        return self.add(other, factor=-1.0)
+
+    def __add__(self, other: SparseHist) -> SparseHist:
+        result = SparseHist(self.axis, {key: self[key].copy() for key in self.keys()})
+        result += other
+        return result
+
+    @classmethod
+    def from_dense(
+        cls,
+        axis: dict[str, Any],
+        sumw: np.ndarray,
+        sumw2: np.ndarray,
+        category_ids: Sequence[int],
+        process_ids: Sequence[int],
+        shift_ids: Sequence[int],
+    ) -> SparseHist:
+        """
+        Creates a sparse histogram from dense arrays *sumw* and *sumw2* of shape (n_categories,
+        n_processes, n_shifts, n_bins + 2), keeping only slices with non-zero entries.
+        """
+        inst = cls(axis)
+        non_empty = (sumw != 0).any(axis=-1) | (sumw2 != 0).any(axis=-1)
+        for i, j, k in zip(*np.nonzero(non_empty)):
+            inst[(category_ids[i], process_ids[j], shift_ids[k])] = np.stack([sumw[i, j, k], sumw2[i, j, k]])
+        return inst
+
+    @classmethod
+    def from_hist(cls, h: hist.Hist) -> SparseHist:
+        """
+        Creates a sparse histogram from a ``hist.Hist`` with integer category, process and shift
+        axes followed by a regular, integer or variable axis with flow bins, and weight storage.
+        """
+        for i in range(3):
+            if not isinstance(h.axes[i], hist.axis.IntCategory):
+                raise ValueError(
+                    f"sparse histograms require integer categorical axes, got {h.axes[i]!r}; store "
+                    "string translations as labels instead",
+                )
+
+        var_axis = h.axes[3]
+        axis = {"name": var_axis.name, "label": var_axis.label}
+        if isinstance(var_axis, hist.axis.Regular):
+            axis.update(
+                type="regular",
+                n_bins=len(var_axis),
+                x_min=float(var_axis.edges[0]),
+                x_max=float(var_axis.edges[-1]),
+            )
+        elif isinstance(var_axis, hist.axis.Integer):
+            axis.update(type="integer", start=int(var_axis.edges[0]), stop=int(var_axis.edges[-1]))
+        elif isinstance(var_axis, hist.axis.Variable):
+            axis.update(type="variable", edges=list(var_axis.edges))
+        else:
+            raise ValueError(f"unsupported variable axis {var_axis!r}")
+        if not (var_axis.traits.underflow and var_axis.traits.overflow):
+            raise ValueError(f"sparse histograms require variable axes with flow bins, got {var_axis!r}")
+
+        # category axes with growth have no flow bins
+        view = h.view(flow=True)
+        n = tuple(len(h.axes[i]) for i in range(3))
+        values = np.asarray(view.value)[:n[0], :n[1], :n[2]]
+        variances = np.asarray(view.variance)[:n[0], :n[1], :n[2]]
+
+        return cls.from_dense(axis, values, variances, *(list(h.axes[i]) for i in range(3)))
+
+    def to_hist(
+        self,
+        categories: Sequence[int] | None = None,
+        processes: Sequence[int] | None = None,
+        shifts: Sequence[int] | None = None,
+        labels: Labels | None = None,
+    ) -> hist.Hist:
+        """
+        Returns a dense ``hist.Hist`` with weight storage, optionally restricted to *categories*,
+        *processes* and *shifts*. Only the selected slices are loaded. Categorical axes contained in
+        *labels* are converted into string axes with the names of their ids, which is equivalent to
+        the default post-processing of columnflow histograms.
+        """
+        keys = [
+            key for key in self.keys()
+            if (
+                (categories is None or key[0] in categories) and
+                (processes is None or key[1] in processes) and
+                (shifts is None or key[2] in shifts)
+            )
+        ]
+        category_ids = sorted(categories) if categories is not None else sorted({key[0] for key in keys})
+        process_ids = sorted(processes) if processes is not None else sorted({key[1] for key in keys})
+        shift_ids = sorted(shifts) if shifts is not None else sorted({key[2] for key in keys})
+
+        cat_axes = []
+        for name, ids, label in zip(
+            CATEGORICAL_AXES,
+            (category_ids, process_ids, shift_ids),
+            ("Category Id", "Process Id", "Shift Id"),
+        ):
+            if labels and name in labels:
+                cat_axes.append(hist.axis.StrCategory(
+                    [labels[name][i] for i in ids],
+                    name=name,
+                    label=label,
+                    growth=True,
+                ))
+            else:
+                cat_axes.append(hist.axis.IntCategory(ids, name=name, label=label, growth=True))
+
+        h = hist.Hist(*cat_axes, create_variable_axis(self.axis), storage=hist.storage.Weight())
+
+        sumw = np.zeros((len(category_ids), len(process_ids), len(shift_ids), self.n_flow_bins))
+        sumw2 = np.zeros_like(sumw)
+        for key in keys:
+            idx = (category_ids.index(key[0]), process_ids.index(key[1]), shift_ids.index(key[2]))
+            sumw[idx], sumw2[idx] = self[key]
+        set_flow_view(h, sumw, sumw2)
+
+        return h
+
+
+def _member_name(variable: str, key: SliceKey) -> str:
+    return f"{variable}/{key[0]}/{key[1]}/{key[2]}"
+
+
+def save_sparse_hists(path: str, hists: dict[str, SparseHist], attrs: dict[str, Any] | None = None) -> None:
+    """
+    Saves the sparse histograms *hists* into a compressed npz file at *path* with one member per
+    slice, plus one member with the axis information of all histograms and, optionally, json
+    serializable *attrs* that are written atomically together with the histograms.
+    """
+    meta = {name: h.axis for name, h in hists.items()}
+    arrays = {META_MEMBER: np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)}
+    if attrs is not None:
+        arrays[ATTRS_MEMBER] = np.frombuffer(json.dumps(attrs).encode("utf-8"), dtype=np.uint8)
+    for name, h in hists.items():
+        for key in h.keys():
+            arrays[_member_name(name, key)] = h[key]
+
+    # write to a temporary file first, np.savez adds the extension when missing
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_sparse_attrs(path: str) -> dict[str, Any]:
+    """
+    Returns the attributes stored with the sparse histograms in the npz file at *path*.
+    """
+    with np.load(path) as source:
+        if ATTRS_MEMBER not in source.files:
+            return {}
+        return json.loads(source[ATTRS_MEMBER].tobytes().decode("utf-8"))
+
+
+def load_sparse_labels(path: str) -> Labels:
+    """
+    Returns the translation of ids into names per categorical axis stored with the sparse
+    histograms in the npz file at *path*.
+    """
+    return decode_labels(load_sparse_attrs(path).get(LABELS_ATTR, {}))
+
+
+def encode_labels(labels: Labels) -> dict[str, dict[str, str]]:
+    """
+    Converts *labels* into a json serializable structure.
+    """
+    return {name: {str(i): label for i, label in id_map.items()} for name, id_map in labels.items()}
+
+
+def decode_labels(labels: dict[str, dict[str, str]]) -> Labels:
+    """
+    Converts *labels* as returned by :py:func:`encode_labels` back into integer ids.
+    """
+    return {name: {int(i): label for i, label in id_map.items()} for name, id_map in labels.items()}
+
+
+def merge_labels(*labels: Labels) -> Labels:
+    """
+    Merges multiple *labels* into one, raising a *ValueError* for ids with different names.
+    """
+    merged: Labels = {}
+    for _labels in labels:
+        for name, id_map in _labels.items():
+            target = merged.setdefault(name, {})
+            for i, label in id_map.items():
+                if target.setdefault(i, label) != label:
+                    raise ValueError(f"id {i} of axis {name} has different labels {target[i]} and {label}")
+    return merged
+
+
+def load_sparse_hists(path: str, variables: Sequence[str] | None = None) -> dict[str, SparseHist]:
+    """
+    Loads sparse histograms from the npz file at *path*, optionally only those of *variables*.
+    Slices are read lazily on first access, so the file must persist while the histograms are used.
+    """
+    source = np.load(path)
+    meta = json.loads(source[META_MEMBER].tobytes().decode("utf-8"))
+
+    hists = {}
+    for name, axis in meta.items():
+        if variables is None or name in variables:
+            hists[name] = SparseHist(axis)
+            hists[name]._source = source
+
+    for member in source.files:
+        if member in (META_MEMBER, ATTRS_MEMBER):
+            continue
+        name, *key = member.rsplit("/", 3)
+        if name in hists:
+            hists[name]._members[tuple(map(int, key))] = member
+
+    return hists
+
+
+def add_sparse_hists(
+    target: dict[str, SparseHist],
+    hists: dict[str, SparseHist],
+    factor: float = 1.0,
+) -> dict[str, SparseHist]:
+    """
+    Adds the sparse histograms *hists*, scaled by *factor*, to the histograms with the same names in
+    *target* in place (see :py:meth:`SparseHist.add`) and returns *target*.
+    """
+    for name, h in hists.items():
+        if name not in target:
+            target[name] = SparseHist(h.axis)
+        target[name].add(h, factor=factor)
+    return target
+
+
+def prune_sparse_hists(hists: dict[str, SparseHist], keys: dict[str, set[SliceKey]]) -> dict[str, SparseHist]:
+    """
+    Removes all histograms and slices from *hists* in place that are not contained in *keys* per
+    histogram name, e.g. slices of subtracted inputs that are left with rounding residuals, and
+    returns *hists*.
+    """
+    for name in list(hists):
+        if name not in keys:
+            del hists[name]
+            continue
+        for key in hists[name].keys():
+            if key not in keys[name]:
+                del hists[name][key]
+    return hists
+
+
+def merge_sparse_hists(paths: Sequence[str], variables: Sequence[str] | None = None) -> dict[str, SparseHist]:
+    """
+    Merges the sparse histograms in the npz files at *paths* file by file, holding only the merged
+    non-empty slices and the currently read slice in memory.
+    """
+    merged: dict[str, SparseHist] = {}
+    for path in paths:
+        for name, h in load_sparse_hists(path, variables=variables).items():
+            if name not in merged:
+                merged[name] = SparseHist(h.axis)
+            elif not merged[name].compatible(h):
+                raise ValueError(f"axis of histogram {name} in {path} differs from previous files")
+            target = merged[name]
+            for key in h.keys():
+                arr = h[key]
+                if key in target:
+                    target._slices[key] += arr
+                else:
+                    target._slices[key] = arr
+    return merged
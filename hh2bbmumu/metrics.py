@@ -0,0 +1,293 @@
+# coding: utf-8
+
+"""
+Low-overhead metrics channel for counters and timing histograms recorded while processing chunks,
+e.g. per-step pass counts of selectors. Metrics are buffered in memory and flushed once per task
+branch into sidecar files (JSON and/or Prometheus textfile format) in ``metrics_dir`` configured in
+the ``[analysis]`` section of the law config, see
+:py:func:`~hh2bbmumu.columnflow_patches.patch_metrics_flush`.
+
+Sidecar files of all branches and datasets can be merged into a cutflow table with
+
+.. code-block:: bash
+
+    hh2bbmumu_cutflow [--config run3_2023_preBPix_nano_v12] [--shift nominal] [--watch 30]
+
+Sidecar files are no law outputs and are therefore not transferred back from remote workers. When
+``metrics_dir`` points to a location below ``$CF_DATA`` that is local to the worker, e.g. on batch
+systems, metrics of remote jobs are lost, so it should point to a shared file system instead.
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import glob
+import json
+import time
+import bisect
+import contextlib
+from collections import defaultdict
+
+import law
+
+from columnflow.types import Any, Sequence
+
+
+logger = law.logger.get_logger(__name__)
+
+#: Default upper bucket edges of timing histograms in seconds.
+default_time_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class MetricsBuffer(object):
+    """
+    In-memory buffer of counters and histograms identified by a name and a set of labels.
+
+    .. code-block:: python
+
+        metrics.inc("selection_step_passed_total", 123, step="jet")
+        with metrics.timer("selection_step_seconds", step="jet"):
+            ...
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.reset()
+
+    def reset(self) -> None:
+        # counters and histograms, keyed by (name, sorted labels), in the order of first use
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], dict[str, Any]] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.counters or self.histograms)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        """
+        Increments the counter *name* with *labels* by *value*.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0.0) + float(value)
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = default_time_buckets, **labels) -> None:
+        """
+        Adds a *value* to the histogram *name* with *labels* and upper bucket edges *buckets*.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = {
+                "buckets": list(buckets),
+                "counts": [0] * (len(buckets) + 1),
+                "sum": 0.0,
+                "count": 0,
+            }
+        hist["counts"][bisect.bisect_left(hist["buckets"], value)] += 1
+        hist["sum"] += value
+        hist["count"] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Context manager that observes the wall time of its block in the histogram *name*.
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def to_dict(self, **meta) -> dict[str, Any]:
+        return {
+            "meta": meta,
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self.counters.items()
+            ],
+            "histograms": [
+                {"name": name, "labels": dict(labels), **hist}
+                for (name, labels), hist in self.histograms.items()
+            ],
+        }
+
+    def to_prometheus(self, prefix: str = "hh2bbmumu_", **meta) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format, adding *meta* as labels.
+        """
+        def fmt_labels(labels: dict[str, Any]) -> str:
+            labels = {**meta, **labels}
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+        lines = []
+        typed = set()
+        for (name, labels), value in self.counters.items():
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{prefix}{name}{fmt_labels(dict(labels))} {value}")
+        for (name, labels), hist in self.histograms.items():
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            cumulative = 0
+            for le, count in zip(hist["buckets"] + ["+Inf"], hist["counts"]):
+                cumulative += count
+                lines.append(f"{prefix}{name}_bucket{fmt_labels({**dict(labels), 'le': le})} {cumulative}")
+            lines.append(f"{prefix}{name}_sum{fmt_labels(dict(labels))} {hist['sum']}")
+            lines.append(f"{prefix}{name}_count{fmt_labels(dict(labels))} {hist['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def flush(self, path: str, formats: Sequence[str] = ("json",), **meta) -> list[str]:
+        """
+        Writes all metrics to *path* with the extensions of *formats* (``json`` and/or ``prom``),
+        adding *meta* information, and resets the buffer. Returns the written paths.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        paths = []
+        for fmt in formats:
+            content = (
+                json.dumps(self.to_dict(**meta), indent=4)
+                if fmt == "json"
+                else self.to_prometheus(**meta)
+            )
+            # write atomically so that readers never see incomplete files
+            fmt_path = f"{path}.{fmt}"
+            tmp_path = f"{fmt_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, fmt_path)
+            paths.append(fmt_path)
+
+        self.reset()
+
+        return paths
+
+
+#: Process-wide metrics buffer.
+metrics = MetricsBuffer()
+
+
+def merge_cutflows(
+    metrics_dir: str,
+    task_family: str = "cf.SelectEvents",
+    config: str | None = None,
+    shift: str = "nominal",
+) -> tuple[list[str], dict[str, dict[str, float]], dict[str, int]]:
+    """
+    Merges the ``selection_events_total`` and ``selection_cutflow_passed_total`` counters of the
+    JSON sidecar files of *task_family* in *metrics_dir* per dataset. Only files of *config* (all
+    configs when *None*) and *shift* are considered. Of multiple files of the same (config,
+    dataset, branch), e.g. from runs with different versions or selectors, only the most recently
+    written one is used.
+
+    :return: A tuple with the list of steps in the order of their first occurrence, a mapping of
+        dataset names to mappings of steps (and ``"initial"``) to counts, and a mapping of dataset
+        names to the number of merged files.
+    """
+    steps = []
+    cutflows = defaultdict(lambda: defaultdict(float))
+    n_files = defaultdict(int)
+
+    # select the latest file per (config, dataset, branch)
+    latest = {}
+    pattern = os.path.join(metrics_dir, task_family, "**", "*.json")
+    for path in glob.glob(pattern, recursive=True):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            mtime = os.path.getmtime(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"skipping unreadable metrics file {path}: {e}")
+            continue
+
+        meta = data["meta"]
+        if config is not None and meta.get("config") != config:
+            continue
+        if meta.get("shift", "nominal") != shift:
+            continue
+        key = (meta.get("config"), meta.get("dataset", "unknown"), meta.get("branch"))
+        if key not in latest or mtime > latest[key][0]:
+            latest[key] = (mtime, path, data)
+
+    for (_, dataset, _), (_, _, data) in sorted(latest.items(), key=lambda item: item[1][1]):
+        n_files[dataset] += 1
+        for counter in data["counters"]:
+            if counter["name"] == "selection_events_total":
+                cutflows[dataset]["initial"] += counter["value"]
+            elif counter["name"] == "selection_cutflow_passed_total":
+                step = counter["labels"]["step"]
+                if step not in steps:
+                    steps.append(step)
+                cutflows[dataset][step] += counter["value"]
+
+    return steps, cutflows, n_files
+
+
+def print_cutflow_table(
+    steps: list[str],
+    cutflows: dict[str, dict[str, float]],
+    n_files: dict[str, int],
+) -> None:
+    datasets = sorted(cutflows)
+    width = max([len(step) for step in steps] + [7])
+    col = max([len(dataset) for dataset in datasets] + [18])
+
+    print(f"{'step':<{width}}  " + "  ".join(f"{dataset:>{col}}" for dataset in datasets))
+    print(f"{'(files)':<{width}}  " + "  ".join(f"{n_files[dataset]:>{col}}" for dataset in datasets))
+    for step in ["initial"] + steps:
+        cells = []
+        for dataset in datasets:
+            n = cutflows[dataset].get(step, 0.0)
+            initial = cutflows[dataset].get("initial", 0.0)
+            eff = n / initial if initial else 0.0
+            cells.append(f"{f'{n:.0f} ({eff:.1%})':>{col}}")
+        print(f"{step:<{width}}  " + "  ".join(cells))
+
+
+def main(args: list[str] | None = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="merge selection metrics of all branches and datasets into a cutflow table",
+    )
+    parser.add_argument(
+        "metrics_dir",
+        nargs="?",
+        default=law.config.get_expanded("analysis", "metrics_dir", None),
+        help="directory with metrics files; default: metrics_dir in the law config",
+    )
+    parser.add_argument("--task-family", default="cf.SelectEvents", help="task family to consider")
+    parser.add_argument("--config", default=None, help="config to consider; default: all")
+    parser.add_argument("--shift", default="nominal", help="shift to consider; default: nominal")
+    parser.add_argument("--watch", type=float, default=0.0, help="refresh the table every WATCH seconds")
+    args = parser.parse_args(args)
+
+    if not args.metrics_dir:
+        parser.error("no metrics directory given or configured")
+
+    while True:
+        steps, cutflows, n_files = merge_cutflows(
+            args.metrics_dir,
+            task_family=args.task_family,
+            config=args.config,
+            shift=args.shift,
+        )
+        if args.watch > 0:
+            # clear the terminal
+            print("\033[2J\033[H", end="")
+        print_cutflow_table(steps, cutflows, n_files)
+        if args.watch <= 0:
+            break
+        time.sleep(args.watch)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -14,10 +14,11 @@ from columnflow.ml import MLModel
 from columnflow.util import maybe_import, dev_sandbox
 from columnflow.columnar_util import Route, set_ak_column
 
-ak = maybe_import("awkward")
-tf = maybe_import("tensorflow")
+from hh2bbmumu.util import DeferredModule
 
-law.contrib.load("tensorflow")
+ak = maybe_import("awkward")
+# tensorflow and its law contrib package are only loaded when a model is actually built or opened
+tf = DeferredModule("tensorflow")
 
 
 class ExampleModel(MLModel):
@@ -75,6 +76,7 @@ class ExampleModel(MLModel):
         return task.target(f"mlmodel_f{task.branch}of{self.folds}.keras")
 
     def open_model(self, target: law.FileSystemDirectoryTarget) -> tf.keras.models.Model:
+        law.contrib.load("tensorflow")
         return target.load(formatter="tf_keras_model")
 
     def train(
@@ -83,6 +85,8 @@ class ExampleModel(MLModel):
         input: dict[str, list[dict[str, law.FileSystemFileTarget]]],
         output: law.FileSystemDirectoryTarget,
     ) -> None:
+        law.contrib.load("tensorflow")
+
         # define a dummy NN
         x = tf.keras.Input(shape=(2,))
         a1 = tf.keras.layers.Dense(10, activation="elu")(x)
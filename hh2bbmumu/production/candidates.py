@@ -0,0 +1,230 @@
+# coding: utf-8
+
+"""
+Producers that build dimuon and di-b-jet candidates, and the HH candidate from their sum.
+"""
+
+from __future__ import annotations
+
+from functools import partial
+
+from columnflow.production import Producer, producer
+from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view, set_ak_column
+from columnflow.util import maybe_import
+from columnflow.types import Callable
+
+from hh2bbmumu.production.kinematics import (
+    collection_offsets, pair_indices, pair_kinematics, segment_argmin, to_cartesian, from_cartesian,
+)
+from hh2bbmumu.selection.muons import muon_id_bits, has_muon_id
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# helpers
+set_ak_f32 = partial(set_ak_column, value_type=np.float32)
+set_ak_i32 = partial(set_ak_column, value_type=np.int32)
+
+
+def pair_scores(
+    criterion: str,
+    p: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    idx1: np.ndarray,
+    idx2: np.ndarray,
+    score: np.ndarray | None = None,
+    mass_target: float | None = None,
+) -> np.ndarray:
+    """
+    Returns scores of pairs according to a *criterion*, with lower values denoting better pairs.
+
+    - ``"mass"``: distance of the pair mass to *mass_target*,
+    - ``"pt"``: highest pair pt,
+    - ``"score"``: highest sum of per-object *score* values, e.g. b-tag discriminants,
+    - ``"leading"``: first pair in the order of objects.
+
+    :param p: Flat cartesian (px, py, pz, e) components of all objects, see
+        :py:func:`~hh2bbmumu.production.kinematics.to_cartesian`.
+    :param idx1: Flat indices of the first objects of pairs.
+    :param idx2: Flat indices of the second objects of pairs.
+    :param score: Flat per-object scores, required for the ``"score"`` criterion.
+    :param mass_target: Target mass, required for the ``"mass"`` criterion.
+    :return: Flat array of pair scores.
+    """
+    if criterion == "mass":
+        px, py, pz, e = (c[idx1] + c[idx2] for c in p)
+        return np.abs(np.sqrt(np.maximum(e**2 - px**2 - py**2 - pz**2, 0.0)) - mass_target)
+    if criterion == "pt":
+        return -np.hypot(p[0][idx1] + p[0][idx2], p[1][idx1] + p[1][idx2])
+    if criterion == "score":
+        score = np.asarray(score, dtype=np.float64)
+        return -(score[idx1] + score[idx2])
+    if criterion == "leading":
+        # lexicographic order of (first, second) index, which is the same for flat and local indices
+        n = float(idx2.max() + 1) if len(idx2) else 1.0
+        return idx1 * n + idx2
+    raise ValueError(f"unknown pair criterion '{criterion}'")
+
+
+def best_pairs(
+    coll: ak.Array,
+    criterion: str,
+    valid_pair: Callable[[np.ndarray, np.ndarray], np.ndarray] | None = None,
+    max_objects: int | None = None,
+    score: np.ndarray | None = None,
+    mass_target: float | None = None,
+) -> tuple[dict[str, np.ndarray], np.ndarray, np.ndarray]:
+    """
+    Builds all unique pairs among the first *max_objects* objects per event of the collection *coll*
+    on flat arrays and selects the best pair per event according to *criterion* (see
+    :py:func:`pair_scores`). Only the quantity required by the criterion is evaluated for all pairs,
+    while the full kinematics are computed for the selected pairs only.
+
+    :param coll: Jagged collection with at least the fields pt, eta, phi and mass.
+    :param criterion: Name of the criterion for choosing the best pair.
+    :param valid_pair: Function receiving the flat indices of the first and second objects of all
+        pairs and returning a mask of pairs that are allowed to be chosen.
+    :param max_objects: Maximum number of leading objects per event to consider.
+    :param score: Flat per-object scores, passed to :py:func:`pair_scores`.
+    :param mass_target: Target mass, passed to :py:func:`pair_scores`.
+    :return: A tuple with the kinematics of the best pair per event (see
+        :py:func:`~hh2bbmumu.production.kinematics.pair_kinematics`), the local indices of its two
+        objects in *coll*, and a mask of events with a valid pair.
+    """
+    offsets = collection_offsets(coll.pt)
+    flat = {f: flat_np_view(coll[f], axis=1) for f in ["pt", "eta", "phi", "mass"]}
+
+    # score all pairs, excluding invalid ones
+    idx1, idx2, pair_offsets = pair_indices(offsets, max_objects=max_objects)
+    p = to_cartesian(**flat) if criterion in ("mass", "pt") else None
+    scores = pair_scores(criterion, p, idx1, idx2, score=score, mass_target=mass_target)
+    if valid_pair is not None:
+        scores[~valid_pair(idx1, idx2)] = np.inf
+
+    # choose the best pair per event
+    best = segment_argmin(scores, pair_offsets)
+    valid = best >= 0
+    idx1, idx2 = idx1[best[valid]], idx2[best[valid]]
+    kin = pair_kinematics(**flat, idx1=idx1, idx2=idx2)
+    local = np.stack([idx1, idx2]) - offsets[:-1][valid]
+
+    return kin, local, valid
+
+
+def fill_pair_columns(
+    events: ak.Array,
+    name: str,
+    kin: dict[str, np.ndarray],
+    local: np.ndarray,
+    valid: np.ndarray,
+) -> ak.Array:
+    """
+    Stores the pair kinematics *kin* and object indices *local* of events denoted by *valid* in
+    columns ``{name}.{pt,eta,phi,mass,dr,idx1,idx2}``, using default values for all other events.
+    """
+    for key, values in kin.items():
+        col = np.full(len(events), EMPTY_FLOAT, dtype=np.float32)
+        col[valid] = values
+        events = set_ak_f32(events, f"{name}.{key}", col)
+
+    for i, key in enumerate(["idx1", "idx2"]):
+        col = np.full(len(events), -1, dtype=np.int32)
+        col[valid] = local[i]
+        events = set_ak_i32(events, f"{name}.{key}", col)
+
+    return events
+
+
+@producer(
+    uses={muon_id_bits, "Muon.{pt,eta,phi,mass,charge}", "Jet.{pt,eta,phi,mass}"},
+    produces={
+        muon_id_bits,
+        "Dimuon.{pt,eta,phi,mass,dr,idx1,idx2}",
+        "Dibjet.{pt,eta,phi,mass,dr,idx1,idx2}",
+        "HH.{pt,eta,phi,mass}",
+    },
+    # maximum numbers of leading muons and jets considered for pairing, bounding the combinatorics
+    max_muons=4,
+    max_jets=6,
+    # muon id working point required for both muons in addition to the base selection, and for at
+    # least one muon (if not None)
+    muon_wp="tight_iso",
+    muon_leading_wp="tight",
+    # criteria for choosing the best pairs, see pair_scores
+    dimuon_criterion="mass",
+    dimuon_mass_target=125.0,
+    dibjet_criterion="score",
+    dibjet_mass_target=125.0,
+    # jet column used as score for the dibjet criterion "score" and for the b-tag working point
+    btag_column="btagPNetB",
+    # b-tag working point required for both jets (if not None), and the function to determine its
+    # threshold
+    btag_wp="medium",
+    get_btag_wp_value=(lambda self: self.config_inst.x.btag_working_points.particleNet[self.btag_wp]),
+)
+def hh_candidates(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Builds opposite-sign dimuon pairs of muons passing the base selection and the id working point
+    *muon_wp* (at least one passing *muon_leading_wp*) and pairs of jets passing the b-tag working
+    point *btag_wp*, chooses the best pair of each kind per event
+    according to the configured criteria, and writes ``Dimuon.*``, ``Dibjet.*`` and ``HH.*``
+    columns. Pairs are built with vectorized combinatorics on flat arrays, limited to the leading
+    *max_muons* and *max_jets* objects so that the cost scales linearly with the object multiplicity.
+    """
+    # dimuon candidates
+    events = self[muon_id_bits](events, **kwargs)
+    charge = flat_np_view(events.Muon.charge, axis=1)
+    id_bits = flat_np_view(events.Muon.id_bits, axis=1)
+    wp_ok = has_muon_id(id_bits, "base", self.muon_wp)
+    leading_ok = has_muon_id(id_bits, self.muon_leading_wp) if self.muon_leading_wp else None
+
+    def valid_dimuon(idx1: np.ndarray, idx2: np.ndarray) -> np.ndarray:
+        mask = (charge[idx1] != charge[idx2]) & wp_ok[idx1] & wp_ok[idx2]
+        if leading_ok is not None:
+            mask &= leading_ok[idx1] | leading_ok[idx2]
+        return mask
+
+    mumu = best_pairs(
+        events.Muon,
+        self.dimuon_criterion,
+        valid_pair=valid_dimuon,
+        max_objects=self.max_muons,
+        mass_target=self.dimuon_mass_target,
+    )
+    events = fill_pair_columns(events, "Dimuon", *mumu)
+
+    # dibjet candidates
+    btag = flat_np_view(events.Jet[self.btag_column], axis=1) if self.uses_btag else None
+    btag_ok = btag > self.get_btag_wp_value() if self.btag_wp else None
+
+    def valid_dibjet(idx1: np.ndarray, idx2: np.ndarray) -> np.ndarray:
+        return btag_ok[idx1] & btag_ok[idx2]
+
+    bb = best_pairs(
+        events.Jet,
+        self.dibjet_criterion,
+        valid_pair=valid_dibjet if btag_ok is not None else None,
+        max_objects=self.max_jets,
+        score=btag,
+        mass_target=self.dibjet_mass_target,
+    )
+    events = fill_pair_columns(events, "Dibjet", *bb)
+
+    # hh candidates from events with both pairs
+    valid = mumu[2] & bb[2]
+    p_mumu = to_cartesian(*(mumu[0][f][valid[mumu[2]]] for f in ["pt", "eta", "phi", "mass"]))
+    p_bb = to_cartesian(*(bb[0][f][valid[bb[2]]] for f in ["pt", "eta", "phi", "mass"]))
+    hh = from_cartesian(*(c1 + c2 for c1, c2 in zip(p_mumu, p_bb)))
+    for f, values in zip(["pt", "eta", "phi", "mass"], hh):
+        col = np.full(len(events), EMPTY_FLOAT, dtype=np.float32)
+        col[valid] = values
+        events = set_ak_f32(events, f"HH.{f}", col)
+
+    return events
+
+
+@hh_candidates.init
+def hh_candidates_init(self: Producer) -> None:
+    self.uses_btag = self.dibjet_criterion == "score" or bool(self.btag_wp)
+    if self.uses_btag:
+        self.uses.add(f"Jet.{self.btag_column}")
@@ -15,7 +15,8 @@ from columnflow.production.cms.muon import muon_weights
 from columnflow.reduction.util import create_collections_from_masks
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column
-from columnflow.production.util import attach_coffea_behavior
+
+from hh2bbmumu.production.kinematics import leading_pair_kinematics
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -35,17 +36,10 @@ def jet_features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     events = set_ak_column(events, "ht", ak.sum(events.Jet.pt, axis=1))
     events = set_ak_column(events, "n_jet", ak.num(events.Jet.pt, axis=1), value_type=np.int32)
 
-    # attach coffea behaviour
-    events = attach_coffea_behavior(events, collections={}, **kwargs)
-    # object padding (Note that after padding, ak.num(events.Jet.pt, axis=1) would always be >= 2)
-    events = set_ak_column(events, "Jet", ak.pad_none(events.Jet, 2))
-
-    # dijet features
-    dijet = ak.with_name(events.Jet[:, 0] + events.Jet[:, 1], "Jet")
-    dijet = set_ak_f32(dijet, "dr", events.Jet[:, 0].delta_r(events.Jet[:, 1]))
-    dijet_columns = ("pt", "mass", "dr")
-    for col in dijet_columns:
-        events = set_ak_f32(events, f"dijet.{col}", ak.fill_none(getattr(dijet, col), EMPTY_FLOAT))
+    # dijet features of the two leading jets, computed on flat arrays without coffea behavior
+    dijet = leading_pair_kinematics(events.Jet)
+    for col in ("pt", "mass", "dr"):
+        events = set_ak_f32(events, f"dijet.{col}", dijet[col])
 
     return events
 
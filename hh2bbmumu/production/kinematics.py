@@ -0,0 +1,181 @@
+# coding: utf-8
+
+"""
+Fast-path kinematics on flat numpy arrays in (pt, eta, phi, mass) coordinates, avoiding the
+attachment of coffea behavior and intermediate jagged arrays.
+"""
+
+from __future__ import annotations
+
+from columnflow.columnar_util import EMPTY_FLOAT, flat_np_view
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def collection_offsets(coll: ak.Array) -> np.ndarray:
+    """
+    Returns the offsets of the jagged collection *coll* with length ``len(coll) + 1``.
+    """
+    offsets = np.zeros(len(coll) + 1, dtype=np.int64)
+    np.cumsum(ak.to_numpy(ak.num(coll, axis=1)), out=offsets[1:])
+    return offsets
+
+
+def leading_pair_indices(offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns a mask denoting events with at least two objects as defined by *offsets*, as well as
+    the flat indices of the first and second object of those events.
+    """
+    valid = np.diff(offsets) >= 2
+    idx1 = offsets[:-1][valid]
+    return idx1, idx1 + 1, valid
+
+
+def to_cartesian(
+    pt: np.ndarray,
+    eta: np.ndarray,
+    phi: np.ndarray,
+    mass: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts (*pt*, *eta*, *phi*, *mass*) into cartesian (px, py, pz, energy) in double precision.
+    """
+    pt, eta, phi, mass = (np.asarray(v, dtype=np.float64) for v in (pt, eta, phi, mass))
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+    pz = pt * np.sinh(eta)
+    e = np.sqrt(px**2 + py**2 + pz**2 + mass**2)
+    return px, py, pz, e
+
+
+def from_cartesian(
+    px: np.ndarray,
+    py: np.ndarray,
+    pz: np.ndarray,
+    e: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts cartesian (*px*, *py*, *pz*, *e*) into (pt, eta, phi, mass). Negative squared masses
+    due to rounding are clipped to zero.
+    """
+    pt = np.hypot(px, py)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        eta = np.arcsinh(np.where(pt > 0, pz / pt, 0.0))
+    phi = np.arctan2(py, px)
+    mass = np.sqrt(np.maximum(e**2 - px**2 - py**2 - pz**2, 0.0))
+    return pt, eta, phi, mass
+
+
+def delta_phi(phi1: np.ndarray, phi2: np.ndarray) -> np.ndarray:
+    """
+    Returns the difference between *phi1* and *phi2*, wrapped into [-pi, pi).
+    """
+    return (np.asarray(phi1) - phi2 + np.pi) % (2 * np.pi) - np.pi
+
+
+def delta_r(eta1: np.ndarray, phi1: np.ndarray, eta2: np.ndarray, phi2: np.ndarray) -> np.ndarray:
+    """
+    Returns the angular distance between two sets of objects.
+    """
+    return np.hypot(np.asarray(eta1) - eta2, delta_phi(phi1, phi2))
+
+
+def pair_kinematics(
+    pt: np.ndarray,
+    eta: np.ndarray,
+    phi: np.ndarray,
+    mass: np.ndarray,
+    idx1: np.ndarray,
+    idx2: np.ndarray,
+) -> dict[str, np.ndarray]:
+    """
+    Returns the pt, eta, phi, mass and the delta R of the sum of the two objects at flat indices
+    *idx1* and *idx2* of the flat arrays *pt*, *eta*, *phi* and *mass*.
+    """
+    p1 = to_cartesian(pt[idx1], eta[idx1], phi[idx1], mass[idx1])
+    p2 = to_cartesian(pt[idx2], eta[idx2], phi[idx2], mass[idx2])
+    pair_pt, pair_eta, pair_phi, pair_mass = from_cartesian(*(c1 + c2 for c1, c2 in zip(p1, p2)))
+
+    return {
+        "pt": pair_pt,
+        "eta": pair_eta,
+        "phi": pair_phi,
+        "mass": pair_mass,
+        "dr": delta_r(eta[idx1], phi[idx1], eta[idx2], phi[idx2]),
+    }
+
+
+def leading_pair_kinematics(
+    coll: ak.Array,
+    fill_value: float = EMPTY_FLOAT,
+    dtype: type = np.float32,
+) -> dict[str, np.ndarray]:
+    """
+    Returns the kinematics (see :py:func:`pair_kinematics`) of the sum of the first two objects per
+    event of the collection *coll* as arrays of type *dtype*, with *fill_value* for events with
+    fewer than two objects.
+    """
+    flat = {f: flat_np_view(coll[f], axis=1) for f in ["pt", "eta", "phi", "mass"]}
+    idx1, idx2, valid = leading_pair_indices(collection_offsets(coll.pt))
+
+    result = {}
+    for key, values in pair_kinematics(**flat, idx1=idx1, idx2=idx2).items():
+        result[key] = np.full(len(valid), fill_value, dtype=dtype)
+        result[key][valid] = values
+
+    return result
+
+
+def pair_indices(
+    offsets: np.ndarray,
+    max_objects: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the flat indices of all unique pairs of objects per event as defined by *offsets*, as
+    well as the offsets of pairs per event. When *max_objects* is set, only pairs among the first
+    *max_objects* objects per event are considered, bounding the number of pairs per event.
+
+    Pairs are enumerated in colexicographic order, i.e., (0, 1), (0, 2), (1, 2), (0, 3), ..., so
+    that the pairs of an event with n objects are exactly the first n * (n - 1) / 2 entries of a
+    single lookup table that is shared by all events.
+    """
+    counts = np.diff(offsets)
+    if max_objects is not None:
+        counts = np.minimum(counts, max_objects)
+    n_pairs = counts * (counts - 1) // 2
+    pair_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(n_pairs, out=pair_offsets[1:])
+
+    # lookup table of local indices, rows of the lower triangle are (second, first) in colex order
+    n_max = int(counts.max()) if len(counts) else 0
+    local2, local1 = np.tril_indices(n_max, -1)
+
+    # position of each pair within its event and offset of the first object of its event
+    starts = np.repeat(offsets[:-1], n_pairs)
+    local = np.arange(pair_offsets[-1]) - np.repeat(pair_offsets[:-1], n_pairs)
+
+    return starts + local1[local], starts + local2[local], pair_offsets
+
+
+def segment_argmin(values: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Returns the index of the first minimum of *values* in each segment defined by *offsets*, or -1
+    for segments that are empty or only contain infinite values.
+    """
+    counts = np.diff(offsets)
+    result = np.full(len(counts), -1, dtype=np.int64)
+    nonempty = counts > 0
+    if not nonempty.any():
+        return result
+
+    mins = np.full(len(counts), np.inf)
+    mins[nonempty] = np.minimum.reduceat(values, offsets[:-1][nonempty])
+
+    # first position per segment at which the minimum is reached
+    candidates = np.flatnonzero(values == np.repeat(mins, counts))
+    found = nonempty & np.isfinite(mins)
+    result[found] = candidates[np.searchsorted(candidates, offsets[:-1][found])]
+
+    return result
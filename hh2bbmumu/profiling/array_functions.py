@@ -0,0 +1,241 @@
+# coding: utf-8
+
+"""
+Opt-in instrumentation of all nested calls of array functions (calibrators, selectors, producers,
+reducers, histogram producers, ...) that records wall time, CPU time, the peak memory allocated
+during calls and the number of input and output columns per call path, aggregated over all chunks
+processed by a task. Memory is traced with :py:mod:`tracemalloc`, which covers numpy (and therefore
+awkward) buffers but adds overhead to all allocations while profiling.
+
+Profiling is enabled via ``array_function_profiling`` in the ``[analysis]`` section of the law
+config. Reports are written per task branch as JSON and as an HTML icicle (flame-style) chart into
+``array_function_profiling_dir`` once the chunked event iteration of a task is finished, see
+:py:func:`~hh2bbmumu.columnflow_patches.patch_array_function_profiling`.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import time
+import html
+import tracemalloc
+
+from columnflow.types import Any, Callable
+from columnflow.util import maybe_import
+
+ak = maybe_import("awkward")
+
+
+def count_columns(obj: Any) -> int:
+    """
+    Returns the number of leaf columns of an awkward array *obj*, or 0 for other objects.
+    """
+    if not isinstance(obj, ak.Array):
+        return 0
+
+    def count(form) -> int:
+        if getattr(form, "is_record", False) or getattr(form, "is_union", False):
+            return sum(map(count, form.contents))
+        if hasattr(form, "content"):
+            return count(form.content)
+        return 1
+
+    return count(obj.layout.form)
+
+
+class CallNode(object):
+    """
+    Aggregated measurements of all calls of an array function *name* at a certain position in the
+    call tree.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__()
+
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = 0
+        self.columns_in = 0
+        self.columns_out = 0
+        self.children: dict[str, CallNode] = {}
+
+    def child(self, name: str) -> CallNode:
+        if name not in self.children:
+            self.children[name] = self.__class__(name)
+        return self.children[name]
+
+    @property
+    def self_time(self) -> float:
+        return self.wall_time - sum(child.wall_time for child in self.children.values())
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "calls": self.calls,
+            "wall_time": self.wall_time,
+            "self_time": self.self_time,
+            "cpu_time": self.cpu_time,
+            "peak_memory": self.peak_memory,
+            "columns_in": self.columns_in,
+            "columns_out": self.columns_out,
+            "children": [
+                child.to_dict()
+                for child in sorted(self.children.values(), key=lambda c: -c.wall_time)
+            ],
+        }
+
+
+class ArrayFunctionProfiler(object):
+    """
+    Collects :py:class:`CallNode` measurements of nested array function calls. Calls are recorded
+    through :py:meth:`wrap`, which is applied to the ``__call__`` method of array function classes.
+
+    The peak memory of a call is the maximum number of bytes traced by :py:mod:`tracemalloc` during
+    the call (including nested calls) minus those traced when it started. As the peak of
+    :py:mod:`tracemalloc` is global, it is reset when entering a call and the previous peak is
+    passed on to the calling frame, so that each frame on the stack keeps track of its own peak.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.started_tracing = False
+        self.reset(trace=False)
+
+    def reset(self, trace: bool = True) -> None:
+        """
+        Resets all measurements and, when *trace* is set, starts tracing memory allocations if not
+        done yet.
+        """
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+        self.root = CallNode("root")
+        # stack of nodes, ids of called instances, and their traced memory at start and peak
+        self.stack: list[tuple[CallNode, int, list[int]]] = [(self.root, 0, [0, 0])]
+        self.n_chunks = 0
+        self.t_start = time.perf_counter()
+
+    def stop(self) -> None:
+        """
+        Stops tracing memory allocations if started by :py:meth:`reset`.
+        """
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def wrap(self, call: Callable) -> Callable:
+        """
+        Returns a wrapper of the ``__call__`` method *call* of array functions that records all
+        calls in the current call tree.
+        """
+        profiler = self
+
+        def __call__(inst, *args, **kwargs):
+            # skip nested calls of the same instance, e.g. when both a class and its base are wrapped
+            if profiler.stack[-1][1] == id(inst):
+                return call(inst, *args, **kwargs)
+
+            parent_mem = profiler.stack[-1][2]
+            node = profiler.stack[-1][0].child(getattr(inst, "cls_name", None) or inst.__class__.__name__)
+            columns_in = count_columns(args[0]) if args else 0
+
+            # pass the peak so far to the calling frame before resetting it
+            current, peak = tracemalloc.get_traced_memory()
+            parent_mem[1] = max(parent_mem[1], peak)
+            tracemalloc.reset_peak()
+            mem = [current, current]
+
+            cpu0 = time.process_time()
+            t0 = time.perf_counter()
+
+            profiler.stack.append((node, id(inst), mem))
+            try:
+                result = call(inst, *args, **kwargs)
+            finally:
+                profiler.stack.pop()
+                node.calls += 1
+                node.wall_time += time.perf_counter() - t0
+                node.cpu_time += time.process_time() - cpu0
+                mem[1] = max(mem[1], tracemalloc.get_traced_memory()[1])
+                parent_mem[1] = max(parent_mem[1], mem[1])
+                node.peak_memory = max(node.peak_memory, mem[1] - mem[0])
+
+            out = result[0] if isinstance(result, tuple) and result else result
+            node.columns_in = max(node.columns_in, columns_in)
+            node.columns_out = max(node.columns_out, count_columns(out))
+
+            return result
+
+        __call__.__wrapped__ = call
+
+        return __call__
+
+    def to_dict(self, **meta) -> dict[str, Any]:
+        self.root.wall_time = sum(child.wall_time for child in self.root.children.values())
+        self.root.cpu_time = sum(child.cpu_time for child in self.root.children.values())
+        return {
+            **meta,
+            "n_chunks": self.n_chunks,
+            "total_time": time.perf_counter() - self.t_start,
+            "tree": self.root.to_dict(),
+        }
+
+    def write(self, path: str, **meta) -> tuple[str, str]:
+        """
+        Writes the report as JSON and HTML to *path* with extensions ``.json`` and ``.html``, and
+        returns both paths. *meta* is added to the JSON report.
+        """
+        data = self.to_dict(**meta)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        json_path = f"{path}.json"
+        with open(json_path, "w") as f:
+            json.dump(data, f, indent=4)
+
+        html_path = f"{path}.html"
+        with open(html_path, "w") as f:
+            f.write(render_html(data))
+
+        return json_path, html_path
+
+
+def render_html(data: dict[str, Any]) -> str:
+    """
+    Renders a report *data* created by :py:meth:`ArrayFunctionProfiler.to_dict` as a standalone
+    HTML icicle chart in which the width of each call is proportional to its wall time.
+    """
+    def render(node: dict[str, Any], parent_time: float) -> str:
+        width = 100.0 * node["wall_time"] / parent_time if parent_time > 0 else 100.0
+        title = (
+            f"{node['name']}: {node['wall_time']:.3f}s wall ({node['self_time']:.3f}s self), "
+            f"{node['cpu_time']:.3f}s cpu, {node['calls']} calls, "
+            f"peak memory +{node['peak_memory'] / 1024**2:.1f} MB, "
+            f"columns {node['columns_in']} -> {node['columns_out']}"
+        )
+        children = "".join(render(child, node["wall_time"]) for child in node["children"])
+        return (
+            f"<div class='node' style='width:{width:.3f}%'>"
+            f"<div class='bar' title='{html.escape(title, quote=True)}'>"
+            f"{html.escape(node['name'])} ({node['wall_time']:.2f}s)</div>"
+            f"<div class='children'>{children}</div></div>"
+        )
+
+    meta = ", ".join(f"{k}: {v}" for k, v in data.items() if k != "tree")
+    return (
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>array function profile</title><style>"
+        "body{font-family:sans-serif;font-size:12px}"
+        ".children{display:flex}"
+        ".node{box-sizing:border-box;overflow:hidden}"
+        ".bar{background:#f4a460;border:1px solid #fff;padding:2px;white-space:nowrap;overflow:hidden}"
+        ".bar:hover{background:#e9967a}"
+        f"</style></head><body><p>{html.escape(meta)}</p>{render(data['tree'], 0.0)}</body></html>"
+    )
+
+
+#: Process-wide profiler instance.
+profiler = ArrayFunctionProfiler()
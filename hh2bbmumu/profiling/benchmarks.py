@@ -0,0 +1,227 @@
+# coding: utf-8
+
+"""
+Micro-benchmarks comparing fast-path implementations to the jagged-array based implementations they
+replace, measuring wall time and peak memory of python-level allocations on synthetic events.
+
+Example:
+
+.. code-block:: bash
+
+    python -m hh2bbmumu.profiling.benchmarks dijet --n-events 1000000
+    python -m hh2bbmumu.profiling.benchmarks candidates --n-events 200000
+"""
+
+from __future__ import annotations
+
+import sys
+import time
+import tracemalloc
+
+from columnflow.types import Callable
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def make_objects(
+    n_events: int,
+    mean_multiplicity: float = 4.0,
+    name: str = "Jet",
+    seed: int = 0,
+) -> ak.Array:
+    """
+    Returns a jagged array of *n_events* with a Poisson-distributed number of objects with fields
+    pt, eta, phi and mass, sorted by decreasing pt and named *name*.
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(mean_multiplicity, n_events)
+    n = counts.sum()
+    pt = np.sort(rng.exponential(50.0, n).astype(np.float32) + 20.0)[::-1]
+    fields = {
+        "pt": pt,
+        "eta": rng.uniform(-2.5, 2.5, n).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+        "mass": rng.uniform(5.0, 20.0, n).astype(np.float32),
+    }
+    return ak.unflatten(ak.zip(fields, with_name=name), counts)
+
+
+def make_candidate_events(n_events: int, mean_muons: float = 3.0, mean_jets: float = 12.0) -> ak.Array:
+    """
+    Returns *n_events* synthetic events with muons and a high jet multiplicity as expected under
+    high pileup conditions, containing all columns required by
+    :py:func:`~hh2bbmumu.production.candidates.hh_candidates`.
+    """
+    rng = np.random.default_rng(1)
+    muons = make_objects(n_events, mean_muons, name="Muon", seed=2)
+    jets = make_objects(n_events, mean_jets, name="Jet", seed=3)
+    n_mu = int(ak.sum(ak.num(muons)))
+    n_jet = int(ak.sum(ak.num(jets)))
+    fields_mu = {
+        "charge": rng.choice([-1, 1], n_mu).astype(np.int32),
+        "tightId": rng.random(n_mu) < 0.8,
+        "pfRelIso04_all": rng.exponential(0.1, n_mu).astype(np.float32),
+    }
+    for field, values in fields_mu.items():
+        muons = ak.with_field(muons, ak.unflatten(values, ak.num(muons)), field)
+    jets = ak.with_field(jets, ak.unflatten(rng.random(n_jet).astype(np.float32), ak.num(jets)), "btagPNetB")
+    return ak.Array({"Muon": muons, "Jet": jets})
+
+
+def measure(func: Callable, *args, n_repeat: int = 3, **kwargs) -> tuple[float, float]:
+    """
+    Calls *func* with *args* and *kwargs* *n_repeat* times and returns the minimum wall time in
+    seconds as well as the peak memory of allocations traced during a separate call in MB.
+    """
+    times = []
+    for _ in range(n_repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak / 1024**2
+
+
+def dijet_coffea(jets: ak.Array) -> dict[str, ak.Array]:
+    """
+    Dijet features of the two leading *jets* via coffea vector behavior, as previously done in
+    :py:func:`~hh2bbmumu.production.example.jet_features`.
+    """
+    from columnflow.columnar_util import EMPTY_FLOAT
+    from coffea.nanoevents.methods import nanoaod
+
+    jets = ak.with_name(jets, "Jet", behavior=nanoaod.behavior)
+    jets = ak.pad_none(jets, 2)
+    dijet = jets[:, 0] + jets[:, 1]
+    return {
+        "pt": ak.fill_none(dijet.pt, EMPTY_FLOAT),
+        "mass": ak.fill_none(dijet.mass, EMPTY_FLOAT),
+        "dr": ak.fill_none(jets[:, 0].delta_r(jets[:, 1]), EMPTY_FLOAT),
+    }
+
+
+def dijet_fast(jets: ak.Array) -> dict[str, np.ndarray]:
+    """
+    Dijet features of the two leading *jets* via
+    :py:func:`~hh2bbmumu.production.kinematics.leading_pair_kinematics`.
+    """
+    from hh2bbmumu.production.kinematics import leading_pair_kinematics
+
+    return leading_pair_kinematics(jets)
+
+
+def candidates_awkward(events: ak.Array, max_muons: int = 4, max_jets: int = 6) -> tuple[ak.Array, ak.Array]:
+    """
+    Masses of the best dimuon (mass closest to 125 GeV) and dibjet (highest summed b-tag score)
+    candidates via :py:func:`ak.combinations` and jagged arithmetic.
+    """
+    def pair_mass(o1: ak.Array, o2: ak.Array) -> ak.Array:
+        p = [
+            o.pt * f
+            for o in (o1, o2)
+            for f in (np.cos(o.phi), np.sin(o.phi), np.sinh(o.eta))
+        ]
+        e = [np.sqrt((o.pt * np.cosh(o.eta))**2 + o.mass**2) for o in (o1, o2)]
+        m2 = (e[0] + e[1])**2 - (p[0] + p[3])**2 - (p[1] + p[4])**2 - (p[2] + p[5])**2
+        return np.sqrt(np.maximum(m2, 0))
+
+    def best(o1: ak.Array, o2: ak.Array, score: ak.Array) -> ak.Array:
+        idx = ak.argmin(score, axis=1, keepdims=True)
+        return ak.firsts(ak.mask(pair_mass(o1, o2), score < np.inf)[idx])
+
+    m1, m2 = ak.unzip(ak.combinations(events.Muon[:, :max_muons], 2))
+    valid = (m1.charge != m2.charge) & (m1.pfRelIso04_all < 0.15) & (m2.pfRelIso04_all < 0.15)
+    valid = valid & (m1.tightId | m2.tightId)
+    mumu = best(m1, m2, ak.where(valid, abs(pair_mass(m1, m2) - 125.0), np.inf))
+
+    j1, j2 = ak.unzip(ak.combinations(events.Jet[:, :max_jets], 2))
+    bb = best(j1, j2, -(ak.values_astype(j1.btagPNetB, np.float64) + j2.btagPNetB))
+
+    return mumu, bb
+
+
+def candidates_fast(events: ak.Array, max_muons: int = 4, max_jets: int = 6) -> tuple[dict, dict]:
+    """
+    Same candidates as :py:func:`candidates_awkward` via
+    :py:func:`~hh2bbmumu.production.candidates.best_pairs` on flat arrays.
+    """
+    from hh2bbmumu.production.candidates import best_pairs
+
+    charge = ak.to_numpy(ak.flatten(events.Muon.charge))
+    iso_ok = ak.to_numpy(ak.flatten(events.Muon.pfRelIso04_all)) < 0.15
+    tight = ak.to_numpy(ak.flatten(events.Muon.tightId))
+
+    mumu = best_pairs(
+        events.Muon,
+        "mass",
+        valid_pair=lambda i1, i2: (charge[i1] != charge[i2]) & iso_ok[i1] & iso_ok[i2] & (tight[i1] | tight[i2]),
+        max_objects=max_muons,
+        mass_target=125.0,
+    )
+    bb = best_pairs(
+        events.Jet,
+        "score",
+        max_objects=max_jets,
+        score=ak.to_numpy(ak.flatten(events.Jet.btagPNetB)),
+    )
+    return mumu, bb
+
+
+#: Registered benchmarks, mapping names to (object factory, {implementation name: function}).
+benchmarks: dict[str, tuple[Callable, dict[str, Callable]]] = {
+    "dijet": (make_objects, {"coffea": dijet_coffea, "fast": dijet_fast}),
+    "candidates": (make_candidate_events, {"awkward": candidates_awkward, "fast": candidates_fast}),
+}
+
+
+def run_benchmark(name: str, n_events: int, n_repeat: int = 3) -> dict[str, tuple[float, float]]:
+    """
+    Runs the benchmark *name* on *n_events* synthetic events and returns a mapping of implementation
+    names to their wall time and peak memory (see :py:func:`measure`). Implementations whose
+    dependencies are missing are skipped.
+    """
+    make_input, funcs = benchmarks[name]
+    inp = make_input(n_events)
+
+    results = {}
+    for impl, func in funcs.items():
+        try:
+            results[impl] = measure(func, inp, n_repeat=n_repeat)
+        except ImportError as e:
+            print(f"skipping {name}/{impl}: {e}")
+
+    return results
+
+
+def main(args: list[str] | None = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="run micro-benchmarks of fast-path implementations")
+    parser.add_argument("benchmark", choices=list(benchmarks), nargs="+", help="benchmarks to run")
+    parser.add_argument("--n-events", type=int, default=1_000_000, help="number of synthetic events")
+    parser.add_argument("--n-repeat", type=int, default=3, help="number of timed repetitions")
+    args = parser.parse_args(args)
+
+    for name in args.benchmark:
+        results = run_benchmark(name, args.n_events, n_repeat=args.n_repeat)
+        ref = next(iter(results.values()), None)
+        for impl, (seconds, peak) in results.items():
+            print(
+                f"{name:<12} {impl:<8} {seconds:>8.3f}s ({ref[0] / seconds:>5.1f}x) "
+                f"{peak:>9.1f} MB ({ref[1] / peak:>5.1f}x)",
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# coding: utf-8
+
+"""
+Profiler of the import cost of all modules that law and columnflow load at startup, i.e., the task
+modules in the ``[modules]`` section and the ``*_modules`` options in the ``[analysis]`` section of
+the law config.
+
+Example:
+
+.. code-block:: bash
+
+    # cumulative cost in a single process, in the order in which modules are loaded
+    hh2bbmumu_profile_imports
+
+    # standalone cost of each module in a fresh process, including the 5 heaviest nested imports
+    hh2bbmumu_profile_imports --isolated --details 5
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import sys
+import time
+import importlib
+import subprocess
+from dataclasses import dataclass, field
+
+import law
+
+
+@dataclass
+class ImportCost:
+
+    module: str
+    option: str
+    seconds: float = 0.0
+    n_new_modules: int = 0
+    error: str | None = None
+    details: list[tuple[str, float]] = field(default_factory=list)
+
+
+def get_configured_modules() -> list[tuple[str, str]]:
+    """
+    Returns a list of (option, module) pairs of all modules configured in the law config, in the
+    order in which they are loaded.
+    """
+    modules = [("modules", mod) for mod in law.config.options("modules")]
+
+    for option in law.config.options("analysis"):
+        if not option.endswith("_modules"):
+            continue
+        for value in law.config.get_expanded("analysis", option, split_csv=True):
+            modules.extend((option, mod) for mod in law.util.brace_expand(value.strip()) if mod)
+
+    return modules
+
+
+def profile_import(module: str) -> tuple[float, int]:
+    """
+    Imports *module* in the current process and returns the elapsed time in seconds and the number
+    of newly loaded modules.
+    """
+    n_before = len(sys.modules)
+    t0 = time.perf_counter()
+    importlib.import_module(module)
+    return time.perf_counter() - t0, len(sys.modules) - n_before
+
+
+def profile_import_isolated(module: str, n_details: int = 0) -> tuple[float, int, list[tuple[str, float]]]:
+    """
+    Imports *module* in a fresh interpreter and returns the elapsed time in seconds, the number of
+    newly loaded modules, and the *n_details* nested imports with the highest cumulative cost as
+    reported by ``python -X importtime``.
+    """
+    code = (
+        "import sys, time, importlib; n = len(sys.modules); t0 = time.perf_counter(); "
+        f"importlib.import_module({module!r}); "
+        "print(time.perf_counter() - t0, len(sys.modules) - n)"
+    )
+    cmd = [sys.executable] + (["-X", "importtime"] if n_details > 0 else []) + ["-c", code]
+    p = subprocess.run(cmd, capture_output=True, text=True, env=os.environ)
+    if p.returncode != 0:
+        raise ImportError(p.stderr.strip().splitlines()[-1] if p.stderr.strip() else "unknown error")
+    seconds, n_new = p.stdout.strip().splitlines()[-1].split()
+
+    details = []
+    if n_details > 0:
+        # lines look like "import time:   self [us] |  cumulative | imported package"
+        cre = re.compile(r"^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(.+)$")
+        for line in p.stderr.splitlines():
+            m = cre.match(line)
+            if m and m.group(3).strip() != module:
+                details.append((m.group(3).strip(), int(m.group(2)) * 1e-6))
+        details = sorted(details, key=lambda d: -d[1])[:n_details]
+
+    return float(seconds), int(n_new), details
+
+
+def profile_configured_modules(isolated: bool = False, n_details: int = 0) -> list[ImportCost]:
+    """
+    Profiles the imports of all modules returned by :py:func:`get_configured_modules`. When not
+    *isolated*, modules are imported in order in the current process, so that each module is only
+    accounted for the cost of dependencies not already loaded by previous ones.
+    """
+    costs = []
+    seen = set()
+    for option, module in get_configured_modules():
+        if module in seen:
+            continue
+        seen.add(module)
+
+        cost = ImportCost(module=module, option=option)
+        try:
+            if isolated:
+                cost.seconds, cost.n_new_modules, cost.details = profile_import_isolated(module, n_details)
+            else:
+                cost.seconds, cost.n_new_modules = profile_import(module)
+        except Exception as e:
+            cost.error = str(e)
+        costs.append(cost)
+
+    return costs
+
+
+def print_report(costs: list[ImportCost], sort: bool = False) -> None:
+    total = sum(cost.seconds for cost in costs)
+    rows = sorted(costs, key=lambda c: -c.seconds) if sort else costs
+    cumulative = 0.0
+
+    width = max([len(cost.module) for cost in costs] + [6])
+    print(f"{'module':<{width}}  {'option':<26} {'time [s]':>9} {'cum. [s]':>9} {'share':>6} {'#new':>6}")
+    for cost in rows:
+        cumulative += cost.seconds
+        share = cost.seconds / total if total else 0.0
+        line = (
+            f"{cost.module:<{width}}  {cost.option:<26} {cost.seconds:>9.3f} {cumulative:>9.3f} "
+            f"{share:>6.1%} {cost.n_new_modules:>6}"
+        )
+        if cost.error:
+            line += f"  (error: {cost.error})"
+        print(line)
+        for name, seconds in cost.details:
+            print(f"    {name:<{width - 4}}  {'':<26} {seconds:>9.3f}")
+    print(f"total: {total:.3f}s")
+
+
+def main(args: list[str] | None = None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="report the import cost of all modules configured in the law config",
+    )
+    parser.add_argument(
+        "--isolated",
+        action="store_true",
+        help="import each module in a fresh process to measure its standalone cost",
+    )
+    parser.add_argument(
+        "--details",
+        type=int,
+        default=0,
+        help="number of heaviest nested imports to show per module (requires --isolated)",
+    )
+    parser.add_argument("--sort", action="store_true", help="sort modules by import cost")
+    args = parser.parse_args(args)
+
+    costs = profile_configured_modules(isolated=args.isolated, n_details=args.details)
+    print_report(costs, sort=args.sort)
+
+    return 1 if any(cost.error for cost in costs) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
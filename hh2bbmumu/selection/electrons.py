@@ -1,16 +1,8 @@
 # from pylint.interfaces import HIGH
 
-from collections import defaultdict
-
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.selection.stats import increment_stats
-from columnflow.columnar_util import sorted_indices_from_mask
-from columnflow.production.processes import process_ids
-from columnflow.production.cms.mc_weight import mc_weight
 from columnflow.util import maybe_import
 
-from hh2bbmumu.production.example import cutflow_features
-
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
@@ -7,27 +7,29 @@ Selection methods.
 
 from __future__ import annotations
 
-from operator import and_
-from functools import reduce
 from collections import defaultdict
 
 from columnflow.production.util import attach_coffea_behavior
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.selection.stats import increment_stats
-from columnflow.selection.cms.json_filter import json_filter
 from columnflow.selection.cms.met_filters import met_filters
 from columnflow.production.processes import process_ids
 from columnflow.production.cms.mc_weight import mc_weight
 from columnflow.production.cms.pileup import pu_weight
 from columnflow.production.cms.pdf import pdf_weights
 from columnflow.production.cms.scale import murmuf_weights
+from columnflow.columnar_util import set_ak_column
 from columnflow.util import maybe_import
 
 # from hh2bbmumu.selection.trigger import trigger_selection
 from hh2bbmumu.selection.electrons import electron_selection
 from hh2bbmumu.selection.jet import jet_selection
 from hh2bbmumu.selection.muons import muon_selection
+from hh2bbmumu.selection.fused import fused_object_selection
+from hh2bbmumu.selection.lumi import cached_json_filter
+from hh2bbmumu.selection.steps import PackedSteps
+from hh2bbmumu.selection.stats import grouped_stats
 from hh2bbmumu.util import IF_DATASET_HAS_LHE_WEIGHTS, IF_RUN_3
+from hh2bbmumu.metrics import metrics
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -43,16 +45,20 @@ ak = maybe_import("awkward")
 
 @selector(
     uses={
-        json_filter, jet_selection, electron_selection, muon_selection, # met_filters
-        mc_weight, pu_weight, process_ids, increment_stats, attach_coffea_behavior,
+        cached_json_filter, jet_selection, electron_selection, muon_selection, # met_filters
+        mc_weight, pu_weight, process_ids, grouped_stats, attach_coffea_behavior,
         IF_DATASET_HAS_LHE_WEIGHTS(pdf_weights, murmuf_weights),
     },
     produces={
         jet_selection, electron_selection, muon_selection,
-        mc_weight, pu_weight, process_ids, increment_stats,# category_ids,
+        mc_weight, pu_weight, process_ids,# category_ids,
         IF_DATASET_HAS_LHE_WEIGHTS(pdf_weights, murmuf_weights),
     },
     exposed=True,
+    # whether to run the jet, electron and muon selections through the fused object selection
+    fused_object_selection=False,
+    # whether to pack step masks into bits of a single column instead of storing them separately
+    packed_steps=False,
 )
 def default(
     self: Selector,
@@ -62,24 +68,30 @@ def default(
 ) -> tuple[ak.Array, SelectionResult]:
     # ensure coffea behavior
     events = self[attach_coffea_behavior](events, **kwargs)
-    print(len(events), " events in the input")
+    metrics.inc("selection_events_total", len(events))
+
     # prepare the selection results that are updated at every step
     results = SelectionResult()
 
     # filter bad data events according to golden lumi mask
     if self.dataset_inst.is_data:
-        events, json_filter_results = self[json_filter](events, **kwargs)
+        with metrics.timer("selection_step_seconds", step="json"):
+            events, json_filter_results = self[cached_json_filter](events, **kwargs)
         results += json_filter_results
     else:
         results += SelectionResult(steps={"json": np.ones(len(events), dtype=bool)})
 
-    print("We are in: ", __file__)
     # met filter selection
     # events, met_filter_results = self[met_filters](events, **kwargs)
     # TODO?: patch for the broken "Flag_ecalBadCalibFilter" MET filter in prompt data (tag set in config)
 
     # results += met_filter_results
 
+    # fused jet, electron and muon selection in a single pass
+    if self.fused_object_selection:
+        with metrics.timer("selection_step_seconds", step="objects"):
+            events, object_results = self[fused_object_selection](events, **kwargs)
+        results += object_results
 
     # # jet selection
     # events, jet_results = self[jet_selection](events, **kwargs)
@@ -98,28 +110,45 @@ def default(
 
     # mc-only functions
     if self.dataset_inst.is_mc:
-        events = self[mc_weight](events, **kwargs)
+        with metrics.timer("selection_step_seconds", step="mc_weights"):
+            events = self[mc_weight](events, **kwargs)
 
-        # pdf weights
-        if self.has_dep(pdf_weights):
-            events = self[pdf_weights](events, outlier_log_mode="debug", **kwargs)
+            # pdf weights
+            if self.has_dep(pdf_weights):
+                events = self[pdf_weights](events, outlier_log_mode="debug", **kwargs)
 
-        # renormalization/factorization scale weights
-        if self.has_dep(murmuf_weights):
-            events = self[murmuf_weights](events, **kwargs)
+            # renormalization/factorization scale weights
+            if self.has_dep(murmuf_weights):
+                events = self[murmuf_weights](events, **kwargs)
 
-        # pileup weights
-        events = self[pu_weight](events, **kwargs)
+            # pileup weights
+            events = self[pu_weight](events, **kwargs)
 
         # TODO?: btag weights
 
-    print("The following steps were applied:", results.steps)
-    # combined event selection after all steps
-    if results.steps:
-        event_sel = reduce(and_, results.steps.values())
+    # combined event selection after all steps, recording per-step and cumulative pass counts
+    if self.packed_steps:
+        # move step masks into bits of cutflow.step_bits (kept for cf.MergeSelectionMasks), keeping
+        # only the combined selection as a single step, and count events passing steps cumulatively
+        packed = PackedSteps(self.config_inst.x.selector_step_bits, n_events=len(events))
+        packed.add_steps(results.steps)
+        event_sel = packed.mask()
+        events = set_ak_column(events, "cutflow.step_bits", packed.bits, value_type=packed.dtype)
+        results.steps["packed"] = event_sel
+        for name, n in packed.cutflow().items():
+            stats[f"num_events_cumulative_{name}"] += n
+            if name != "initial":
+                metrics.inc("selection_cutflow_passed_total", n, step=name)
+        for name in packed.added:
+            metrics.inc("selection_step_passed_total", np.sum(packed.get(name)), step=name)
     else:
         event_sel = np.ones(len(events), dtype=bool)
-    print(event_sel.shape, event_sel.sum()) 
+        for name, step_sel in results.steps.items():
+            step_sel = np.asarray(step_sel, dtype=bool)
+            event_sel = event_sel & step_sel
+            metrics.inc("selection_step_passed_total", np.sum(step_sel), step=name)
+            metrics.inc("selection_cutflow_passed_total", np.sum(event_sel), step=name)
+    metrics.inc("selection_events_selected_total", np.sum(event_sel))
     results.event = event_sel
 
     # increment stats
@@ -136,6 +165,24 @@ def default(
     return events, results
 
 
+@default.init
+def default_init(self: Selector) -> None:
+    if self.fused_object_selection:
+        self.uses.add(fused_object_selection)
+        self.produces.add(fused_object_selection)
+
+    if self.packed_steps:
+        self.produces.add("cutflow.step_bits")
+
+
+default_fused = default.derive("default_fused", cls_dict={"fused_object_selection": True})
+
+default_packed = default.derive("default_packed", cls_dict={"packed_steps": True})
+
+default_fused_packed = default.derive(
+    "default_fused_packed",
+    cls_dict={"fused_object_selection": True, "packed_steps": True},
+)
 
 
 def setup_and_increment_stats(
@@ -150,7 +197,7 @@ def setup_and_increment_stats(
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
     """
-    Helper function that sets up the weight and group maps for the increment_stats task, invokes it
+    Helper function that sets up the weight and group maps for the grouped_stats selector, invokes it
     and returns the updated events and results objects.
     ** Taken from bbtautau analysis **
 
@@ -222,20 +269,18 @@ def setup_and_increment_stats(
         #     # per process
         #     "process": {
         #         "values": events.process_id,
-        #         "mask_fn": (lambda v: events.process_id == v),
         #     },
         # }
         # per jet multiplicity
         if njets is not None:
             group_map["njet"] = {
                 "values": njets,
-                "mask_fn": (lambda v: njets == v),
             }
 
         # combinations
         group_combinations.append(("process", "njet"))
 
-    return self[increment_stats](
+    return self[grouped_stats](
         events,
         results,
         stats,
@@ -0,0 +1,141 @@
+# coding: utf-8
+
+"""
+Fused object selection that evaluates the jet, electron and muon selections in a single pass over
+the flat content arrays of all three collections.
+"""
+
+from __future__ import annotations
+
+import time
+
+import law
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.columnar_util import flat_np_view
+from columnflow.util import maybe_import
+
+from hh2bbmumu.selection.muons import muon_id_bits, has_muon_id
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def _offsets(coll: ak.Array) -> np.ndarray:
+    """
+    Returns the offsets of a jagged collection *coll* as a numpy array of length ``len(coll) + 1``.
+    """
+    offsets = np.zeros(len(coll) + 1, dtype=np.int64)
+    np.cumsum(ak.to_numpy(ak.num(coll, axis=1)), out=offsets[1:])
+    return offsets
+
+
+def _segment_count(mask: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Counts the number of *True* values in *mask* per segment defined by *offsets*. Unlike
+    ``np.add.reduceat``, empty segments are handled correctly.
+    """
+    csum = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=csum[1:])
+    return csum[offsets[1:]] - csum[offsets[:-1]]
+
+
+def fused_object_masks(
+    jet: dict[str, np.ndarray],
+    electron: dict[str, np.ndarray],
+    muon: dict[str, np.ndarray],
+) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    Kernel of the fused object selection, operating on flat numpy arrays only. Each of *jet*,
+    *electron* and *muon* maps field names to flat content arrays and must contain an additional
+    ``"offsets"`` entry. The cuts are identical to those in :py:func:`~hh2bbmumu.selection.jet.
+    jet_selection`, :py:func:`~hh2bbmumu.selection.electrons.electron_selection` and
+    :py:func:`~hh2bbmumu.selection.muons.muon_selection`, with muons being selected through the
+    ``"base"`` bit of their ``"id_bits"`` (see :py:func:`~hh2bbmumu.selection.muons.muon_id_bits`).
+
+    :return: Dictionary mapping collection names to tuples of flat object masks and the number of
+        selected objects per event.
+    """
+    # jets
+    jet_mask = (jet["pt"] > 20.0) & (np.abs(jet["eta"]) < 2.4)
+
+    # electrons
+    electron_abs_eta = np.abs(electron["eta"])
+    electron_mask = (electron["pt"] > 20.0) & (
+        (electron_abs_eta < 1.44) |
+        ((electron_abs_eta < 2.5) & (electron_abs_eta > 1.57))
+    )
+
+    # muons
+    muon_mask = has_muon_id(muon["id_bits"], "base")
+
+    return {
+        "Jet": (jet_mask, _segment_count(jet_mask, jet["offsets"])),
+        "Electron": (electron_mask, _segment_count(electron_mask, electron["offsets"])),
+        "Muon": (muon_mask, _segment_count(muon_mask, muon["offsets"])),
+    }
+
+
+@selector(
+    uses={muon_id_bits, "Jet.{pt,eta}", "Electron.{pt,eta}"},
+    produces={muon_id_bits},
+)
+def fused_object_selection(
+    self: Selector,
+    events: ak.Array,
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Drop-in replacement for calling ``jet_selection``, ``electron_selection`` and ``muon_selection``
+    one after another that produces the same steps, object masks and auxiliary data, but reads each
+    flat column only once.
+    """
+    t0 = time.perf_counter()
+
+    # muon id bits as used by muon_selection
+    events = self[muon_id_bits](events, **kwargs)
+
+    # gather flat views of all needed columns
+    flat = {}
+    for coll_name, fields in [
+        ("Jet", ["pt", "eta"]),
+        ("Electron", ["pt", "eta"]),
+        ("Muon", ["id_bits"]),
+    ]:
+        coll = events[coll_name]
+        flat[coll_name] = {field: flat_np_view(coll[field], axis=1) for field in fields}
+        flat[coll_name]["offsets"] = _offsets(coll[fields[0]])
+
+    # run the kernel
+    masks = fused_object_masks(flat["Jet"], flat["Electron"], flat["Muon"])
+
+    # convert flat masks back to jagged arrays, reusing the per-event counts of the input
+    jagged = {
+        coll_name: ak.unflatten(mask, np.diff(flat[coll_name]["offsets"]))
+        for coll_name, (mask, _) in masks.items()
+    }
+
+    results = SelectionResult(
+        steps={
+            "jet": masks["Jet"][1] >= 2,
+            "electron": masks["Electron"][1] == 0,
+            "muon": masks["Muon"][1] >= 2,
+        },
+        objects={
+            coll_name: {coll_name: mask}
+            for coll_name, mask in jagged.items()
+        },
+        aux={
+            # same definition as in jet_selection
+            "n_central_jets": np.diff(flat["Jet"]["offsets"]),
+        },
+    )
+
+    logger.debug(
+        f"fused object selection of {len(events)} events took {time.perf_counter() - t0:.3f}s",
+    )
+
+    return events, results
@@ -0,0 +1,138 @@
+# coding: utf-8
+
+"""
+Lumi mask selection based on pre-evaluated and cached golden JSON run/lumi ranges.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+
+import law
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+# process-wide cache of lumi ranges, mapping (path, version) to (starts, stops) arrays
+_lumi_ranges_cache: dict[tuple[str, str], tuple[np.ndarray, np.ndarray]] = {}
+
+
+def pack_run_lumi(run: np.ndarray, lumi: np.ndarray) -> np.ndarray:
+    """
+    Packs *run* and *lumi* numbers into sortable ``uint64`` keys.
+    """
+    return (
+        (np.asarray(run).astype(np.uint64) << np.uint64(32)) |
+        np.asarray(lumi).astype(np.uint64)
+    )
+
+
+def parse_lumi_ranges(golden_json: dict[str, list[list[int]]]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Converts the content of a *golden_json* file, mapping runs to lists of inclusive lumi ranges,
+    into two sorted arrays of packed start and stop keys (see :py:func:`pack_run_lumi`).
+    """
+    runs, lumi_starts, lumi_stops = [], [], []
+    for run, ranges in golden_json.items():
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        runs.append(np.full(len(ranges), int(run), dtype=np.int64))
+        lumi_starts.append(ranges[:, 0])
+        lumi_stops.append(ranges[:, 1])
+
+    if not runs:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+
+    runs = np.concatenate(runs)
+    starts = pack_run_lumi(runs, np.concatenate(lumi_starts))
+    stops = pack_run_lumi(runs, np.concatenate(lumi_stops))
+    order = np.argsort(starts, kind="stable")
+
+    return starts[order], stops[order]
+
+
+def load_lumi_ranges(path: str, version: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the sorted start and stop keys of lumi ranges in the golden json file at *path*. Results
+    are cached per process as well as in a file next to *path*, keyed by the file *version*.
+    """
+    key = (os.path.realpath(path), str(version))
+    if key in _lumi_ranges_cache:
+        return _lumi_ranges_cache[key]
+
+    cache_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{version}.lumi_ranges.npy")
+    if os.path.exists(cache_path):
+        starts, stops = np.load(cache_path)
+    else:
+        with open(path, "r") as f:
+            starts, stops = parse_lumi_ranges(json.load(f))
+
+        # try to store the converted ranges, but the external files might be read-only
+        try:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, np.stack([starts, stops]))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.debug(f"could not cache lumi ranges at {cache_path}: {e}")
+
+    _lumi_ranges_cache[key] = (starts, stops)
+
+    return starts, stops
+
+
+@selector(
+    uses={"run", "luminosityBlock"},
+    # function to determine the golden lumi file and its version
+    get_lumi_file=(lambda self, external_files: external_files.lumi.golden),
+)
+def cached_json_filter(
+    self: Selector,
+    events: ak.Array,
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Drop-in replacement for columnflow's :py:func:`~columnflow.selection.cms.json_filter.json_filter`
+    that looks up all events in the cached, sorted lumi ranges with a single ``searchsorted``.
+    """
+    if not len(self.lumi_starts):
+        return events, SelectionResult(steps={"json": np.zeros(len(events), dtype=bool)})
+
+    keys = pack_run_lumi(events.run, events.luminosityBlock)
+
+    # index of the last range starting at or before each key
+    idx = np.searchsorted(self.lumi_starts, keys, side="right") - 1
+    mask = (idx >= 0) & (keys <= self.lumi_stops[np.maximum(idx, 0)])
+
+    return events, SelectionResult(steps={"json": mask})
+
+
+@cached_json_filter.requires
+def cached_json_filter_requires(self: Selector, task: law.Task, reqs: dict) -> None:
+    if "external_files" in reqs:
+        return
+
+    from columnflow.tasks.external import BundleExternalFiles
+    reqs["external_files"] = BundleExternalFiles.req(task)
+
+
+@cached_json_filter.setup
+def cached_json_filter_setup(
+    self: Selector,
+    task: law.Task,
+    reqs: dict,
+    inputs: dict,
+    reader_targets: law.util.InsertableDict,
+) -> None:
+    self.lumi_starts = self.lumi_stops = np.zeros(0, dtype=np.uint64)
+    if not self.dataset_inst.is_data:
+        return
+
+    lumi_file = self.get_lumi_file(reqs["external_files"].files)
+    version = self.get_lumi_file(self.config_inst.x.external_files)[1]
+    self.lumi_starts, self.lumi_stops = load_lumi_ranges(lumi_file.abspath, version)
@@ -1,34 +1,171 @@
+from __future__ import annotations
 
-from collections import defaultdict
+import json
 
+import law
+
+from columnflow.production import Producer, producer
 from columnflow.selection import Selector, SelectionResult, selector
-from columnflow.selection.stats import increment_stats
-from columnflow.columnar_util import sorted_indices_from_mask
-from columnflow.production.processes import process_ids
-from columnflow.production.cms.mc_weight import mc_weight
+from columnflow.columnar_util import Route, flat_np_view, set_ak_column
 from columnflow.util import maybe_import
 
-from hh2bbmumu.production.example import cutflow_features
-
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+#: Bits of the muon id working points in the ``Muon.id_bits`` column.
+muon_id_bit = {
+    "base": 0,
+    "loose": 1,
+    "medium": 2,
+    "tight": 3,
+    "loose_iso": 4,
+    "tight_iso": 5,
+}
+
+# process-wide cache of compiled working point tables, mapping their json representation to cuts
+_muon_id_cuts_cache: dict[str, list[tuple[int, list[tuple[str, str, float | None]]]]] = {}
+
+
+def compile_muon_id_working_points(
+    working_points: dict[str, dict],
+) -> list[tuple[int, list[tuple[str, str, float | None]]]]:
+    """
+    Converts a table of muon id *working_points* as stored in the ``muon_id_working_points`` auxiliary
+    config entry into a list of (bit, cuts) pairs, with cuts being (operator, field, threshold)
+    tuples. Results are cached per process.
+    """
+    key = json.dumps(working_points, sort_keys=True)
+    if key in _muon_id_cuts_cache:
+        return _muon_id_cuts_cache[key]
+
+    compiled = []
+    for name, wp in working_points.items():
+        if name not in muon_id_bit:
+            raise ValueError(f"unknown muon id working point '{name}', known are {list(muon_id_bit)}")
+        cuts = []
+        for op, spec in wp.items():
+            if op in ("min", "max", "max_abs"):
+                cuts.extend((op, field, float(value)) for field, value in spec.items())
+            elif op in ("all", "any"):
+                cuts.extend((op, field, None) for field in spec)
+            else:
+                raise ValueError(f"unknown operator '{op}' in muon id working point '{name}'")
+        compiled.append((muon_id_bit[name], cuts))
+
+    _muon_id_cuts_cache[key] = compiled
+
+    return compiled
+
+
+def evaluate_muon_id_bits(
+    muon: dict[str, np.ndarray],
+    compiled: list[tuple[int, list[tuple[str, str, float | None]]]],
+) -> np.ndarray:
+    """
+    Evaluates all *compiled* working points (see :py:func:`compile_muon_id_working_points`) on flat
+    arrays of *muon* fields in a single pass and returns the packed ``uint8`` id bits.
+    """
+    n = len(next(iter(muon.values()))) if muon else 0
+    bits = np.zeros(n, dtype=np.uint8)
+
+    abs_values = {}
+    for bit, cuts in compiled:
+        passed = np.ones(n, dtype=bool)
+        any_mask = None
+        for op, field, value in cuts:
+            if op == "min":
+                passed &= muon[field] > value
+            elif op == "max":
+                passed &= muon[field] < value
+            elif op == "max_abs":
+                if field not in abs_values:
+                    abs_values[field] = np.abs(muon[field])
+                passed &= abs_values[field] < value
+            elif op == "all":
+                passed &= muon[field].astype(bool)
+            else:  # any
+                any_mask = muon[field].astype(bool) if any_mask is None else (any_mask | muon[field].astype(bool))
+        if any_mask is not None:
+            passed &= any_mask
+        bits |= passed.astype(np.uint8) << np.uint8(bit)
+
+    return bits
+
+
+def has_muon_id(id_bits: np.ndarray | ak.Array, *names: str) -> np.ndarray | ak.Array:
+    """
+    Returns a mask denoting muons with *id_bits* that pass all working points *names*.
+    """
+    mask = sum(1 << muon_id_bit[name] for name in names)
+    return (id_bits & mask) == mask
+
+
+@producer(
+    uses={"Muon.pt"},
+    produces={"Muon.id_bits"},
+    # function to determine the working point table
+    get_muon_id_working_points=(lambda self: self.config_inst.x.muon_id_working_points),
+)
+def muon_id_bits(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
+    """
+    Evaluates all muon id and isolation working points configured in the
+    ``muon_id_working_points`` auxiliary config entry in one vectorized pass and stores them as a
+    bitmask in ``Muon.id_bits`` (see :py:attr:`muon_id_bit`). Downstream selectors and producers
+    should test bits via :py:func:`has_muon_id` instead of repeating the cuts. When the column is
+    already present, it is only recomputed if the shift of the task aliases any of the muon fields
+    entering the working points, as the existing bits would refer to unshifted values otherwise.
+    """
+    if "id_bits" in events.Muon.fields and not self.shifted_muon_id_fields:
+        return events
+
+    muon = {field: flat_np_view(events.Muon[field], axis=1) for field in self.muon_id_fields}
+    bits = evaluate_muon_id_bits(muon, self.muon_id_cuts)
+
+    return set_ak_column(
+        events,
+        "Muon.id_bits",
+        ak.unflatten(bits, ak.num(events.Muon, axis=1)),
+        value_type=np.uint8,
+    )
+
+
+@muon_id_bits.init
+def muon_id_bits_init(self: Producer) -> None:
+    self.muon_id_cuts = compile_muon_id_working_points(self.get_muon_id_working_points())
+    self.muon_id_fields = sorted({field for _, cuts in self.muon_id_cuts for _, field, _ in cuts})
+    self.uses |= {f"Muon.{field}" for field in self.muon_id_fields}
+    self.shifted_muon_id_fields = set()
+
+
+@muon_id_bits.post_init
+def muon_id_bits_post_init(self: Producer, task: law.Task, **kwargs) -> None:
+    super(muon_id_bits, self).post_init_func(task=task, **kwargs)
+
+    # muon fields whose values are replaced by shifted ones through column aliases
+    shift_inst = getattr(task, "local_shift_inst", None)
+    aliases = shift_inst.x("column_aliases", {}) if shift_inst else {}
+    self.shifted_muon_id_fields = {
+        field
+        for field in self.muon_id_fields
+        if any(Route(src).column == f"Muon.{field}" for src in aliases)
+    }
+
+
 @selector(
-    uses={"Muon.{pt,eta,phi,dxy,dz}"},
+    uses={muon_id_bits},
+    produces={muon_id_bits},
 )
 def muon_selection(
     self: Selector,
     events: ak.Array,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
-    # example muon selection: exactly one muon
-    #
-    # Choose events with 2 muons
-    muon_mask = (events.Muon.pt > 20.0) & (abs(events.Muon.eta) < 2.4) & (abs(events.Muon.dxy) < 0.5) & (abs(events.Muon.dz) < 1)
+    # Choose events with 2 muons passing the base kinematic and impact parameter requirements
+    events = self[muon_id_bits](events, **kwargs)
+    muon_mask = has_muon_id(events.Muon.id_bits, "base")
     muon_sel = ak.sum(muon_mask, axis=1) >= 2
 
-
     # build and return selection results
     # "objects" maps source columns to new columns and selections to be applied on the old columns
     # to create them, e.g. {"Muon": {"MySelectedMuon": indices_applied_to_Muon}}
@@ -43,15 +180,17 @@ def muon_selection(
         },
     )
 
-def loose_muon_id_selection():
+
+def loose_muon_id_selection(muon: ak.Array) -> ak.Array:
     # If they pass:
         # base_muon_selector
         # identified as muon by PF -> isPFcand
         # AND reconstructed as Global muon or Tracker muon -> isGlobal or isTracker
             # (standalone muon tracks reconstructed only in the muon system are rejected)
-    pass
+    return has_muon_id(muon.id_bits, "base", "loose")
+
 
-def medium_muon_id_selection():
+def medium_muon_id_selection(muon: ak.Array) -> ak.Array:
     # Loose muon ID (Global or arbitrated tracker muon)
     # Fraction of valid hits: >80%
     # One of the following criteria:
@@ -62,9 +201,11 @@ def medium_muon_id_selection():
             # muon segment compatibility: > 0.303
         # 2. Good tracker muon:
             # muon segment compatibility > 0.451
-    pass
+    # (track quality criteria are not stored in NanoAOD and taken from the mediumId flag)
+    return has_muon_id(muon.id_bits, "base", "loose", "medium")
+
 
-def tight_muon_id_selection():
+def tight_muon_id_selection(muon: ak.Array) -> ak.Array:
     # Reconstructed as global muon
     # Muon identified as PF muon
     # Normalized χ2 of the global muon track fit must be below 10 to suppress hadronic punch-through and muons from decays in flight. May need retuning for newer segment-based fits: χ2/ndof < 10
@@ -74,4 +215,5 @@ def tight_muon_id_selection():
     # Longitudinal Impact Parameter |dz| < 0.5 mm
     # The track must contain at least one pixel hit to further reduce background from decays in flight.
     # A minimum of six tracker layers with hits is required, ensuring accurate pT measurement and additional suppression of decay-in-flight muons.
-    pass
+    # (track quality criteria are not stored in NanoAOD and taken from the tightId flag)
+    return has_muon_id(muon.id_bits, "base", "tight")
@@ -0,0 +1,208 @@
+# coding: utf-8
+
+"""
+Vectorized accumulation of selection stats, computing weighted sums for all groups and group
+combinations with a single ``np.bincount`` per weight over a combined integer group key.
+"""
+
+from __future__ import annotations
+
+from functools import reduce
+from operator import mul, getitem
+from collections import defaultdict
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.util import maybe_import
+from columnflow.types import Callable
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def _parse_weight(
+    weight_name: str,
+    obj,
+    n_events: int,
+) -> tuple[bool, np.ndarray | None, np.ndarray | None]:
+    """
+    Interprets an entry of a weight map, following the conventions of columnflow's
+    :py:func:`~columnflow.selection.stats.increment_stats`, and returns a tuple of a flag denoting
+    whether events are counted (names starting with ``"num"``) rather than weights summed (names
+    starting with ``"sum"``), the weights and an event mask, either of which can be *None* to denote
+    unit weights or no masking.
+    """
+    if weight_name.startswith("num"):
+        num = True
+    elif weight_name.startswith("sum"):
+        num = False
+    else:
+        raise ValueError(f"weight '{weight_name}' should either start with 'num' or 'sum'")
+
+    weights, mask = None, None
+    if isinstance(obj, tuple):
+        if num:
+            raise ValueError(f"weight map entry '{weight_name}' should refer to a mask, but found a sequence")
+        weights, mask = obj
+    elif obj is not Ellipsis:
+        arr = np.asarray(obj)
+        if num or arr.dtype == bool:
+            mask = arr
+        else:
+            weights = arr
+
+    if mask is Ellipsis:
+        mask = None
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+        if len(mask) != n_events:
+            raise ValueError(f"length of mask ({len(mask)}) does not match number of events ({n_events})")
+
+    return num, weights, mask
+
+
+def accumulate_stats(
+    stats: defaultdict,
+    weight_map: dict,
+    group_map: dict[str, dict] | None = None,
+    group_combinations: list[tuple[str, ...]] | None = None,
+    skip_func: Callable[[str, tuple[str, ...]], bool] | None = None,
+    n_events: int | None = None,
+) -> defaultdict:
+    """
+    Increments *stats* with the sums of all weights in *weight_map*, also per value of each group
+    in *group_map* and per value combination of the groups in *group_combinations*. The resulting
+    structure is the same as that of columnflow's :py:func:`~columnflow.selection.stats.increment_stats`,
+    i.e., ``stats["<weight>"]``, ``stats["<weight>_per_<group>"][<value>]`` and
+    ``stats["<weight>_per_<group1>_and_<group2>"][<value1>][<value2>]`` with group values converted
+    to strings. Entries whose names start with ``"num"`` are integer event counts, those starting
+    with ``"sum"`` are floating point sums of weights.
+
+    Instead of evaluating a mask per group value and weight, all groups are encoded into a single
+    integer key per event, so that each weight requires a single ``np.bincount`` whose result is
+    marginalized for each group and combination.
+
+    :param stats: The stats dictionary to update.
+    :param weight_map: Mapping of weight names to either *Ellipsis* (all events), a boolean event
+        mask, an array of weights, or a tuple of weights and a mask (or *Ellipsis*). The latter two
+        are only allowed for names starting with ``"sum"``.
+    :param group_map: Mapping of group names to dictionaries with per-event integer ``"values"``
+        and an optional ``"combinations_only"`` flag to only evaluate the group in combinations.
+        Other entries such as ``"mask_fn"`` are ignored.
+    :param group_combinations: Tuples of group names whose value combinations are accumulated.
+        Combinations involving groups that are not in *group_map* are skipped.
+    :param skip_func: Optional function receiving a weight name and a tuple of group names that
+        returns *True* when the corresponding entry should be skipped.
+    :param n_events: Number of events, inferred from the first group or weight when not set.
+    :return: The updated *stats*.
+    """
+    group_map = group_map or {}
+    group_combinations = [
+        tuple(combination)
+        for combination in (group_combinations or [])
+        if all(name in group_map for name in combination)
+    ]
+
+    # treat groups as combinations of a single group
+    group_combinations = [
+        (name,)
+        for name, group_data in group_map.items()
+        if not group_data.get("combinations_only", False) and (name,) not in group_combinations
+    ] + group_combinations
+
+    # encode groups into a combined key
+    group_names = list(group_map)
+    codes, uniques = [], []
+    for name in group_names:
+        u, inv = np.unique(np.asarray(group_map[name]["values"]), return_inverse=True)
+        uniques.append([str(v) for v in u.tolist()])
+        codes.append(inv.reshape(-1))
+    dims = tuple(len(u) for u in uniques)
+    size = reduce(mul, dims, 1)
+    key = np.ravel_multi_index(codes, dims) if group_names and size else None
+
+    if n_events is None:
+        if key is not None:
+            n_events = len(key)
+        else:
+            obj = next((o for o in weight_map.values() if o is not Ellipsis), None)
+            n_events = len(obj[0] if isinstance(obj, tuple) else obj) if obj is not None else 0
+
+    def marginalize(table: np.ndarray, names: tuple[str, ...]) -> np.ndarray:
+        axes = [group_names.index(name) for name in names]
+        other = tuple(i for i in range(len(group_names)) if i not in axes)
+        reduced = table.sum(axis=other) if other else table
+        # bring remaining axes into the order of names
+        return np.transpose(reduced, np.argsort(np.argsort(axes)))
+
+    for weight_name, obj in weight_map.items():
+        num, weights, mask = _parse_weight(weight_name, obj, n_events)
+        if mask is not None:
+            weights = weights[mask] if weights is not None else None
+        dtype = int if num else float
+
+        # total sum
+        if weights is not None:
+            stats[weight_name] += float(np.sum(weights))
+        else:
+            stats[weight_name] += dtype(n_events if mask is None else np.sum(mask))
+
+        combinations = [c for c in group_combinations if not (skip_func and skip_func(weight_name, c))]
+        if key is None or not combinations:
+            continue
+
+        # sums per combined group key
+        table = np.bincount(
+            key if mask is None else key[mask],
+            weights=weights,
+            minlength=size,
+        ).astype(np.int64 if num else np.float64).reshape(dims)
+
+        # per combination of groups, including all combinations of values
+        for combination in combinations:
+            comb_name = f"{weight_name}_per_{'_and_'.join(combination)}"
+            if comb_name not in stats:
+                stats[comb_name] = reduce(
+                    lambda factory, _: (lambda: defaultdict(factory)),
+                    combination[1:],
+                    lambda: defaultdict(dtype),
+                )()
+            sums = marginalize(table, combination)
+            comb_uniques = [uniques[group_names.index(name)] for name in combination]
+            for idx in np.ndindex(sums.shape):
+                values = [u[i] for u, i in zip(comb_uniques, idx)]
+                reduce(getitem, [stats[comb_name]] + values[:-1])[values[-1]] += sums[idx].item()
+
+    return stats
+
+
+@selector(
+    call_force=True,
+)
+def grouped_stats(
+    self: Selector,
+    events: ak.Array,
+    results: SelectionResult,
+    stats: defaultdict,
+    weight_map: dict | None = None,
+    group_map: dict[str, dict] | None = None,
+    group_combinations: list[tuple[str, ...]] | None = None,
+    skip_func: Callable[[str, tuple[str, ...]], bool] | None = None,
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Drop-in replacement for columnflow's :py:func:`~columnflow.selection.stats.increment_stats`
+    based on :py:func:`accumulate_stats`, whose cost per chunk does not grow with the number of
+    group values.
+    """
+    accumulate_stats(
+        stats,
+        weight_map or {},
+        group_map=group_map,
+        group_combinations=group_combinations,
+        skip_func=skip_func,
+        n_events=len(events),
+    )
+
+    return events, results
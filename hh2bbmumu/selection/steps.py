@@ -0,0 +1,160 @@
+# coding: utf-8
+
+"""
+Bit-packed storage of selection step masks, holding all steps of an event in a single unsigned
+integer from which combined selections and cutflows are derived with bitwise operations.
+"""
+
+from __future__ import annotations
+
+from columnflow.types import Sequence
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class PackedSteps(object):
+    """
+    Container of selection step masks packed into bits of a single ``uint32`` (up to 32 steps) or
+    ``uint64`` (up to 64 steps) array with one entry per event. The bit position of each step is its
+    index in *step_names*, which should therefore be persistent (e.g. taken from the config) so that
+    packed arrays written in different chunks and datasets are interpreted consistently. *bits* can
+    be passed to wrap an existing packed array, e.g. when reading it back from disk.
+
+    Bits of steps that were not added are set, i.e., missing steps are considered as passed.
+
+    .. code-block:: python
+
+        packed = PackedSteps(["json", "jet", "muon"], n_events=len(events))
+        packed.add("jet", jet_mask)
+        packed.add("muon", muon_mask)
+
+        event_sel = packed.mask()
+        jet_n_minus_one = packed.n_minus_one("jet")
+        counts = packed.cutflow(["muon", "jet"])
+    """
+
+    def __init__(
+        self,
+        step_names: Sequence[str],
+        n_events: int | None = None,
+        bits: np.ndarray | None = None,
+    ) -> None:
+        super().__init__()
+
+        self.step_names = list(step_names)
+        if len(self.step_names) > 64:
+            raise ValueError(f"at most 64 steps can be packed, got {len(self.step_names)}")
+        if len(set(self.step_names)) != len(self.step_names):
+            raise ValueError(f"step names are not unique: {self.step_names}")
+
+        self.dtype = np.dtype(np.uint32 if len(self.step_names) <= 32 else np.uint64)
+        if bits is not None:
+            self.bits = np.asarray(bits).astype(self.dtype, copy=False)
+        elif n_events is not None:
+            self.bits = np.full(n_events, self.all_bits, dtype=self.dtype)
+        else:
+            self.bits = None
+
+        # names of steps added so far, in the order of addition
+        self.added: list[str] = []
+
+    def __len__(self) -> int:
+        return 0 if self.bits is None else len(self.bits)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.added
+
+    @property
+    def all_bits(self) -> int:
+        return (1 << len(self.step_names)) - 1
+
+    def bit(self, name: str) -> int:
+        """
+        Returns the bit position of step *name*.
+        """
+        try:
+            return self.step_names.index(name)
+        except ValueError:
+            raise ValueError(f"unknown selection step '{name}', known are {self.step_names}") from None
+
+    def bitmask(self, names: Sequence[str]) -> np.unsignedinteger:
+        """
+        Returns the combined bitmask of all steps *names*.
+        """
+        mask = 0
+        for name in names:
+            mask |= 1 << self.bit(name)
+        return self.dtype.type(mask)
+
+    def add(self, name: str, mask: np.ndarray | ak.Array) -> None:
+        """
+        Adds the boolean *mask* of step *name*, replacing previously added masks of the same step.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if self.bits is None:
+            self.bits = np.full(len(mask), self.all_bits, dtype=self.dtype)
+
+        bit = self.dtype.type(self.bit(name))
+        self.bits &= ~(self.dtype.type(1) << bit)
+        self.bits |= mask.astype(self.dtype) << bit
+
+        if name not in self.added:
+            self.added.append(name)
+
+    def add_steps(self, steps: dict[str, np.ndarray | ak.Array]) -> None:
+        """
+        Moves all masks in *steps* into the packed array, removing them from the mapping so that
+        the boolean arrays can be freed.
+        """
+        for name in list(steps.keys()):
+            self.add(name, steps.pop(name))
+
+    def get(self, name: str) -> np.ndarray:
+        """
+        Returns the boolean mask of step *name*.
+        """
+        return (self.bits >> self.dtype.type(self.bit(name))) & self.dtype.type(1) == 1
+
+    def mask(self, names: Sequence[str] | None = None) -> np.ndarray:
+        """
+        Returns a mask of events passing all steps *names*, defaulting to all steps.
+        """
+        bitmask = self.bitmask(self.step_names if names is None else names)
+        return (self.bits & bitmask) == bitmask
+
+    def n_minus_one(self, name: str, names: Sequence[str] | None = None) -> np.ndarray:
+        """
+        Returns a mask of events passing all steps *names* (defaulting to all steps) except *name*.
+        """
+        names = self.step_names if names is None else names
+        return self.mask([n for n in names if n != name])
+
+    def cumulative(self, names: Sequence[str] | None = None) -> list[tuple[str, np.ndarray]]:
+        """
+        Returns a list of (name, mask) pairs with masks of events passing all steps up to and
+        including the step *name*, applied in the order of *names* (defaulting to all added steps).
+        """
+        names = self.added if names is None else names
+        return [(name, self.mask(names[:i + 1])) for i, name in enumerate(names)]
+
+    def cutflow(
+        self,
+        names: Sequence[str] | None = None,
+        weights: np.ndarray | None = None,
+    ) -> dict[str, float]:
+        """
+        Returns the (optionally weighted) numbers of events passing the steps *names* cumulatively
+        (see :py:meth:`cumulative`), starting with the total number of events as ``"initial"``.
+        """
+        counts = {"initial": float(len(self) if weights is None else np.sum(weights))}
+        for name, mask in self.cumulative(names):
+            counts[name] = float(np.sum(mask) if weights is None else np.sum(weights[mask]))
+        return counts
+
+    def unpack(self) -> dict[str, np.ndarray]:
+        """
+        Returns a mapping of all added step names to boolean masks.
+        """
+        return {name: self.get(name) for name in self.added}
@@ -0,0 +1,267 @@
+# coding: utf-8
+
+"""
+Shift-overlay storage of columnar outputs. Outputs of shifted task runs only store columns whose
+values differ from the nominal output of the same branch, plus a reference to the nominal file in
+the parquet metadata. Readers resolve overlays lazily, i.e., columns that are not stored in the
+overlay are read from the nominal file, so that disk usage and reading costs scale with the number
+of changed columns. Overlays also store the number of rows and a fingerprint of the nominal file
+they were created against, and reading them fails when the nominal file was replaced since.
+
+The storage mode is enabled via ``shift_overlay_storage`` in the ``[analysis]`` section of the law
+config for the task families listed in ``shift_overlay_tasks``, see
+:py:func:`~hh2bbmumu.columnflow_patches.patch_shift_overlay_storage`.
+"""
+
+from __future__ import annotations
+
+import os
+import json
+import struct
+import fnmatch
+import hashlib
+
+import law
+
+from columnflow.columnar_util import Route, get_ak_routes, remove_ak_column, set_ak_column
+from columnflow.types import Any, Sequence, Generator
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+pa = maybe_import("pyarrow")
+pq = maybe_import("pyarrow.parquet")
+
+
+logger = law.logger.get_logger(__name__)
+
+#: Keys in the parquet metadata of overlay files.
+BASE_KEY = b"hh2bbmumu_overlay_base"
+COLUMNS_KEY = b"hh2bbmumu_overlay_columns"
+BASE_ROWS_KEY = b"hh2bbmumu_overlay_base_rows"
+BASE_FINGERPRINT_KEY = b"hh2bbmumu_overlay_base_fingerprint"
+
+#: Name of the placeholder column stored in overlays without changed columns.
+PLACEHOLDER_COLUMN = "hh2bbmumu_overlay_placeholder"
+
+# cache of overlay information per (path, mtime)
+_overlay_info_cache: dict[tuple[str, int], tuple[str, list[str], int, str] | None] = {}
+
+# cache of parquet fingerprints per (path, mtime)
+_fingerprint_cache: dict[tuple[str, int], tuple[int, str]] = {}
+
+
+def get_parquet_fingerprint(path: str) -> tuple[int, str]:
+    """
+    Returns the number of rows and a fingerprint of the parquet file at *path*, made of its size and
+    a hash of its footer. The footer contains the schema and the offsets and statistics of all
+    column chunks, so it changes whenever the file is rewritten with different content.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns)
+    if key not in _fingerprint_cache:
+        with open(path, "rb") as f:
+            # the file ends with the footer, its length as 4 byte little-endian integer and b"PAR1"
+            f.seek(-8, os.SEEK_END)
+            footer_len = struct.unpack("<i", f.read(4))[0]
+            f.seek(-8 - footer_len, os.SEEK_END)
+            footer = f.read(footer_len)
+        fingerprint = f"{stat.st_size}:{hashlib.sha256(footer).hexdigest()}"
+        _fingerprint_cache[key] = (pq.ParquetFile(path).metadata.num_rows, fingerprint)
+    return _fingerprint_cache[key]
+
+
+def get_overlay_info(path: str) -> tuple[str, list[str], int, str] | None:
+    """
+    Returns the path of the base file, the list of stored columns, and the number of rows and
+    fingerprint of the base file at creation time of the overlay file at *path*, or *None* if it is
+    not an overlay.
+    """
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _overlay_info_cache:
+        metadata = pq.read_schema(path).metadata or {}
+        info = None
+        if BASE_KEY in metadata:
+            if BASE_ROWS_KEY not in metadata or BASE_FINGERPRINT_KEY not in metadata:
+                raise ValueError(f"overlay {path} lacks the row count and fingerprint of its base file")
+            # base paths are stored relative to the overlay
+            base_path = os.path.join(os.path.dirname(os.path.abspath(path)), metadata[BASE_KEY].decode("utf-8"))
+            info = (
+                os.path.normpath(base_path),
+                json.loads(metadata[COLUMNS_KEY].decode("utf-8")),
+                int(metadata[BASE_ROWS_KEY]),
+                metadata[BASE_FINGERPRINT_KEY].decode("utf-8"),
+            )
+        _overlay_info_cache[key] = info
+    return _overlay_info_cache[key]
+
+
+def check_overlay_base(path: str, base_path: str, n_rows: int, fingerprint: str) -> None:
+    """
+    Raises a *ValueError* if the base file at *base_path* of the overlay at *path* differs from the
+    one the overlay was created against, given by its number of rows *n_rows* and *fingerprint*.
+    """
+    if not os.path.isfile(base_path):
+        raise ValueError(f"base file {base_path} of overlay {path} does not exist")
+    base_rows, base_fingerprint = get_parquet_fingerprint(base_path)
+    if base_rows != n_rows:
+        raise ValueError(
+            f"base file {base_path} of overlay {path} has {base_rows} rows, but the overlay was "
+            f"created against {n_rows} rows",
+        )
+    if base_fingerprint != fingerprint:
+        raise ValueError(
+            f"base file {base_path} of overlay {path} changed since the overlay was created "
+            f"(fingerprint {base_fingerprint} != {fingerprint}), rerun the shifted task",
+        )
+
+
+def changed_columns(array: ak.Array, base: ak.Array) -> list[str]:
+    """
+    Returns the names of all leaf columns in *array* that do not exist in or differ from *base*.
+    """
+    base_routes = {route.column for route in get_ak_routes(base)}
+    changed = []
+    for route in get_ak_routes(array):
+        if route.column not in base_routes:
+            changed.append(route.column)
+            continue
+        a, b = route.apply(array), route.apply(base)
+        if a.type != b.type or not ak.array_equal(a, b, equal_nan=True, dtype_exact=True):
+            changed.append(route.column)
+    return changed
+
+
+def iter_row_group_chunks(path: str, sizes: Sequence[int]) -> Generator[ak.Array, None, None]:
+    """
+    Reads the parquet file at *path* row group by row group and yields consecutive chunks with the
+    number of rows in *sizes*, buffering at most the row groups that overlap the current chunk.
+    """
+    n_groups = pq.ParquetFile(path).metadata.num_row_groups
+    buffer: list[ak.Array] = []
+    n_buffered = 0
+    group = 0
+    for size in sizes:
+        while n_buffered < size and group < n_groups:
+            arr = ak.from_parquet(path, row_groups=[group])
+            buffer.append(arr)
+            n_buffered += len(arr)
+            group += 1
+        if n_buffered < size:
+            raise ValueError(f"{path} has less rows than requested")
+        arr = buffer[0] if len(buffer) == 1 else ak.concatenate(buffer)
+        yield arr[:size]
+        buffer = [arr[size:]] if len(arr) > size else []
+        n_buffered = len(arr) - size
+
+
+def write_overlay(path: str, base_path: str) -> list[str]:
+    """
+    Replaces the parquet file at *path* with an overlay of the file at *base_path*, storing only
+    columns that differ, with the same row groups as the base file. Returns the stored columns.
+    Both files are compared and written row group by row group, so that they are never fully held in
+    memory.
+    """
+    base_metadata = pq.ParquetFile(base_path).metadata
+    n_rows = pq.ParquetFile(path).metadata.num_rows
+    if n_rows != base_metadata.num_rows:
+        raise ValueError(
+            f"cannot create overlay of {path} with {n_rows} rows over {base_path} with {base_metadata.num_rows}",
+        )
+    sizes = [base_metadata.row_group(i).num_rows for i in range(base_metadata.num_row_groups)]
+
+    # first pass: collect columns that differ in any row group
+    columns: list[str] = []
+    for group, (chunk, base_chunk) in enumerate(zip(
+        iter_row_group_chunks(path, sizes),
+        iter_row_group_chunks(base_path, sizes),
+    )):
+        columns.extend(c for c in changed_columns(chunk, base_chunk) if c not in columns)
+        if group == 0:
+            # keep the column order of the file
+            routes = [route.column for route in get_ak_routes(chunk)]
+    if sizes:
+        columns.sort(key=routes.index)
+
+    base_rows, base_fingerprint = get_parquet_fingerprint(base_path)
+    metadata = {
+        BASE_KEY: os.path.relpath(os.path.abspath(base_path), os.path.dirname(os.path.abspath(path))).encode("utf-8"),
+        COLUMNS_KEY: json.dumps(columns).encode("utf-8"),
+        BASE_ROWS_KEY: str(base_rows).encode("utf-8"),
+        BASE_FINGERPRINT_KEY: base_fingerprint.encode("utf-8"),
+    }
+
+    def to_table(chunk: ak.Array) -> pa.Table:
+        if columns:
+            for route in get_ak_routes(chunk):
+                if route.column not in columns:
+                    chunk = remove_ak_column(chunk, route)
+        else:
+            chunk = ak.Array({PLACEHOLDER_COLUMN: np.zeros(len(chunk), dtype=np.uint8)})
+        return ak.to_arrow_table(chunk)
+
+    # second pass: write changed columns with the row group boundaries of the base file so that row
+    # groups can be read in sync
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writer = None
+    try:
+        chunks = iter_row_group_chunks(path, sizes) if sizes else [ak.from_parquet(path)]
+        for chunk in chunks:
+            table = to_table(chunk)
+            if writer is None:
+                schema = table.schema.with_metadata({**(table.schema.metadata or {}), **metadata})
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_table(table, row_group_size=max(len(table), 1))
+        writer.close()
+    except:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+    return columns
+
+
+def _matches(column: str, patterns: Sequence[str] | None) -> bool:
+    if patterns is None:
+        return True
+    return any(
+        column == pattern or column.startswith(f"{pattern}.") or fnmatch.fnmatch(column, pattern)
+        for pattern in patterns
+    )
+
+
+def read_parquet(
+    read_func: Any,
+    path: str,
+    *args,
+    columns: Sequence[str] | str | None = None,
+    **kwargs,
+) -> ak.Array:
+    """
+    Reads the parquet file at *path* with *read_func* (with the signature of ``ak.from_parquet``)
+    and, if it is an overlay, lazily resolves it over its base file(s): only the requested
+    *columns* that are stored in the overlay are read from it, all others from the base file.
+    Raises a *ValueError* if the base file differs from the one the overlay was created against.
+    """
+    info = get_overlay_info(path) if isinstance(path, (str, os.PathLike)) and os.path.isfile(path) else None
+    if info is None:
+        return read_func(path, *args, columns=columns, **kwargs)
+
+    base_path, stored, n_rows, fingerprint = info
+    check_overlay_base(path, base_path, n_rows, fingerprint)
+    patterns = [columns] if isinstance(columns, str) else (None if columns is None else list(columns))
+    overlay_columns = [column for column in stored if _matches(column, patterns)]
+
+    # read the base, recursively resolving overlays
+    result = read_parquet(read_func, base_path, *args, columns=columns, **kwargs)
+
+    # replace columns stored in the overlay
+    if overlay_columns:
+        overlay = read_func(path, *args, columns=overlay_columns, **kwargs)
+        for column in overlay_columns:
+            result = set_ak_column(result, column, Route(column).apply(overlay))
+
+    return result
@@ -3,3 +3,7 @@
 
 # provisioning imports
 import hh2bbmumu.tasks.base
+import hh2bbmumu.tasks.event_index
+import hh2bbmumu.tasks.external
+import hh2bbmumu.tasks.histograms
+import hh2bbmumu.tasks.parallel_selection
@@ -0,0 +1,213 @@
+# coding: utf-8
+
+"""
+Tasks and helpers to index reduced events by their fingerprint for fast event lookup, e.g. during
+synchronization with other groups.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks.reduction import ReducedEventsUser
+from columnflow.util import dev_sandbox, maybe_import
+
+from hh2bbmumu.tasks.base import HH2BBMUMUTask
+from hh2bbmumu.util import event_fingerprint, fingerprint_join, widen_fingerprint
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+#: Fields of the structured dtype of index entries, sorted by (hi, lo).
+EVENT_INDEX_FIELDS = [("hi", "<u8"), ("lo", "<u8"), ("file", "<u4"), ("chunk", "<u4"), ("row", "<u4")]
+
+
+class EventIndex(object):
+    """
+    Lookup helper for event indices created by :py:class:`BuildEventIndex`. The *index* is a sorted
+    structured array (usually memory-mapped) with fields :py:attr:`EVENT_INDEX_FIELDS` and *files*
+    is the list of parquet file paths that the ``file`` field refers to. Chunks correspond to
+    parquet row groups so that single events can be loaded by reading only a single row group.
+
+    .. code-block:: python
+
+        index = EventIndex.load("event_index.npy", ["/path/to/data_0.parquet", ...])
+        events = index.load_events(event_fingerprint(sync_events, wide=True))
+    """
+
+    # maximum number of queries for which binary searches are done per fingerprint instead of a
+    # full join with all index entries
+    max_binary_search_queries = 10_000
+
+    @classmethod
+    def load(cls, index_path: str, files: list[str]) -> EventIndex:
+        return cls(np.load(index_path, mmap_mode="r"), files)
+
+    def __init__(self, index: np.ndarray, files: list[str]) -> None:
+        super().__init__()
+
+        self.index = index
+        self.files = list(files)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def locate(self, fingerprints: np.ndarray) -> np.ndarray:
+        """
+        Returns the positions of *fingerprints* (in either encoding of
+        :py:func:`~hh2bbmumu.util.event_fingerprint`) in the index, or -1 for fingerprints that are
+        not contained.
+        """
+        fingerprints = np.asarray(fingerprints)
+        pos = np.full(len(fingerprints), -1, dtype=np.int64)
+
+        if len(fingerprints) > self.max_binary_search_queries:
+            # full join, reading the fingerprint fields of all index entries once
+            idx_query, idx_index = fingerprint_join(
+                fingerprints,
+                np.asarray(self.index[["hi", "lo"]]).astype(EVENT_INDEX_FIELDS[:2]),
+            )
+            pos[idx_query] = idx_index
+            return pos
+
+        # binary searches, first for the block of equal hi values, then for lo within that block
+        fingerprints = widen_fingerprint(fingerprints)
+        his, los = self.index["hi"], self.index["lo"]
+        starts = np.searchsorted(his, fingerprints["hi"], side="left")
+        stops = np.searchsorted(his, fingerprints["hi"], side="right")
+        for i, (start, stop, lo) in enumerate(zip(starts, stops, fingerprints["lo"])):
+            if start == stop:
+                continue
+            j = start + np.searchsorted(los[start:stop], lo)
+            if j < stop and los[j] == lo:
+                pos[i] = j
+
+        return pos
+
+    def find(self, run: int, lumi: int, event: int) -> np.void | None:
+        """
+        Returns the index entry of a single event identified by *run*, *lumi* and *event*, or *None*
+        when it is not contained.
+        """
+        fingerprint = event_fingerprint({"run": [run], "luminosityBlock": [lumi], "event": [event]}, wide=True)
+        pos = self.locate(fingerprint)[0]
+        return None if pos < 0 else self.index[pos]
+
+    def load_events(
+        self,
+        fingerprints: np.ndarray,
+        columns: list[str] | None = None,
+    ) -> tuple[ak.Array, np.ndarray]:
+        """
+        Loads all events referred to by *fingerprints* from the indexed files, reading only the row
+        groups that contain them. *columns* are forwarded to :py:func:`ak.from_parquet`.
+
+        :return: The loaded events in the order of *fingerprints*, and a boolean mask denoting which
+            fingerprints were found.
+        """
+        pos = self.locate(fingerprints)
+        found = pos >= 0
+        entries = np.asarray(self.index[pos[found]])
+
+        # read each (file, chunk) pair only once
+        chunks = []
+        order = []
+        keys = (entries["file"].astype(np.uint64) << np.uint64(32)) | entries["chunk"]
+        for key in np.unique(keys):
+            sel = np.flatnonzero(keys == key)
+            file_idx, chunk = int(key >> np.uint64(32)), int(key & np.uint64(0xFFFFFFFF))
+            arr = ak.from_parquet(self.files[file_idx], row_groups=[chunk], columns=columns)
+            chunks.append(arr[entries["row"][sel].astype(np.int64)])
+            order.append(sel)
+
+        if not chunks:
+            return ak.Array([]), found
+
+        # restore the query order
+        events = ak.concatenate(chunks, axis=0)[np.argsort(np.concatenate(order), kind="stable")]
+
+        return events, found
+
+
+class BuildEventIndex(
+    HH2BBMUMUTask,
+    ReducedEventsUser,
+):
+    """
+    Creates a sorted, memory-mappable index of (fingerprint -> file, chunk, row) for all merged
+    reduced events of a dataset.
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # upstream requirements
+    reqs = Requirements(
+        ReducedEventsUser.reqs,
+    )
+
+    def requires(self):
+        return self.reqs.ProvideReducedEvents.req(self)
+
+    def output(self):
+        return {
+            "index": self.target("event_index.npy"),
+            "files": self.target("event_index_files.json"),
+        }
+
+    def load_index(self) -> EventIndex:
+        """
+        Returns an :py:class:`EventIndex` for the output of this task, referring to the merged
+        reduced event files. Loading events through the index requires them to be stored on a local
+        file system.
+        """
+        outp = self.output()
+        inputs = [inp["events"] for inp in self.input()["collection"].targets.values()]
+        if [inp.path for inp in inputs] != outp["files"].load(formatter="json"):
+            raise Exception(f"input files of {self!r} changed since the index was created")
+        return EventIndex.load(outp["index"].abspath, [inp.abspath for inp in inputs])
+
+    @law.decorator.log
+    @law.decorator.localize(input=False)
+    @law.decorator.safe_output
+    def run(self):
+        outp = self.output()
+        inputs = [inp["events"] for inp in self.input()["collection"].targets.values()]
+
+        # read only the event identifying columns, row group by row group
+        parts = []
+        for file_idx, inp in enumerate(self.iter_progress(inputs, len(inputs), msg="indexing files ...")):
+            with inp.localize("r") as tmp:
+                n_row_groups = ak.metadata_from_parquet(tmp.abspath)["num_row_groups"]
+                for chunk in range(n_row_groups):
+                    arr = ak.from_parquet(
+                        tmp.abspath,
+                        row_groups=[chunk],
+                        columns=["run", "luminosityBlock", "event"],
+                    )
+                    fingerprints = event_fingerprint(arr, wide=True)
+                    part = np.empty(len(fingerprints), dtype=EVENT_INDEX_FIELDS)
+                    part["hi"] = fingerprints["hi"]
+                    part["lo"] = fingerprints["lo"]
+                    part["file"] = file_idx
+                    part["chunk"] = chunk
+                    part["row"] = np.arange(len(fingerprints))
+                    parts.append(part)
+
+        index = np.concatenate(parts) if parts else np.empty(0, dtype=EVENT_INDEX_FIELDS)
+        index = index[np.lexsort((index["lo"], index["hi"]))]
+
+        # warn about duplicate events
+        dups = (index["hi"][1:] == index["hi"][:-1]) & (index["lo"][1:] == index["lo"][:-1])
+        if dups.any():
+            logger.warning(f"found {dups.sum()} duplicate events in {self.dataset_inst.name}")
+
+        # save the index in numpy's format which can be memory-mapped when loading
+        np.save(outp["index"].abspath, index)
+        outp["files"].dump([inp.path for inp in inputs], formatter="json", indent=4)
+
+        self.publish_message(f"indexed {len(index)} events in {len(inputs)} files")
@@ -0,0 +1,82 @@
+# coding: utf-8
+
+"""
+Tasks related to the local store of external files.
+"""
+
+from __future__ import annotations
+
+import os
+
+import law
+
+from columnflow.tasks.framework.base import Requirements, ConfigTask
+from columnflow.tasks.external import BundleExternalFiles
+
+from hh2bbmumu.tasks.base import HH2BBMUMUTask
+from hh2bbmumu.external_store import ExternalStore, iter_external_files
+
+
+logger = law.logger.get_logger(__name__)
+
+
+class FillExternalStore(
+    HH2BBMUMUTask,
+    ConfigTask,
+):
+    """
+    Adds all external files of a config, as fetched by ``cf.BundleExternalFiles``, to the
+    content-addressed :py:class:`~hh2bbmumu.external_store.ExternalStore` at *store*, unpacking
+    tarballs once. Workers use the store when *HH2BBMUMU_EXTERNAL_STORE* points to it.
+
+    .. code-block:: bash
+
+        law run hh2bbmumu.FillExternalStore --config run3_2023_preBPix_nano_v12 --store /path/to/store
+    """
+
+    store = law.Parameter(
+        default=os.getenv("HH2BBMUMU_EXTERNAL_STORE", ""),
+        description="directory of the external file store; default: $HH2BBMUMU_EXTERNAL_STORE",
+    )
+
+    # upstream requirements
+    reqs = Requirements(
+        BundleExternalFiles=BundleExternalFiles,
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if not self.store:
+            raise ValueError(f"{self.task_family} requires a --store or $HH2BBMUMU_EXTERNAL_STORE to be set")
+
+    @property
+    def store_inst(self) -> ExternalStore:
+        return ExternalStore(os.path.expandvars(os.path.expanduser(self.store)))
+
+    def requires(self):
+        return self.reqs.BundleExternalFiles.req(self)
+
+    def output(self):
+        return {
+            name: law.LocalFileTarget(self.store_inst.ref_path(name, version))
+            for name, _, version in iter_external_files(self.config_inst.x.external_files)
+        }
+
+    def complete(self):
+        # references of files that were added from a different source must be replaced
+        return super().complete() and self.store_inst.has_all(self.config_inst.x.external_files)
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        store = self.store_inst
+        files = self.requires().files
+
+        external_files = list(iter_external_files(self.config_inst.x.external_files))
+        for name, source, version in self.iter_progress(external_files, len(external_files), msg="adding files ..."):
+            target = files
+            for key in name.split("."):
+                target = target[key]
+            ref = store.add(name, version, target.abspath, source=source)
+            self.publish_message(f"added {name} ({version}) as {ref['hash'][:12]}")
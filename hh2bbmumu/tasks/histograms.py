@@ -0,0 +1,523 @@
+# coding: utf-8
+
+"""
+Tasks creating histograms of many variables, categories and weight shifts in a single pass, and
+merging them incrementally across datasets and shifts.
+"""
+
+from __future__ import annotations
+
+import os
+import hashlib
+
+import law
+import luigi
+
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks.framework.mixins import (
+    CalibratorsMixin, SelectorMixin, ProducersMixin, MLModelsMixin, HistProducerMixin, VariablesMixin,
+    DatasetsProcessesMixin,
+)
+from columnflow.tasks.histograms import CreateHistograms
+from columnflow.util import dev_sandbox, maybe_import
+
+from hh2bbmumu.tasks.base import HH2BBMUMUTask
+from hh2bbmumu.histogramming.dense import DenseHistFiller
+from hh2bbmumu.histogramming.expressions import ExpressionEvaluator
+from hh2bbmumu.histogramming.sparse import (
+    SparseHist, Labels, LABELS_ATTR, save_sparse_hists, load_sparse_hists, load_sparse_attrs, load_sparse_labels,
+    merge_sparse_hists, add_sparse_hists, prune_sparse_hists, encode_labels, merge_labels,
+)
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+class CreateHistogramsSinglePass(
+    HH2BBMUMUTask,
+    CreateHistograms,
+):
+    """
+    Drop-in alternative to ``cf.CreateHistograms`` that fills all *variables* for all categories,
+    processes and weight-only shifts in a single pass over each chunk using a
+    :py:class:`~hh2bbmumu.histogramming.dense.DenseHistFiller`. Weight shifts are taken from the
+    ``shift_weights.<shift>`` columns produced by the hist producer (e.g. ``example_batched``), so
+    that the nominal run yields histograms with all of these shifts on the ``shift`` axis. Only
+    one-dimensional variables are supported.
+
+    With *sparse*, histograms are stored with integer ids of categories, processes and shifts, and
+    the translation of ids into names that the default post-processing of ``cf_default`` applies is
+    stored alongside as labels (see :py:mod:`hh2bbmumu.histogramming.sparse`). Other
+    post-processing hooks cannot be applied to sparse outputs.
+
+    .. code-block:: bash
+
+        law run hh2bbmumu.CreateHistogramsSinglePass --hist-producer example_batched \\
+            --variables jet1_pt,jet1_eta,jets_pt,n_jet
+    """
+
+    sparse = luigi.BoolParameter(
+        default=law.config.get_expanded_bool("analysis", "default_sparse_histograms", False),
+        significant=False,
+        description="when True, store only non-empty (category, process, shift) slices in a compressed npz "
+        "file instead of pickled hist objects; default: default_sparse_histograms in the law config",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        multi_dim = [var_key for var_key, var_names in self.variable_tuples.items() if len(var_names) > 1]
+        if multi_dim:
+            raise ValueError(f"{self.task_family} only supports one-dimensional variables, got {multi_dim}")
+
+    @property
+    def batched_shifts(self) -> list[str]:
+        """
+        Names of the shifts whose weights are produced as ``shift_weights.<shift>`` columns.
+        """
+        return sorted(
+            route.fields[1]
+            for route in self.hist_producer_inst.produced_columns
+            if len(route.fields) == 2 and route.fields[0] == "shift_weights"
+        )
+
+    @property
+    def has_custom_post_process_hist(self) -> bool:
+        """
+        Whether the hist producer defines a hook to post-process histograms other than the default
+        one of columnflow or ``cf_default``, whose translation of ids into names is stored as labels
+        in sparse outputs.
+        """
+        from columnflow.histogramming import HistProducer
+        from columnflow.histogramming.default import cf_default
+
+        func = getattr(self.hist_producer_inst.post_process_hist_func, "__func__", None)
+        return func not in (HistProducer.post_process_hist_func, cf_default.post_process_hist_func)
+
+    def get_sparse_labels(self, histograms: dict[str, SparseHist]) -> Labels:
+        """
+        Returns the names of all category, process and shift ids in the sparse *histograms*.
+        """
+        getters = {
+            "category": self.config_inst.get_category,
+            "process": self.config_inst.get_process,
+            "shift": self.config_inst.get_shift,
+        }
+        labels = {name: {} for name in getters}
+        for h in histograms.values():
+            for key in h.keys():
+                for (name, get), i in zip(getters.items(), key):
+                    if i not in labels[name]:
+                        labels[name][i] = get(i).name
+        return labels
+
+    def output(self):
+        ext = "npz" if self.sparse else "pickle"
+        return {"hists": self.target(f"histograms__vars_{self.variables_repr}__{self.branch}.{ext}")}
+
+    @law.decorator.log
+    @law.decorator.localize(input=True, output=False)
+    @law.decorator.safe_output
+    def run(self):
+        from columnflow.columnar_util import (
+            Route, update_ak_array, add_ak_aliases, attach_coffea_behavior, ak_concatenate_safe,
+        )
+
+        inputs = self.input()
+
+        if self.sparse and self.has_custom_post_process_hist:
+            raise Exception(
+                f"{self.task_family} cannot store sparse histograms of hist producer "
+                f"{self.hist_producer_inst.cls_name} with a custom post_process_hist hook",
+            )
+
+        # get IDs and names of all leaf categories
+        leaf_category_map = {
+            cat.id: cat.name
+            for cat in self.config_inst.get_leaf_categories()
+        }
+
+        # setup the hist producer
+        self._array_function_post_init()
+        hist_producer_reqs = self.hist_producer_inst.run_requires(task=self)
+        reader_targets = self.hist_producer_inst.run_setup(
+            task=self,
+            reqs=hist_producer_reqs,
+            inputs=luigi.task.getpaths(hist_producer_reqs),
+        ) or {}
+
+        # weight shifts filled in addition to the current shift, requiring a nominal run since
+        # shifted weight columns are read directly instead of through aliases
+        batched_shifts = self.batched_shifts
+        if batched_shifts and not self.global_shift_inst.is_nominal:
+            raise Exception(
+                f"{self.task_family} with batched weight shifts must run for the nominal shift, "
+                f"got {self.global_shift_inst.name}",
+            )
+        shift_ids = [self.global_shift_inst.id] + [self.config_inst.get_shift(s).id for s in batched_shifts]
+
+        # get shift dependent aliases
+        aliases = self.local_shift_inst.x("column_aliases", {})
+
+        # variables and columns to read
+        variable_insts = [
+            self.config_inst.get_variable(var_names[0])
+            for var_names in self.variable_tuples.values()
+        ]
+        read_columns = {Route("process_id")}
+        read_columns |= set(map(Route, self.category_id_columns))
+        read_columns |= set(self.hist_producer_inst.used_columns)
+        read_columns |= set(map(Route, aliases.values()))
+        for variable_inst in variable_insts:
+            if isinstance(variable_inst.expression, str):
+                read_columns.add(Route(variable_inst.expression))
+            read_columns |= set(map(Route, variable_inst.x("inputs", [])))
+
+        # bin values on the last edge as columnflow's histogram filling does
+        filler = DenseHistFiller(variable_insts, shift_ids, last_edge_inclusive=self.last_edge_inclusive)
+        evaluator = ExpressionEvaluator(variable_insts)
+        logger.debug(f"compiled {len(variable_insts)} variables into {evaluator.n_sub_expressions} sub-expressions")
+
+        # iterate over chunks of events and columns
+        file_targets = [inputs["events"]["events"]]
+        if self.producer_insts:
+            file_targets.extend([inp["columns"] for inp in inputs["producers"]])
+        if self.ml_model_insts:
+            file_targets.extend([inp["mlcolumns"] for inp in inputs["ml"]])
+
+        with law.localize_file_targets([*file_targets, *reader_targets.values()], mode="r") as inps:
+            for (events, *columns), pos in self.iter_chunked_io(
+                [inp.abspath for inp in inps],
+                source_type=len(file_targets) * ["awkward_parquet"] + [None] * len(reader_targets),
+                read_columns=(len(file_targets) + len(reader_targets)) * [read_columns],
+                chunk_size=self.hist_producer_inst.get_min_chunk_size(),
+            ):
+                # optional check for overlapping inputs
+                if self.check_overlapping_inputs:
+                    self.raise_if_overlapping([events] + list(columns))
+
+                events = update_ak_array(events, *columns)
+                events = add_ak_aliases(
+                    events,
+                    aliases,
+                    remove_src=True,
+                    missing_strategy=self.missing_column_alias_strategy,
+                )
+
+                # invoke the hist producer, potentially updating columns and creating the event weight
+                events = attach_coffea_behavior(events)
+                events, weight = self.hist_producer_inst(events, task=self)
+
+                if len(events) == 0:
+                    self.publish_message(f"no events found in chunk {pos}")
+                    continue
+
+                # merge category ids and check that they are defined as leaf categories
+                category_ids = ak_concatenate_safe(
+                    [Route(c).apply(events) for c in self.category_id_columns],
+                    axis=-1,
+                )
+                unique_category_ids = np.unique(ak.flatten(category_ids))
+                if any(cat_id not in leaf_category_map for cat_id in unique_category_ids):
+                    undefined_category_ids = list(map(str, set(unique_category_ids) - set(leaf_category_map)))
+                    raise ValueError(
+                        f"category_ids column contains ids {','.join(undefined_category_ids)} that are either not "
+                        "known to the config at all, or not as leaf categories (i.e., they have child categories); "
+                        "please ensure that category_ids only contains ids of known leaf categories",
+                    )
+
+                # stack the weights of all shifts
+                weights = np.empty((len(shift_ids), len(events)), dtype=np.float32)
+                weights[0] = np.asarray(weight)
+                for i, shift in enumerate(batched_shifts, 1):
+                    weights[i] = np.asarray(events.shift_weights[shift])
+
+                # evaluate all variables at once, sharing sub-expressions, and their selections
+                values = evaluator.evaluate(events)
+                masks = {}
+                for variable_inst in variable_insts:
+                    sel = variable_inst.selection
+                    if sel == "1":
+                        continue
+                    if not callable(sel):
+                        raise ValueError(
+                            f"invalid selection '{sel}', for now only callables are supported",
+                        )
+                    masks[variable_inst.name] = np.asarray(sel(events), dtype=bool)
+
+                filler.fill(values, category_ids, events.process_id, weights, masks=masks)
+
+                logger.debug(f"filled {len(variable_insts)} variables for {len(shift_ids)} shifts in chunk {pos.index}")
+
+        # teardown the hist producer
+        self.teardown_hist_producer_inst()
+
+        # store non-empty slices only, keyed by ids, and the names of the ids
+        if self.sparse:
+            histograms = filler.to_sparse_hists()
+            attrs = {LABELS_ATTR: encode_labels(self.get_sparse_labels(histograms))}
+            with self.output()["hists"].localize("w") as tmp:
+                save_sparse_hists(tmp.abspath, histograms, attrs=attrs)
+            return
+
+        # convert to hist objects and post-process them
+        histograms = filler.to_hists()
+        for name, h in histograms.items():
+            histograms[name] = self.hist_producer_inst.run_post_process_hist(h=h, task=self)
+
+            # check the format after post-processing if no merged preprocessing will take place
+            if self.hist_producer_inst.post_process_compatibility_check:
+                self.check_histogram_compatibility(histograms[name])
+
+        self.output()["hists"].dump(histograms, formatter="pickle")
+
+
+def file_hash(path: str) -> str:
+    """
+    Returns the sha256 hash of the content of the file at *path*.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class MergeHistogramsIncremental(
+    HH2BBMUMUTask,
+    VariablesMixin,
+    HistProducerMixin,
+    MLModelsMixin,
+    ProducersMixin,
+    SelectorMixin,
+    CalibratorsMixin,
+    DatasetsProcessesMixin,
+):
+    """
+    Merges the sparse histograms of :py:class:`CreateHistogramsSinglePass` over all *datasets* and
+    *shifts* into a running accumulator on local disk. The accumulator keeps one partial sum per
+    (dataset, shift) unit and a manifest with the content hashes of their inputs. On each run, only
+    units whose inputs changed are re-merged, and the difference to their previous partial sum is
+    added to the merged histograms. Units that are no longer requested are subtracted. The cost of a
+    run therefore scales with the number of changed units rather than with the full dataset list.
+
+    The output location does not depend on *datasets* so that the accumulator is shared when
+    datasets are added or removed. Slices that are not contained in any merged unit are dropped after
+    subtractions, but repeated additions and subtractions can accumulate floating point rounding in
+    the remaining ones, which *rebuild* removes by merging all units from scratch. The names of all
+    ids are merged from the labels of the inputs.
+
+    Weight shifts of hist producers with shift batching (e.g. ``example_batched``) are contained in
+    the nominal unit. Such hist producers only run for the nominal shift, so other *shifts* require a
+    hist producer without shift batching. Each requested shift must be known to the upstream tasks
+    of all datasets, as it would otherwise silently resolve to nominal.
+
+    .. code-block:: bash
+
+        law run hh2bbmumu.MergeHistogramsIncremental --hist-producer example_batched \
+            --datasets 'hh_ggf_*,tt_*' --variables jet1_pt,n_jet
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    shifts = law.CSVParameter(
+        default=("nominal",),
+        description="shifts to merge; weight shifts are included in the histograms of their source shift; "
+        "default: nominal",
+    )
+    rebuild = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="when True, merge all units from scratch instead of incrementally; default: False",
+    )
+
+    # upstream requirements
+    reqs = Requirements(
+        CreateHistogramsSinglePass=CreateHistogramsSinglePass,
+    )
+
+    @property
+    def units(self) -> list[tuple[str, str]]:
+        """
+        All (dataset, shift) units to merge.
+        """
+        return [(dataset, shift) for dataset in self.datasets for shift in self.shifts]
+
+    @staticmethod
+    def unit_key(dataset: str, shift: str) -> str:
+        return f"{dataset}__{shift}"
+
+    def store_parts(self):
+        parts = super().store_parts()
+        # share the accumulator across dataset selections
+        parts.pop("datasets", None)
+        return parts
+
+    def requires(self):
+        reqs = {}
+        for dataset, shift in self.units:
+            task = self.reqs.CreateHistogramsSinglePass.req(
+                self,
+                dataset=dataset,
+                shift=shift,
+                sparse=True,
+                _exclude={"branches"},
+            )
+            # unknown shifts resolve to nominal, which would merge the nominal output multiple times
+            if task.global_shift_inst.name != shift:
+                raise ValueError(
+                    f"shift {shift} of dataset {dataset} resolves to {task.global_shift_inst.name} in "
+                    f"{task.task_family}, as it is not declared by any upstream calibrator, producer or "
+                    "hist producer",
+                )
+            reqs[self.unit_key(dataset, shift)] = task
+        return reqs
+
+    def output(self):
+        return {
+            "hists": self.local_target(f"hists__vars_{self.variables_repr}.npz"),
+            "manifest": self.local_target(f"manifest__vars_{self.variables_repr}.json"),
+        }
+
+    @property
+    def partials_dir(self) -> str:
+        return os.path.join(os.path.dirname(self.output()["manifest"].abspath), f"partials__vars_{self.variables_repr}")
+
+    def partial_path(self, key: str, unit_hash: str) -> str:
+        return os.path.join(self.partials_dir, f"{key}__{unit_hash[:16]}.npz")
+
+    def load_manifest(self) -> dict:
+        """
+        Returns the manifest with the cached stats and hashes of input files and the hashes of all
+        merged units. The merged histograms store the unit hashes they reflect as well, which take
+        precedence during merging.
+        """
+        outp = self.output()["manifest"]
+        manifest = outp.load(formatter="json") if outp.exists() else {}
+        manifest.setdefault("files", {})
+        manifest.setdefault("units", {})
+        return manifest
+
+    def input_files(self, key: str) -> list[law.FileSystemFileTarget]:
+        collection = self.input()[key]["collection"]
+        return [inp["hists"] for inp in collection.targets.values()]
+
+    @staticmethod
+    def file_stat(target: law.FileSystemFileTarget) -> list:
+        stat = target.stat()
+        return [target.path, stat.st_size, int(stat.st_mtime)]
+
+    def complete(self):
+        if self.rebuild or not all(target.exists() for target in law.util.flatten(self.output())):
+            return False
+
+        # complete when the requested units and all input file stats match the manifest
+        manifest = self.load_manifest()
+        if set(manifest["units"]) != {self.unit_key(*unit) for unit in self.units}:
+            return False
+        reqs = self.requires()
+        for key in manifest["units"]:
+            if not reqs[key].complete():
+                return False
+            for target in self.input_files(key):
+                cached = manifest["files"].get(target.path)
+                if not cached or cached["stat"] != self.file_stat(target):
+                    return False
+
+        return True
+
+    def unit_hash(self, key: str, manifest: dict) -> str:
+        """
+        Returns the combined content hash of all inputs of the unit *key*, hashing only files whose
+        stat changed since the last run, and updates the file entries in the *manifest*.
+        """
+        hashes = []
+        for target in self.input_files(key):
+            stat = self.file_stat(target)
+            cached = manifest["files"].get(target.path)
+            if not cached or cached["stat"] != stat:
+                with target.localize("r") as tmp:
+                    cached = manifest["files"][target.path] = {"stat": stat, "hash": file_hash(tmp.abspath)}
+            hashes.append(cached["hash"])
+        return hashlib.sha256("".join(sorted(hashes)).encode("utf-8")).hexdigest()
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        outputs = self.output()
+        manifest = self.load_manifest()
+        os.makedirs(self.partials_dir, exist_ok=True)
+
+        # units reflected by the current merged histograms
+        merged_path = outputs["hists"].abspath
+        old_units = {}
+        if os.path.exists(merged_path) and not self.rebuild:
+            old_units = load_sparse_attrs(merged_path).get("units", {})
+
+        # determine changed and removed units
+        keys = [self.unit_key(*unit) for unit in self.units]
+        new_units = {}
+        for key in self.iter_progress(keys, len(keys), msg="hashing inputs ..."):
+            new_units[key] = self.unit_hash(key, manifest)
+
+        # previous partials are needed to subtract changed and removed units, so rebuild from
+        # scratch when any of them is missing
+        missing = [key for key, h in old_units.items() if not os.path.exists(self.partial_path(key, h))]
+        if missing:
+            logger.warning(f"partials of merged units {', '.join(missing)} missing, rebuilding from scratch")
+            old_units = {}
+
+        changed = [key for key in keys if old_units.get(key) != new_units[key]]
+        removed = [key for key in old_units if key not in new_units]
+        self.publish_message(f"{len(changed)} of {len(keys)} units changed, {len(removed)} removed")
+
+        # load the current merged histograms into memory
+        merged = merge_sparse_hists([merged_path]) if old_units else {}
+
+        # subtract removed units
+        for key in removed:
+            add_sparse_hists(merged, load_sparse_hists(self.partial_path(key, old_units[key])), -1.0)
+            logger.info(f"removed {key}")
+
+        # add the difference between new and previous partial sums of changed units, writing new
+        # partials next to the previous ones which are only removed once the merged output is saved
+        for key in self.iter_progress(changed, len(changed), msg="merging changed units ..."):
+            inputs = self.input_files(key)
+            with law.localize_file_targets(inputs, mode="r") as inps:
+                paths = [inp.abspath for inp in inps]
+                partial = merge_sparse_hists(paths)
+                labels = merge_labels(*map(load_sparse_labels, paths))
+
+            if key in old_units:
+                add_sparse_hists(merged, load_sparse_hists(self.partial_path(key, old_units[key])), -1.0)
+            add_sparse_hists(merged, partial, 1.0)
+
+            attrs = {LABELS_ATTR: encode_labels(labels)}
+            save_sparse_hists(self.partial_path(key, new_units[key]), partial, attrs=attrs)
+            logger.info(f"merged {key} from {len(inputs)} files")
+
+        # drop slices that are not contained in any merged unit, which are left with rounding
+        # residuals after subtractions, and collect the names of all ids
+        live_keys, labels = {}, {}
+        for key, unit_hash in new_units.items():
+            path = self.partial_path(key, unit_hash)
+            for name, h in load_sparse_hists(path).items():
+                live_keys.setdefault(name, set()).update(h.keys())
+            labels = merge_labels(labels, load_sparse_labels(path))
+        prune_sparse_hists(merged, live_keys)
+
+        # save the merged histograms together with the units they reflect
+        save_sparse_hists(merged_path, merged, attrs={"units": new_units, LABELS_ATTR: encode_labels(labels)})
+
+        # remove stale partials and forget files of removed units
+        current_partials = {os.path.basename(self.partial_path(key, h)) for key, h in new_units.items()}
+        for name in os.listdir(self.partials_dir):
+            if name not in current_partials:
+                os.remove(os.path.join(self.partials_dir, name))
+        current_files = {target.path for key in keys for target in self.input_files(key)}
+        manifest["files"] = {path: entry for path, entry in manifest["files"].items() if path in current_files}
+        manifest["units"] = new_units
+        outputs["manifest"].dump(manifest, formatter="json", indent=4)
@@ -0,0 +1,384 @@
+# coding: utf-8
+
+"""
+Local, chunk-parallel execution of selectors over the NanoAOD files of single branches of
+``cf.SelectEvents`` for quick turnarounds and throughput measurements on multi-core machines.
+"""
+
+from __future__ import annotations
+
+import os
+import time
+import multiprocessing
+from collections import defaultdict
+
+import law
+import luigi
+
+from columnflow.columnar_util import ChunkedIOHandler
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks.framework.mixins import CalibratorsMixin, SelectorMixin, ChunkedIOMixin
+from columnflow.tasks.external import GetDatasetLFNs
+from columnflow.tasks.calibration import CalibrateEvents
+from columnflow.tasks.selection import SelectEvents, default_create_selection_hists
+from columnflow.util import dev_sandbox, maybe_import, DotDict
+
+from hh2bbmumu.tasks.base import HH2BBMUMUTask
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+
+# state shared with forked worker processes, set right before the pool is created
+_worker_state: dict = {}
+
+
+def read_chunk(handler: ChunkedIOHandler, chunk_pos: ChunkedIOHandler.ChunkPosition) -> list[ak.Array]:
+    """
+    Reads the chunk at *chunk_pos* from all sources of the opened *handler* with their configured
+    read functions, options and columns, identical to what the handler does in its reading threads
+    when iterating through it.
+    """
+    return [
+        source_handler.read(
+            obj,
+            chunk_pos,
+            read_options=read_options,
+            read_columns=(sorted(read_columns) if read_columns else read_columns),
+        )
+        for obj, source_handler, read_options, read_columns in zip(
+            handler.source_objects,
+            handler.source_handlers,
+            handler.read_options_list,
+            handler.read_columns_list,
+        )
+    ]
+
+
+def merge_stats(target: dict, stats: dict) -> dict:
+    """
+    Recursively adds all values in *stats* to *target* and returns it.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(target.setdefault(key, defaultdict(float)), value)
+        else:
+            target[key] = target.get(key, 0.0) + value
+    return target
+
+
+def merge_hists(target: dict, hists: dict) -> dict:
+    """
+    Recursively adds all histograms in *hists* to *target* and returns it.
+    """
+    for key, value in hists.items():
+        if isinstance(value, dict):
+            merge_hists(target.setdefault(key, DotDict()), value)
+        else:
+            target[key] = target[key] + value if key in target else value
+    return target
+
+
+def _select_chunk(chunk_index: int) -> tuple[int, str, str, dict, dict, float]:
+    """
+    Runs the selector of the task stored in :py:attr:`_worker_state` over the chunk with index
+    *chunk_index*, following ``cf.SelectEvents``, and saves results and columns into parquet files.
+    Returns the chunk index, the paths of the results and columns files, the chunk stats and
+    histograms and the processing time in seconds.
+    """
+    from columnflow.columnar_util import update_ak_array, add_ak_aliases, sorted_ak_to_parquet
+
+    state = _worker_state
+    task = state["task"]
+    handler = state["handler"]
+    t0 = time.perf_counter()
+
+    # open sources once per process, i.e., after forking
+    handler.open()
+    chunk_pos = handler.create_chunk_position(handler.n_entries, handler.chunk_size, chunk_index)
+    events, *cols = read_chunk(handler, chunk_pos)
+
+    # optional check for overlapping inputs within additional columns
+    if task.check_overlapping_inputs:
+        task.raise_if_overlapping(list(cols))
+
+    # insert additional columns and aliases
+    events = update_ak_array(events, *cols)
+    events = add_ak_aliases(
+        events,
+        state["aliases"],
+        remove_src=True,
+        missing_strategy=task.missing_column_alias_strategy,
+    )
+
+    # invoke the selection function, starting from empty stats and histograms
+    stats = defaultdict(float)
+    hists = DotDict()
+    events, results = task.selector_inst(events, task=task, stats=stats, hists=hists)
+    if results.event is None:
+        raise Exception(
+            f"selector {task.selector_inst.cls_name} returned {results!r} object that does not contain 'event' mask",
+        )
+
+    results_array = results.to_ak()
+    if task.check_finite_output:
+        task.raise_if_not_finite(results_array)
+    results_path = os.path.join(state["tmp_dir"], f"res_{chunk_pos.index}.parquet")
+    sorted_ak_to_parquet(results_array, results_path)
+
+    events = state["route_filter"](events)
+    if task.check_finite_output:
+        task.raise_if_not_finite(events)
+    columns_path = os.path.join(state["tmp_dir"], f"cols_{chunk_pos.index}.parquet")
+    sorted_ak_to_parquet(events, columns_path)
+
+    return chunk_pos.index, results_path, columns_path, stats, hists, time.perf_counter() - t0
+
+
+class SelectEventsParallel(
+    HH2BBMUMUTask,
+    SelectorMixin,
+    CalibratorsMixin,
+    ChunkedIOMixin,
+):
+    """
+    Runs the selector over the NanoAOD file(s) of one branch of ``cf.SelectEvents`` in a local
+    process pool. Chunks are read with the sources, read options and columns that
+    ``cf.SelectEvents`` uses, via the coffea NanoAOD reading of
+    :py:class:`~columnflow.columnar_util.ChunkedIOHandler`, and processed in the same way, so that
+    results and columns are identical to those of ``cf.SelectEvents`` and stats agree up to the
+    order of floating point additions. Stats and histograms of chunks are merged in chunk order. In
+    addition, the throughput in events per second (in total and per worker) is measured.
+
+    .. code-block:: bash
+
+        law run hh2bbmumu.SelectEventsParallel --dataset hh_ggf_hbb_hmm_kl1_kt1_powheg --workers 64
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    branch_index = luigi.IntParameter(
+        default=0,
+        description="index of the branch of cf.SelectEvents whose NanoAOD file(s) to process; default: 0",
+    )
+    workers = luigi.IntParameter(
+        default=0,
+        significant=False,
+        description="number of worker processes; 0 uses all available cores, 1 runs serially; default: 0",
+    )
+    chunk_size = luigi.IntParameter(
+        default=0,
+        significant=False,
+        description="number of events per chunk; 0 uses the chunk size of cf.SelectEvents; default: 0",
+    )
+
+    missing_column_alias_strategy = "original"
+    create_selection_hists = default_create_selection_hists
+
+    # upstream requirements
+    reqs = Requirements(
+        GetDatasetLFNs=GetDatasetLFNs,
+        CalibrateEvents=CalibrateEvents,
+    )
+
+    @property
+    def n_workers(self) -> int:
+        if self.workers > 0:
+            return self.workers
+        return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+
+    @property
+    def resolved_chunk_size(self) -> int:
+        """
+        Chunk size, defaulting to the one that ``cf.SelectEvents`` uses.
+        """
+        if self.chunk_size > 0:
+            return self.chunk_size
+        return self.selector_inst.get_min_chunk_size() or law.config.get_expanded_int(
+            "analysis",
+            f"{SelectEvents.task_family}__chunked_io_chunk_size",
+            self.default_chunk_size,
+        )
+
+    def requires(self):
+        reqs = {
+            "lfns": self.reqs.GetDatasetLFNs.req(self),
+            "calibrations": [
+                self.reqs.CalibrateEvents.req(
+                    self,
+                    calibrator=calibrator_inst.cls_name,
+                    calibrator_inst=calibrator_inst,
+                    branch=self.branch_index,
+                )
+                for calibrator_inst in self.calibrator_insts
+                if calibrator_inst.produced_columns
+            ],
+        }
+
+        # add selector dependent requirements
+        reqs["selector"] = law.util.make_unique(law.util.flatten(self.selector_inst.run_requires(task=self)))
+
+        return reqs
+
+    def output(self):
+        outputs = {
+            "results": self.target(f"results_{self.branch_index}.parquet"),
+            "columns": self.target(f"columns_{self.branch_index}.parquet"),
+            "stats": self.target(f"stats_{self.branch_index}.json"),
+            "throughput": self.target(f"throughput_{self.branch_index}.json"),
+        }
+
+        # add histograms if requested
+        if self.create_selection_hists:
+            outputs["hists"] = self.target(f"hists_{self.branch_index}.pickle")
+
+        return outputs
+
+    @law.decorator.log
+    @law.decorator.localize(input=False)
+    @law.decorator.safe_output
+    def run(self):
+        from columnflow.columnar_util import Route, RouteFilter, mandatory_coffea_columns
+
+        lfn_task = self.requires()["lfns"]
+        inputs = self.input()
+        outputs = self.output()
+
+        # setup the selector
+        self._array_function_post_init()
+        selector_reqs = self.selector_inst.run_requires(task=self)
+        reader_targets = self.selector_inst.run_setup(
+            task=self,
+            reqs=selector_reqs,
+            inputs=luigi.task.getpaths(selector_reqs),
+        ) or {}
+        n_ext = len(reader_targets)
+
+        # create a temp dir for saving intermediate files
+        tmp_dir = law.LocalDirectoryTarget(is_tmp=True)
+        tmp_dir.touch()
+
+        # columns to read, including sources of shift aliases, and columns to write
+        aliases = self.local_shift_inst.x("column_aliases", {})
+        read_columns = set(map(Route, mandatory_coffea_columns))
+        read_columns |= self.selector_inst.used_columns
+        read_columns |= set(map(Route, aliases.values()))
+        write_columns = set(map(Route, mandatory_coffea_columns))
+        write_columns |= self.selector_inst.produced_columns
+        route_filter = RouteFilter(keep=write_columns)
+
+        # let the lfn task locate the nano file(s) of the branch
+        lfn_indices = self.create_branch_map()[self.branch_index]
+        nano_input = [nano_target for _, nano_target in lfn_task.iter_nano_files(self, lfn_indices=lfn_indices)]
+        if len(nano_input) == 1:
+            nano_input = nano_input[0]
+
+        with law.localize_file_targets(
+            [
+                nano_input,
+                *(inp["columns"] for inp in inputs["calibrations"]),
+                *reader_targets.values(),
+            ],
+            mode="r",
+        ) as inps:
+            # same handler setup as in cf.SelectEvents, opened once to count entries and again in
+            # each worker process to read chunks
+            n_calib = len(inputs["calibrations"])
+            handler = ChunkedIOHandler(
+                law.util.map_struct(law.target.file.get_path, inps),
+                source_type=["coffea_root"] + ["awkward_parquet"] * n_calib + [None] * n_ext,
+                read_columns=[read_columns] * (1 + n_calib + n_ext),
+                read_options=self.get_read_options(inps, first_is_nano=True),
+                chunk_size=self.resolved_chunk_size,
+            )
+            with handler:
+                n_events = handler.n_entries
+                chunk_indices = list(range(max(handler.n_chunks, 1)))
+
+            _worker_state.clear()
+            _worker_state.update(
+                task=self,
+                handler=handler,
+                aliases=aliases,
+                route_filter=route_filter,
+                tmp_dir=tmp_dir.abspath,
+            )
+
+            # process chunks, collecting outputs in chunk order
+            n_workers = min(self.n_workers, len(chunk_indices))
+            self.publish_message(
+                f"selecting {n_events} events in {len(chunk_indices)} chunks with {n_workers} workers",
+            )
+            outs = [None] * len(chunk_indices)
+            t0 = time.perf_counter()
+            try:
+                if n_workers == 1:
+                    self._collect_chunks(map(_select_chunk, chunk_indices), outs)
+                else:
+                    # fork so that workers inherit the set up selector without pickling it
+                    ctx = multiprocessing.get_context("fork")
+                    with ctx.Pool(n_workers) as pool:
+                        self._collect_chunks(pool.imap_unordered(_select_chunk, chunk_indices), outs)
+            finally:
+                handler.close()
+                _worker_state.clear()
+            wall_time = time.perf_counter() - t0
+
+        # teardown the selector
+        self.teardown_selector_inst()
+
+        # merge stats and histograms in chunk order
+        stats = defaultdict(float)
+        hists = DotDict()
+        for _, _, _, chunk_stats, chunk_hists, _ in outs:
+            merge_stats(stats, chunk_stats)
+            merge_hists(hists, chunk_hists)
+
+        # merge the result and column files
+        law.pyarrow.merge_parquet_task(
+            task=self,
+            inputs=[law.LocalFileTarget(out[1]) for out in outs],
+            output=outputs["results"],
+            local=True,
+            writer_opts=self.get_parquet_writer_opts(repeating_values=True),
+            target_row_group_size=self.merging_row_group_size,
+        )
+        law.pyarrow.merge_parquet_task(
+            task=self,
+            inputs=[law.LocalFileTarget(out[2]) for out in outs],
+            output=outputs["columns"],
+            local=True,
+            writer_opts=self.get_parquet_writer_opts(),
+            target_row_group_size=self.merging_row_group_size,
+        )
+
+        outputs["stats"].dump(stats, formatter="json")
+        if self.create_selection_hists:
+            outputs["hists"].dump(hists, formatter="pickle")
+
+        # throughput
+        chunk_times = [out[5] for out in outs]
+        throughput = {
+            "n_events": n_events,
+            "n_chunks": len(chunk_indices),
+            "n_workers": n_workers,
+            "wall_time": wall_time,
+            "cpu_time": sum(chunk_times),
+            "events_per_second": n_events / wall_time if wall_time else 0.0,
+            "events_per_second_per_worker": n_events / wall_time / n_workers if wall_time else 0.0,
+            "events_per_cpu_second": n_events / sum(chunk_times) if sum(chunk_times) else 0.0,
+            "worker_efficiency": sum(chunk_times) / (wall_time * n_workers) if wall_time else 0.0,
+        }
+        outputs["throughput"].dump(throughput, formatter="json", indent=4)
+        self.publish_message(
+            f"selected {n_events} events in {wall_time:.1f}s, "
+            f"{throughput['events_per_second']:.0f} events/s, "
+            f"{throughput['events_per_second_per_worker']:.0f} events/s per worker",
+        )
+
+    def _collect_chunks(self, it, outs: list) -> None:
+        for out in self.iter_progress(it, len(outs), msg="selecting chunks ..."):
+            outs[out[0]] = out
+            logger.debug(f"selected chunk {out[0]} in {out[5]:.2f}s")
@@ -9,6 +9,8 @@ from __future__ import annotations
 
 __all__ = []
 
+import importlib
+
 from columnflow.types import Any
 from columnflow.columnar_util import ArrayFunction, deferred_column
 from columnflow.util import maybe_import
@@ -16,6 +18,42 @@ from columnflow.util import maybe_import
 np = maybe_import("numpy")
 
 
+class DeferredModule(object):
+    """
+    Proxy for a module *name* that is only imported upon first attribute access, e.g. to avoid
+    loading heavy dependencies such as tensorflow when modules are merely imported to register
+    calibrators, selectors, producers or ml models.
+
+    .. code-block:: python
+
+        tf = DeferredModule("tensorflow")
+
+        def evaluate(...):
+            tf.constant(...)  # tensorflow is imported here
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__()
+
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "deferred"
+        return f"<{self.__class__.__name__} '{self._name}' ({state})>"
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr: str, value: Any) -> None:
+        setattr(self._load(), attr, value)
+
+
 @deferred_column
 def IF_NANO_V9(self: ArrayFunction.DeferredColumn, func: ArrayFunction) -> Any | set[Any]:
     return self.get() if func.config_inst.campaign.x.version == 9 else None
@@ -77,6 +115,11 @@ def hash_events(arr: np.ndarray) -> np.ndarray:
     """
     Helper function to create a hash value from the event, run and luminosityBlock columns.
     The values are padded to specific lengths and concatenated to a single integer.
+
+    .. note::
+
+        Event numbers in Run 3 regularly exceed the 8 digits reserved here. Use
+        :py:func:`event_fingerprint` for an overflow-safe, bit-packed alternative.
     """
     import awkward as ak
 
@@ -84,8 +127,9 @@ def hash_events(arr: np.ndarray) -> np.ndarray:
         """
         Helper function to check if a column does not exceed a maximum value.
         """
-        digits = len(str(arr[field].to_numpy().max()))
-        assert digits <= max_value, f"{field} digit count is {digits} and exceed max value {max_value}"
+        assert not np.any(np.asarray(arr[field]) >= 10**max_value), (
+            f"{field} digit count exceeds max value {max_value}"
+        )
 
     max_digits_run = 6
     max_digits_luminosityBlock = 6
@@ -103,3 +147,133 @@ def hash_events(arr: np.ndarray) -> np.ndarray:
         ak.values_astype(arr.luminosityBlock, np.int64) * 10**max_digits_event +
         ak.values_astype(arr.event, np.int64)
     )
+
+
+#: Number of bits reserved for the run number in packed event fingerprints.
+FINGERPRINT_RUN_BITS = 20
+
+#: Number of bits reserved for the luminosity block in packed event fingerprints.
+FINGERPRINT_LUMI_BITS = 18
+
+#: Fields of the structured dtype of wide (128 bit) event fingerprints.
+FINGERPRINT_WIDE_FIELDS = [("hi", "<u8"), ("lo", "<u8")]
+
+
+def event_fingerprint(
+    arr: np.ndarray,
+    wide: bool | None = None,
+    run_bits: int = FINGERPRINT_RUN_BITS,
+    lumi_bits: int = FINGERPRINT_LUMI_BITS,
+) -> np.ndarray:
+    """
+    Creates a collision-free fingerprint per event from the run, luminosityBlock and event columns
+    of *arr* by bit-packing them with pure numpy shifts.
+
+    In the narrow (64 bit) encoding, the run occupies the upper *run_bits*, the luminosity block the
+    next *lumi_bits* and the event number the remaining bits of a single ``uint64``. When event
+    numbers do not fit into the remaining bits, the wide (128 bit) encoding is used, which is a
+    structured array with fields ``hi`` (run and luminosity block packed as above) and ``lo`` (the
+    full event number). *wide* enforces either encoding, while *None* chooses the narrow one
+    whenever possible. Note that the automatic choice can differ between chunks, so *wide* should
+    be set explicitly when fingerprints are persisted.
+
+    :param arr: Array with ``run``, ``luminosityBlock`` and ``event`` fields.
+    :param wide: Whether to use the wide encoding, or *None* to decide automatically.
+    :param run_bits: Number of bits reserved for the run number.
+    :param lumi_bits: Number of bits reserved for the luminosity block.
+    :raises ValueError: If run or luminosity block numbers exceed their reserved number of bits.
+    :return: The ``uint64`` or structured array of fingerprints.
+    """
+    run = np.asarray(arr["run"]).astype(np.uint64, copy=False)
+    lumi = np.asarray(arr["luminosityBlock"]).astype(np.uint64, copy=False)
+    event = np.asarray(arr["event"]).astype(np.uint64, copy=False)
+
+    # check bounds
+    if np.any(run >> np.uint64(run_bits)):
+        raise ValueError(f"run numbers exceed the reserved {run_bits} bits")
+    if np.any(lumi >> np.uint64(lumi_bits)):
+        raise ValueError(f"luminosity block numbers exceed the reserved {lumi_bits} bits")
+
+    hi = (run << np.uint64(lumi_bits)) | lumi
+
+    event_bits = 64 - run_bits - lumi_bits
+    if wide is None:
+        wide = bool(np.any(event >> np.uint64(event_bits)))
+    elif not wide and np.any(event >> np.uint64(event_bits)):
+        raise ValueError(f"event numbers exceed the {event_bits} bits available in the narrow encoding")
+
+    if not wide:
+        return (hi << np.uint64(event_bits)) | event
+
+    fingerprints = np.empty(len(event), dtype=FINGERPRINT_WIDE_FIELDS)
+    fingerprints["hi"] = hi
+    fingerprints["lo"] = event
+    return fingerprints
+
+
+def widen_fingerprint(
+    fingerprints: np.ndarray,
+    run_bits: int = FINGERPRINT_RUN_BITS,
+    lumi_bits: int = FINGERPRINT_LUMI_BITS,
+) -> np.ndarray:
+    """
+    Converts narrow *fingerprints* created with :py:func:`event_fingerprint` into the wide encoding.
+    Wide fingerprints are returned unchanged.
+    """
+    if fingerprints.dtype.names:
+        return fingerprints
+
+    event_bits = np.uint64(64 - run_bits - lumi_bits)
+    wide = np.empty(len(fingerprints), dtype=FINGERPRINT_WIDE_FIELDS)
+    wide["hi"] = fingerprints >> event_bits
+    wide["lo"] = fingerprints & ((np.uint64(1) << event_bits) - np.uint64(1))
+    return wide
+
+
+def _fingerprint_join_keys(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns ``uint64`` keys for two fingerprint arrays *a* and *b* that are equal if and only if
+    the fingerprints are equal. Wide fingerprints are dense-ranked per field over both arrays, as
+    sorting and searching structured arrays in numpy is an order of magnitude slower.
+    """
+    if not a.dtype.names and not b.dtype.names:
+        return a, b
+
+    a, b = widen_fingerprint(a), widen_fingerprint(b)
+    keys = np.zeros(len(a) + len(b), dtype=np.uint64)
+    for field, shift in [("hi", 32), ("lo", 0)]:
+        _, rank = np.unique(np.concatenate([a[field], b[field]]), return_inverse=True)
+        keys |= rank.astype(np.uint64).reshape(-1) << np.uint64(shift)
+    return keys[:len(a)], keys[len(a):]
+
+
+def fingerprint_join(a: np.ndarray, b: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Batch inner join of two fingerprint arrays *a* and *b*, as returned by
+    :py:func:`event_fingerprint` in either encoding. For duplicate fingerprints in *b*, the first
+    occurrence is matched.
+
+    :return: Two index arrays, pointing into *a* and *b*, respectively, of all matching pairs.
+    """
+    if not len(a) or not len(b):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    key_a, key_b = _fingerprint_join_keys(a, b)
+
+    # binary search of all keys of a in the sorted keys of b
+    order = np.argsort(key_b, kind="stable")
+    sorted_b = key_b[order]
+    pos = np.minimum(np.searchsorted(sorted_b, key_a), len(sorted_b) - 1)
+    idx_a = np.flatnonzero(sorted_b[pos] == key_a)
+
+    return idx_a, order[pos[idx_a]]
+
+
+def fingerprint_isin(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Returns a boolean mask with the length of *a* denoting whether fingerprints in *a* are contained
+    in *b*. Fingerprints can be given in either encoding of :py:func:`event_fingerprint`.
+    """
+    mask = np.zeros(len(a), dtype=bool)
+    mask[fingerprint_join(a, b)[0]] = True
+    return mask
@@ -7,7 +7,8 @@ Example event weight producer.
 from columnflow.weight import WeightProducer, weight_producer
 from columnflow.util import maybe_import
 from columnflow.config_util import get_shifts_from_sources
-from columnflow.columnar_util import Route
+
+from hh2bbmumu.weight.products import WeightProducts
 
 ak = maybe_import("awkward")
 np = maybe_import("numpy")
@@ -20,9 +21,7 @@ np = maybe_import("numpy")
 )
 def example(self: WeightProducer, events: ak.Array, **kwargs) -> ak.Array:
     # build the full event weight
-    weight = ak.Array(np.ones(len(events), dtype=np.float32))
-    for column in self.weight_columns:
-        weight = weight * Route(column).apply(events)
+    weight = ak.Array(self.weight_products.products(events)[0])
 
     return events, weight
 
@@ -35,6 +34,7 @@ def example_init(self: WeightProducer) -> None:
         "muon_weight",
     }
     self.uses |= self.weight_columns
+    self.weight_products = WeightProducts(self.weight_columns)
 
     # declare shifts that the produced event weight depends on
     shift_sources = {
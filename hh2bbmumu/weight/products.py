@@ -0,0 +1,98 @@
+# coding: utf-8
+
+"""
+Vectorized products of event weight columns for the nominal weight and all weight shifts at once.
+"""
+
+from __future__ import annotations
+
+import order as od
+
+from columnflow.columnar_util import Route
+from columnflow.types import Sequence
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def get_shift_aliases(config_inst: od.Config, shifts: Sequence[str]) -> dict[str, dict[str, str]]:
+    """
+    Returns a mapping of the names of *shifts* to their column aliases in *config_inst*.
+    """
+    return {
+        shift: dict(config_inst.get_shift(shift).x("column_aliases", {}))
+        for shift in sorted(shifts)
+    }
+
+
+class WeightProducts(object):
+    """
+    Computes the product of *weight_columns* for the nominal weight and for all shifts in
+    *shift_aliases* (mapping shift names to column aliases as returned by
+    :py:func:`get_shift_aliases`). All distinct weight columns are read once into a contiguous
+    float32 matrix with one row per column, and the products of all shifts are obtained with one
+    vectorized multiplication per weight column.
+
+    .. code-block:: python
+
+        products = WeightProducts(["normalization_weight", "muon_weight"], {
+            "mu_up": {"muon_weight": "muon_weight_up"},
+            "mu_down": {"muon_weight": "muon_weight_down"},
+        })
+        weights = products.weights(events)  # {"nominal": ..., "mu_up": ..., "mu_down": ...}
+    """
+
+    def __init__(
+        self,
+        weight_columns: Sequence[str],
+        shift_aliases: dict[str, dict[str, str]] | None = None,
+    ) -> None:
+        super().__init__()
+
+        self.weight_columns = sorted(weight_columns)
+        shift_aliases = shift_aliases or {}
+        self.shifts = ["nominal"] + [shift for shift in shift_aliases if shift != "nominal"]
+
+        # distinct columns and, per shift, the indices of the columns to multiply
+        self.columns = list(self.weight_columns)
+        index = []
+        for shift in self.shifts:
+            aliases = shift_aliases.get(shift, {})
+            row = []
+            for column in self.weight_columns:
+                column = aliases.get(column, column)
+                if column not in self.columns:
+                    self.columns.append(column)
+                row.append(self.columns.index(column))
+            index.append(row)
+        self.index = np.array(index, dtype=np.intp).reshape(len(self.shifts), len(self.weight_columns))
+
+    def matrix(self, events: ak.Array) -> np.ndarray:
+        """
+        Returns a float32 matrix with shape (n_columns, n_events) of all distinct weight columns.
+        """
+        matrix = np.empty((len(self.columns), len(events)), dtype=np.float32)
+        for i, column in enumerate(self.columns):
+            matrix[i] = np.asarray(Route(column).apply(events))
+        return matrix
+
+    def products(self, events: ak.Array) -> np.ndarray:
+        """
+        Returns a float32 matrix with shape (n_shifts, n_events) with the weight of each shift, in
+        the order of :py:attr:`shifts`.
+        """
+        if not self.weight_columns:
+            return np.ones((len(self.shifts), len(events)), dtype=np.float32)
+
+        matrix = self.matrix(events)
+        products = matrix[self.index[:, 0]]
+        for j in range(1, len(self.weight_columns)):
+            products *= matrix[self.index[:, j]]
+        return products
+
+    def weights(self, events: ak.Array) -> dict[str, np.ndarray]:
+        """
+        Returns a mapping of shift names (including ``"nominal"``) to weights.
+        """
+        return dict(zip(self.shifts, self.products(events)))
@@ -18,7 +18,16 @@ setup_hh2bbmumu() {
     #
     #
     # Optinally preconfigured environment variables:
-    #   None yet.
+    #   HH2BBMUMU_LAZY_CONFIG
+    #       When true, datasets of analysis configs are only created when first accessed, which
+    #       speeds up the startup of tasks that only require a small subset of them.
+    #   HH2BBMUMU_CONFIG_SNAPSHOT_DIR
+    #       Directory in which pickled snapshots of analysis configs are cached. Snapshots are
+    #       disabled when not set.
+    #   HH2BBMUMU_EXTERNAL_STORE
+    #       Directory of a content-addressed store of external files, filled with the
+    #       hh2bbmumu.FillExternalStore task. When set and complete, external files are read from the
+    #       store instead of being fetched and unpacked per job, also allowing to run offline.
     #
     #
     # Variables defined by the setup and potentially required throughout the analysis:
@@ -15,4 +15,14 @@ sys.path.append(base)
 import hh2bbmumu  # noqa
 
 # import all tests
-# ...
+from .test_util import *
+from .test_dense import *
+from .test_sparse import *
+from .test_histogram_tasks import *
+from .test_parallel_selection import *
+from .test_shift_overlay import *
+from .test_stats import *
+from .test_profiling import *
+from .test_chunking import *
+from .test_kinematics import *
+from .test_expressions import *
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+
+__all__ = ["AdaptiveChunkedIOHandlerTest"]
+
+import os
+import time
+import tempfile
+import unittest
+
+from columnflow.util import maybe_import
+
+from hh2bbmumu.chunking import AdaptiveChunkedIOHandler, compute_chunk_size, get_rss
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class AdaptiveChunkedIOHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        self.n = 12345
+        counts = rng.integers(0, 4, self.n)
+        self.events = ak.Array({
+            "event": np.arange(self.n, dtype=np.uint64),
+            "Jet": ak.zip({"pt": ak.unflatten(rng.uniform(20, 100, counts.sum()), counts)}),
+        })
+        self.columns = ak.Array({"weight": rng.uniform(size=self.n)})
+        self.paths = []
+        for name, arr in [("events", self.events), ("columns", self.columns)]:
+            self.paths.append(os.path.join(self.tmp_dir, f"{name}.parquet"))
+            ak.to_parquet(arr, self.paths[-1], row_group_size=700)
+
+    def iterate(self, process=None, **kwargs) -> tuple[AdaptiveChunkedIOHandler, list]:
+        handler = AdaptiveChunkedIOHandler(
+            self.paths,
+            source_type=["awkward_parquet", "awkward_parquet"],
+            chunk_size=2000,
+            pool_size=2,
+            **kwargs,
+        )
+        chunks = []
+        with handler:
+            for (events, columns), pos in handler:
+                chunks.append((events, columns, pos))
+                if process:
+                    process(pos)
+        # chunks read in parallel might be yielded out of order
+        return handler, sorted(chunks, key=lambda chunk: chunk[2].entry_start)
+
+    def test_coverage(self):
+        # budget below the baseline, so that the minimum chunk size is used
+        handler, chunks = self.iterate(sample_size=1500, budget=0.0)
+        self.assertEqual(handler.chunk_size, 1000)
+
+        positions = [pos for _, _, pos in chunks]
+        self.assertEqual([pos.index for pos in positions], list(range(len(positions))))
+        # the number of chunks is estimated with the initial chunk size until the sample is processed
+        self.assertEqual(positions[0].n_chunks, 7)
+        self.assertTrue(all(pos.n_chunks == len(positions) for pos in positions[1:]))
+        self.assertEqual(
+            [(pos.entry_start, pos.entry_stop) for pos in positions[:3]],
+            [(0, 1500), (1500, 2000), (2000, 3000)],
+        )
+        self.assertEqual(positions[-1].entry_stop, self.n)
+
+        # all events are read exactly once and in order
+        self.assertTrue(ak.array_equal(ak.concatenate([e for e, _, _ in chunks]), self.events))
+        self.assertTrue(ak.array_equal(ak.concatenate([c for _, c, _ in chunks]), self.columns))
+
+    def test_small_input(self):
+        handler, chunks = self.iterate(sample_size=self.n, budget=0.0)
+        self.assertEqual(handler.chunk_size, 2000)
+        self.assertEqual(len(chunks), 7)
+        self.assertTrue(ak.array_equal(ak.concatenate([e for e, _, _ in chunks]), self.events))
+
+    def test_peak_memory(self):
+        def process(pos):
+            # allocate memory while processing the sample only
+            if pos.index == 0:
+                buf = np.ones(400 * 1024**2, dtype=np.uint8)
+                time.sleep(0.1)
+                self.assertEqual(buf.sum(), buf.size)
+
+        budget = get_rss() + 1000 * 1024**2
+        handler, chunks = self.iterate(sample_size=2000, budget=budget)
+        self.assertEqual(handler.chunk_size, 1000000)
+        self.assertEqual(len(chunks), 2)
+
+        # the peak while processing the sample determines the chunk size
+        handler, chunks = self.iterate(process=process, sample_size=2000, budget=budget)
+        self.assertLess(handler.chunk_size, 10000)
+        self.assertTrue(ak.array_equal(ak.concatenate([e for e, _, _ in chunks]), self.events))
+
+    def test_compute_chunk_size(self):
+        mb = 1024**2
+        self.assertEqual(compute_chunk_size(1000.0, 100 * mb, baseline=50 * mb), 52000)
+        self.assertEqual(compute_chunk_size(1000.0, 100 * mb, read_bytes_per_event=500.0, pool_size=2), 52000)
+        self.assertEqual(compute_chunk_size(1000.0, 10 * mb, baseline=20 * mb), 1000)
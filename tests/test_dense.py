@@ -0,0 +1,166 @@
+# coding: utf-8
+
+
+__all__ = ["BinIndexerTest", "DenseHistFillerTest"]
+
+import unittest
+
+import order as od
+
+from columnflow.hist_util import create_hist_from_variables, fill_hist
+from columnflow.util import maybe_import
+
+from hh2bbmumu.histogramming.dense import BinIndexer, DenseHistFiller
+from hh2bbmumu.histogramming.sparse import create_variable_axis
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+hist = maybe_import("hist")
+
+
+def make_variables() -> list[od.Variable]:
+    return [
+        od.Variable("x", expression="x", binning=(10, 0.0, 1.0)),
+        od.Variable("y", expression="y", binning=[0.0, 0.2, 0.5, 1.0]),
+        od.Variable("r", expression="r", binning=(4, 0.0, 2.0), aux={"axis_type": "regular"}),
+        od.Variable("n", expression="n", binning=(5, 0.0, 5.0), discrete_x=True),
+        od.Variable("jet_pt", expression="jet_pt", binning=(5, 0.0, 100.0)),
+    ]
+
+
+class BinIndexerTest(unittest.TestCase):
+
+    def assert_matches_hist(self, indexer: BinIndexer, values: np.ndarray) -> None:
+        h = hist.Hist(create_variable_axis({"name": "v", **indexer.axis}))
+        h.fill(v=values.astype(np.int64) if indexer.axis_type == "integer" else values)
+        counts = np.bincount(indexer(values), minlength=indexer.n_flow_bins)
+        np.testing.assert_array_equal(counts, h.view(flow=True))
+
+    def test_axis_types(self):
+        v = od.Variable("v", binning=(10, 0.0, 1.0))
+        self.assertEqual(BinIndexer.from_variable(v).axis_type, "variable")
+        v = od.Variable("v", binning=(10, 0.0, 1.0), discrete_x=True)
+        self.assertEqual(BinIndexer.from_variable(v).axis_type, "integer")
+        v = od.Variable("v", binning=(10, 0.0, 1.0), aux={"axis_type": "reg"})
+        self.assertEqual(BinIndexer.from_variable(v).axis_type, "regular")
+        v = od.Variable("v", binning=(10, 0.0, 1.0), aux={"axis_type": "strcat"})
+        with self.assertRaises(ValueError):
+            BinIndexer.from_variable(v)
+
+    def test_matches_hist(self):
+        rng = np.random.default_rng(1)
+        edges = np.linspace(-1.3, 2.9, 43)
+        values = np.concatenate([
+            rng.uniform(-2, 4, 10000),
+            edges,
+            np.nextafter(edges, np.inf),
+            np.nextafter(edges, -np.inf),
+            [np.nan, np.inf, -np.inf],
+        ])
+        self.assert_matches_hist(BinIndexer(edges=edges), values)
+        self.assert_matches_hist(BinIndexer(edges=[-1.3, 0.0, 0.1, 2.9]), values)
+        self.assert_matches_hist(BinIndexer(n_bins=42, x_min=-1.3, x_max=2.9, axis_type="regular"), values)
+
+        ints = rng.integers(-3, 9, 1000).astype(np.float64)
+        self.assert_matches_hist(BinIndexer(n_bins=3, x_min=0, x_max=6, axis_type="integer"), ints)
+
+    def test_last_edge(self):
+        values = np.array([0.0, 1.0, 5.0])
+
+        # only variable axes include the last edge
+        indexer = BinIndexer(n_bins=5, x_min=0.0, x_max=5.0, last_edge_inclusive=True)
+        np.testing.assert_array_equal(indexer(values), [1, 2, 5])
+        indexer = BinIndexer(n_bins=5, x_min=0.0, x_max=5.0, axis_type="integer", last_edge_inclusive=True)
+        np.testing.assert_array_equal(indexer(values), [1, 2, 6])
+        indexer = BinIndexer(n_bins=5, x_min=0.0, x_max=5.0, axis_type="regular", last_edge_inclusive=True)
+        np.testing.assert_array_equal(indexer(values), [1, 2, 6])
+
+        # enabled by default for variable axes, unless circular
+        self.assertTrue(BinIndexer.from_variable(od.Variable("v", binning=(5, 0.0, 5.0))).last_edge_inclusive)
+        self.assertFalse(BinIndexer.from_variable(od.Variable("v", binning=(5, 0.0, 5.0)), False).last_edge_inclusive)
+        v = od.Variable("v", binning=(5, 0.0, 5.0), aux={"axis_kwargs": {"circular": True}})
+        self.assertFalse(BinIndexer.from_variable(v).last_edge_inclusive)
+
+
+class DenseHistFillerTest(unittest.TestCase):
+
+    def fill(self, last_edge_inclusive: bool | None) -> tuple[DenseHistFiller, dict[str, hist.Hist]]:
+        variable_insts = make_variables()
+        rng = np.random.default_rng(2)
+        n = 1000
+        counts = rng.integers(0, 4, n)
+        data = {
+            "x": rng.uniform(-0.1, 1.1, n),
+            "y": rng.choice([0.0, 0.2, 0.5, 1.0, 0.7], n),
+            "r": rng.choice([0.0, 0.5, 2.0, 1.3], n),
+            "n": rng.integers(-1, 7, n),
+            "jet_pt": ak.unflatten(rng.choice([0.0, 55.0, 100.0, 120.0], counts.sum()), counts),
+        }
+        n_cats = rng.integers(0, 3, n)
+        category_ids = ak.unflatten(rng.choice([11, 12, 13], n_cats.sum()), n_cats)
+        process_ids = rng.choice([100, 200], n)
+        weights = rng.uniform(size=(2, n)).astype(np.float32)
+
+        filler = DenseHistFiller(variable_insts, shift_ids=[0, 5], last_edge_inclusive=last_edge_inclusive)
+        filler.fill(data, category_ids, process_ids, weights)
+
+        # reference: histograms created and filled by columnflow
+        refs = {}
+        for variable_inst in variable_insts:
+            h = create_hist_from_variables(
+                variable_inst,
+                categorical_axes=[("category", "intcat"), ("process", "intcat"), ("shift", "intcat")],
+                weight=True,
+            )
+            for shift_idx, shift_id in enumerate([0, 5]):
+                fill_hist(
+                    h,
+                    {
+                        "category": category_ids,
+                        "process": process_ids,
+                        "shift": shift_id,
+                        "weight": weights[shift_idx],
+                        variable_inst.name: data[variable_inst.name],
+                    },
+                    last_edge_inclusive=last_edge_inclusive,
+                )
+            refs[variable_inst.name] = h
+
+        return filler, refs
+
+    def assert_hists_equal(self, h: hist.Hist, ref: hist.Hist) -> None:
+        self.assertEqual(type(h.axes[-1]), type(ref.axes[-1]))
+        np.testing.assert_allclose(h.axes[-1].edges, ref.axes[-1].edges)
+        for axis in ("category", "process", "shift"):
+            self.assertEqual(set(h.axes[axis]), set(ref.axes[axis]))
+        for cat in ref.axes["category"]:
+            for proc in ref.axes["process"]:
+                for shift in ref.axes["shift"]:
+                    loc = {"category": hist.loc(cat), "process": hist.loc(proc), "shift": hist.loc(shift)}
+                    np.testing.assert_allclose(h[loc].values(flow=True), ref[loc].values(flow=True), rtol=1e-6)
+                    np.testing.assert_allclose(h[loc].variances(flow=True), ref[loc].variances(flow=True), rtol=1e-6)
+
+    def test_matches_columnflow(self):
+        for last_edge_inclusive in (None, True, False):
+            filler, refs = self.fill(last_edge_inclusive)
+            for name, ref in refs.items():
+                self.assert_hists_equal(filler.to_hist(name), ref)
+
+    def test_sparse(self):
+        filler, refs = self.fill(None)
+        for name, h in filler.to_sparse_hists().items():
+            self.assert_hists_equal(h.to_hist(), refs[name])
+
+    def test_masks(self):
+        variable_insts = make_variables()[:1]
+        filler = DenseHistFiller(variable_insts, shift_ids=[0])
+        filler.fill(
+            {"x": np.array([0.05, 0.15, 0.25])},
+            ak.Array([[1], [1, 2], []]),
+            np.array([7, 7, 7]),
+            np.ones((1, 3)),
+            masks={"x": np.array([True, False, True])},
+        )
+        h = filler.to_hist("x")
+        self.assertEqual(h[{"category": hist.loc(1), "process": hist.loc(7), "shift": hist.loc(0)}].sum().value, 1)
+        self.assertEqual(h.sum().value, 1)
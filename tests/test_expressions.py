@@ -0,0 +1,102 @@
+# coding: utf-8
+
+
+__all__ = ["ParseExpressionTest", "ExpressionEvaluatorTest"]
+
+import unittest
+
+import order as od
+
+from columnflow.columnar_util import EMPTY_FLOAT, Route
+from columnflow.util import maybe_import
+
+from hh2bbmumu.histogramming.expressions import ExpressionEvaluator, parse_expression
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class ParseExpressionTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_expression("nJet"), (("nJet",), None, ()))
+        self.assertEqual(parse_expression("Jet.pt"), (("Jet", "pt"), None, ()))
+        self.assertEqual(parse_expression("Jet.pt[:,0]"), (("Jet",), (slice(None), 0), ("pt",)))
+        self.assertEqual(parse_expression("Jet['pt'][:, -1]"), (("Jet",), (slice(None), -1), ("pt",)))
+        self.assertEqual(parse_expression("Jet.pt[1:3]"), (("Jet",), (slice(1, 3, None),), ("pt",)))
+
+    def test_unsupported(self):
+        for expr in ("Jet.pt[:, [0, 1]]", "Jet.pt[:, 0][:, 1]", "Jet.pt + 1", "Jet.pt["):
+            self.assertIsNone(parse_expression(expr), msg=expr)
+
+
+class ExpressionEvaluatorTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        n = 1000
+        counts = rng.integers(0, 4, n)
+        self.events = ak.Array({
+            "nJet": counts,
+            "Jet": ak.zip({
+                "pt": ak.unflatten(rng.uniform(20, 100, counts.sum()), counts),
+                "eta": ak.unflatten(rng.uniform(-2.5, 2.5, counts.sum()), counts),
+            }),
+        })
+
+    def test_matches_route(self):
+        variable_insts = [
+            od.Variable("n_jet", expression="nJet"),
+            od.Variable("jet_pt", expression="Jet.pt"),
+            od.Variable("jet1_pt", expression="Jet.pt[:,0]", null_value=EMPTY_FLOAT),
+            od.Variable("jet2_eta", expression="Jet.eta[:,1]", null_value=EMPTY_FLOAT),
+        ]
+        values = ExpressionEvaluator(variable_insts).evaluate(self.events)
+        self.assertEqual(list(values), [variable_inst.name for variable_inst in variable_insts])
+
+        for variable_inst in variable_insts:
+            null_value = variable_inst.null_value
+            ref = Route(variable_inst.expression).apply(
+                self.events,
+                **({} if null_value is None else {"null_value": null_value}),
+            )
+            self.assertTrue(ak.array_equal(values[variable_inst.name], ref), msg=variable_inst.name)
+
+    def test_negative_index(self):
+        # not supported with null values by routes
+        evaluator = ExpressionEvaluator([od.Variable("jet_last_pt", expression="Jet.pt[:,-1]", null_value=-1.0)])
+        ref = ak.fill_none(ak.pad_none(self.events.Jet.pt, 1)[:, -1], -1.0)
+        self.assertTrue(ak.array_equal(evaluator.evaluate(self.events)["jet_last_pt"], ref))
+        self.assertEqual(ref[0], self.events.Jet.pt[0, -1])
+
+    def test_route_fallback(self):
+        evaluator = ExpressionEvaluator([od.Variable("jet12_pt", expression="Jet.pt[:,[0,1]]")])
+        self.assertEqual(evaluator.compiled["jet12_pt"][0], "route")
+        events = self.events[ak.num(self.events.Jet) >= 2]
+        # routes are applied with the null value of the variable, as in columnflow's histogram tasks
+        self.assertEqual(evaluator.evaluate(events)["jet12_pt"].tolist(), events.Jet.pt[:, :2].tolist())
+
+    def test_unpadded_index(self):
+        evaluator = ExpressionEvaluator([od.Variable("jet1_pt", expression="Jet.pt[:,0]")])
+        with self.assertRaises(IndexError):
+            evaluator.evaluate(self.events)
+        values = evaluator.evaluate(self.events[ak.num(self.events.Jet) > 0])
+        self.assertEqual(values["jet1_pt"].ndim, 1)
+
+    def test_callable(self):
+        evaluator = ExpressionEvaluator([od.Variable("ht", expression=(lambda events: ak.sum(events.Jet.pt, axis=1)))])
+        self.assertTrue(ak.array_equal(evaluator.evaluate(self.events)["ht"], ak.sum(self.events.Jet.pt, axis=1)))
+
+    def test_shared_sub_expressions(self):
+        evaluator = ExpressionEvaluator([
+            od.Variable("jet1_pt", expression="Jet.pt[:,0]", null_value=EMPTY_FLOAT),
+            od.Variable("jet1_eta", expression="Jet.eta[:,0]", null_value=EMPTY_FLOAT),
+            od.Variable("jet1_eta_alias", expression="Jet['eta'][:, 0]", null_value=EMPTY_FLOAT),
+        ])
+        # the Jet column, the sliced collection and two distinct values
+        self.assertEqual(evaluator.n_sub_expressions, 4)
+
+        cache = evaluator.bind(self.events)
+        self.assertIs(cache["jet1_eta"], cache["jet1_eta_alias"])
+        cache["jet1_pt"]
+        self.assertEqual(len(cache._cache), 4)
@@ -0,0 +1,121 @@
+# coding: utf-8
+
+
+__all__ = ["MergeHistogramsIncrementalTest"]
+
+import os
+import inspect
+import tempfile
+import unittest
+
+import law
+import order as od
+
+from columnflow.util import maybe_import
+
+from hh2bbmumu.histogramming.dense import DenseHistFiller
+from hh2bbmumu.histogramming.sparse import (
+    LABELS_ATTR, save_sparse_hists, load_sparse_hists, load_sparse_labels, merge_sparse_hists, encode_labels,
+)
+from hh2bbmumu.tasks.histograms import MergeHistogramsIncremental
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class MergeHistogramsIncrementalFixture(MergeHistogramsIncremental):
+
+    # fixed variable representation instead of one derived from parameters
+    variables_repr = "x"
+
+
+class MergeHistogramsIncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files: dict[str, list[str]] = {}
+        self.variable_inst = od.Variable("x", expression="x", binning=(10, 0.0, 1.0))
+
+    def write_unit(self, dataset: str, seed: int, n_files: int = 2) -> None:
+        """
+        Writes the sparse histograms of *n_files* branches of *dataset*, using one process id per
+        dataset so that some slices are only contained in single units.
+        """
+        process_id = int(dataset[1:])
+        paths = []
+        for i in range(n_files):
+            rng = np.random.default_rng(seed * 100 + i)
+            n = 200
+            filler = DenseHistFiller([self.variable_inst], shift_ids=[0])
+            filler.fill(
+                {"x": rng.uniform(size=n)},
+                category_ids=ak.Array([[int(c)] for c in rng.integers(1, 4, n)]),
+                process_ids=np.full(n, process_id),
+                weights=rng.uniform(size=(1, n)),
+            )
+            labels = {"process": {process_id: dataset}, "shift": {0: "nominal"}}
+            path = os.path.join(self.tmp_dir, f"{dataset}_{seed}_{i}.npz")
+            save_sparse_hists(path, filler.to_sparse_hists(), attrs={LABELS_ATTR: encode_labels(labels)})
+            paths.append(path)
+        self.files[f"{dataset}__nominal"] = paths
+
+    def run_task(self, datasets: list[str], rebuild: bool = False) -> str:
+        # bypass parameter and config handling and only run the merging logic
+        out_dir = os.path.join(self.tmp_dir, "out")
+        task = MergeHistogramsIncrementalFixture.__new__(MergeHistogramsIncrementalFixture)
+        task.datasets = datasets
+        task.shifts = ["nominal"]
+        task.rebuild = rebuild
+        task.output = lambda: {
+            "hists": law.LocalFileTarget(os.path.join(out_dir, "hists.npz")),
+            "manifest": law.LocalFileTarget(os.path.join(out_dir, "manifest.json")),
+        }
+        task.input_files = lambda key: [law.LocalFileTarget(path) for path in self.files[key]]
+        task.iter_progress = lambda iterable, n, msg=None: iterable
+        task.publish_message = lambda msg: None
+        os.makedirs(out_dir, exist_ok=True)
+
+        inspect.unwrap(MergeHistogramsIncremental.run)(task)
+
+        return task.output()["hists"].abspath
+
+    def assert_rebuilt(self, path: str, datasets: list[str]) -> None:
+        """
+        Compares the merged histograms at *path* to those merged from scratch.
+        """
+        ref = merge_sparse_hists([p for dataset in datasets for p in self.files[f"{dataset}__nominal"]])["x"]
+        merged = load_sparse_hists(path)["x"]
+        self.assertEqual(merged.keys(), ref.keys())
+        for key in ref.keys():
+            np.testing.assert_allclose(merged[key], ref[key], rtol=1e-12, atol=1e-12)
+        self.assertEqual(
+            load_sparse_labels(path)["process"],
+            {int(dataset[1:]): dataset for dataset in datasets},
+        )
+
+    def test_incremental_merging(self):
+        self.write_unit("d1", 1)
+        self.write_unit("d2", 2)
+        path = self.run_task(["d1", "d2"])
+        self.assert_rebuilt(path, ["d1", "d2"])
+
+        # add a unit
+        self.write_unit("d3", 3)
+        self.assert_rebuilt(self.run_task(["d1", "d2", "d3"]), ["d1", "d2", "d3"])
+
+        # change a unit, with a different number of files
+        self.write_unit("d2", 4, n_files=3)
+        self.assert_rebuilt(self.run_task(["d1", "d2", "d3"]), ["d1", "d2", "d3"])
+
+        # remove a unit, dropping all of its slices
+        self.assert_rebuilt(self.run_task(["d1", "d3"]), ["d1", "d3"])
+
+        # rebuild from scratch
+        self.assert_rebuilt(self.run_task(["d1", "d3"], rebuild=True), ["d1", "d3"])
+
+        # previous partials that are missing trigger a rebuild
+        partials_dir = os.path.join(self.tmp_dir, "out", "partials__vars_x")
+        for name in os.listdir(partials_dir):
+            os.remove(os.path.join(partials_dir, name))
+        self.write_unit("d1", 5)
+        self.assert_rebuilt(self.run_task(["d1", "d3"]), ["d1", "d3"])
@@ -0,0 +1,69 @@
+# coding: utf-8
+
+
+__all__ = ["PairIndicesTest", "SegmentArgminTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hh2bbmumu.production.kinematics import pair_indices, segment_argmin
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+class PairIndicesTest(unittest.TestCase):
+
+    def test_matches_combinations(self):
+        rng = np.random.default_rng(1)
+        counts = rng.integers(0, 7, 500)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        objects = ak.unflatten(np.arange(offsets[-1]), counts)
+
+        for max_objects in (None, 3):
+            first, second, pair_offsets = pair_indices(offsets, max_objects=max_objects)
+            ref = ak.combinations(objects if max_objects is None else objects[:, :max_objects], 2)
+            np.testing.assert_array_equal(pair_offsets[1:], np.cumsum(ak.num(ref)))
+
+            # same pairs per event, in colexicographic instead of lexicographic order
+            for i in range(len(counts)):
+                sl = slice(pair_offsets[i], pair_offsets[i + 1])
+                pairs = list(zip(first[sl].tolist(), second[sl].tolist()))
+                self.assertEqual(sorted(pairs), [tuple(pair) for pair in ref[i].tolist()])
+                self.assertEqual(pairs, sorted(pairs, key=lambda pair: pair[::-1]))
+
+    def test_order(self):
+        first, second, pair_offsets = pair_indices(np.array([0, 4, 4, 5, 7]))
+        np.testing.assert_array_equal(first, [0, 0, 1, 0, 1, 2, 5])
+        np.testing.assert_array_equal(second, [1, 2, 2, 3, 3, 3, 6])
+        np.testing.assert_array_equal(pair_offsets, [0, 6, 6, 6, 7])
+
+    def test_empty(self):
+        first, second, pair_offsets = pair_indices(np.array([0]))
+        self.assertEqual(len(first), 0)
+        self.assertEqual(len(second), 0)
+        np.testing.assert_array_equal(pair_offsets, [0])
+
+
+class SegmentArgminTest(unittest.TestCase):
+
+    def test_matches_argmin(self):
+        rng = np.random.default_rng(2)
+        counts = rng.integers(0, 5, 1000)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        # few distinct values to produce ties, and some infinite values
+        values = rng.choice([0.5, 1.0, 2.0, np.inf], offsets[-1])
+
+        ref = [
+            start + int(np.argmin(values[start:stop])) if np.isfinite(values[start:stop]).any() else -1
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ]
+        np.testing.assert_array_equal(segment_argmin(values, offsets), ref)
+
+    def test_edge_cases(self):
+        np.testing.assert_array_equal(
+            segment_argmin(np.array([np.inf, 3.0, 1.0, 1.0, np.inf]), np.array([0, 0, 1, 4, 4, 5])),
+            [-1, -1, 2, -1, -1],
+        )
+        np.testing.assert_array_equal(segment_argmin(np.array([]), np.array([0, 0, 0])), [-1, -1])
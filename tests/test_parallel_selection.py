@@ -0,0 +1,160 @@
+# coding: utf-8
+
+
+__all__ = ["SelectEventsParallelTest"]
+
+import os
+import logging
+import inspect
+import tempfile
+import unittest
+from collections import defaultdict
+
+import law
+import order as od
+
+from columnflow.columnar_util import set_ak_column
+from columnflow.selection import SelectionResult, selector
+from columnflow.tasks.selection import SelectEvents
+from columnflow.util import maybe_import
+
+from hh2bbmumu.tasks.parallel_selection import SelectEventsParallel
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+uproot = maybe_import("uproot")
+
+
+@selector(
+    uses={"Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass"},
+    produces={"n_sel_jet", "sel_jet_ht"},
+    max_chunk_size=500,
+)
+def parallel_selection_test_selector(self, events, stats, **kwargs):
+    jet_mask = (events.Jet.pt > 30.0) & (abs(events.Jet.eta) < 2.4)
+    n_jet = ak.sum(jet_mask, axis=1)
+    events = set_ak_column(events, "n_sel_jet", n_jet, value_type=np.int32)
+    events = set_ak_column(events, "sel_jet_ht", ak.sum(events.Jet.pt[jet_mask], axis=1), value_type=np.float32)
+    event_mask = n_jet >= 2
+
+    stats["num_events"] += len(events)
+    stats["num_events_selected"] += int(ak.sum(event_mask))
+    stats["sum_mc_weight"] += float(ak.sum(events.Jet.pt))
+    stats["sum_mc_weight_selected"] += float(ak.sum(events.Jet.pt[event_mask]))
+    for n, count in zip(*np.unique(ak.to_numpy(n_jet), return_counts=True)):
+        stats.setdefault("num_events_per_jet_multiplicity", defaultdict(float))[str(n)] += int(count)
+
+    return events, SelectionResult(
+        steps={"jet": event_mask},
+        objects={"Jet": {"Jet": ak.local_index(events.Jet)[jet_mask]}},
+        aux={"n_jet": n_jet},
+        event=event_mask,
+    )
+
+
+def write_nano(path: str, n: int = 2500) -> None:
+    rng = np.random.default_rng(1)
+    counts = rng.integers(0, 6, n)
+    n_jets = int(counts.sum())
+    jet = {
+        "pt": rng.exponential(40.0, n_jets),
+        "eta": rng.uniform(-3.0, 3.0, n_jets),
+        "phi": rng.uniform(-np.pi, np.pi, n_jets),
+        "mass": rng.uniform(5.0, 20.0, n_jets),
+    }
+    data = {
+        "run": np.full(n, 367000, dtype=np.uint32),
+        "luminosityBlock": rng.integers(1, 100, n).astype(np.uint32),
+        "event": np.arange(n, dtype=np.uint64),
+        "Jet": ak.zip({name: ak.unflatten(values.astype(np.float32), counts) for name, values in jet.items()}),
+    }
+    with uproot.recreate(path) as f:
+        f.mktree(
+            "Events",
+            {name: arr.type if isinstance(arr, ak.Array) else arr.dtype for name, arr in data.items()},
+            field_name=lambda outer, inner: f"{outer}_{inner}",
+        )
+        f["Events"].extend(data)
+
+
+class _LFNTask(object):
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def iter_nano_files(self, task, lfn_indices=None):
+        yield 0, law.LocalFileTarget(self.path)
+
+
+class SelectEventsParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.nano_path = os.path.join(self.tmp_dir, "nano.root")
+        write_nano(self.nano_path)
+
+    def make_task(self, cls, name: str, **attrs):
+        # bypass parameter and config handling and only run the processing logic
+        config_inst = od.Config(name="test_config", id=1, campaign=od.Campaign("test_campaign", 1))
+        task = cls.__new__(cls)
+        task.config_inst = config_inst
+        task.local_shift_inst = od.Shift("nominal", 0)
+        task.selector_inst = parallel_selection_test_selector(inst_dict={"config_inst": config_inst})
+        task.calibrator_insts = []
+        task._task_logger = logging.getLogger(__name__)
+        task.check_overlapping_inputs = False
+        task.check_finite_output = False
+        task.requires = lambda: {"lfns": _LFNTask(self.nano_path), "selector": []}
+        task.input = lambda: {"calibrations": [], "selector": []}
+        task.iter_progress = lambda iterable, n, msg=None: iterable
+        task.publish_message = lambda msg, **kwargs: None
+        task.create_branch_map = lambda: {0: [0]}
+        task.branch_index = 0
+        for attr, value in attrs.items():
+            setattr(task, attr, value)
+
+        out_dir = os.path.join(self.tmp_dir, name)
+        os.makedirs(out_dir)
+        outputs = {
+            key: law.LocalFileTarget(os.path.join(out_dir, f"{key}.{ext}"))
+            for key, ext in [
+                ("results", "parquet"),
+                ("columns", "parquet"),
+                ("stats", "json"),
+                ("hists", "pickle"),
+                ("throughput", "json"),
+            ]
+        }
+        task.output = lambda: outputs
+
+        return task
+
+    def run_task(self, cls, name: str, **attrs) -> dict[str, law.LocalFileTarget]:
+        task = self.make_task(cls, name, **attrs)
+        inspect.unwrap(cls.run)(task)
+        return task.output()
+
+    def test_matches_select_events(self):
+        ref = self.run_task(SelectEvents, "cf")
+
+        # both tasks use the maximum chunk size of the selector
+        for workers in (1, 3):
+            out = self.run_task(SelectEventsParallel, f"parallel_{workers}", workers=workers, chunk_size=0)
+            for key in ("results", "columns"):
+                arr, ref_arr = ak.from_parquet(out[key].abspath), ak.from_parquet(ref[key].abspath)
+                self.assertEqual(arr.fields, ref_arr.fields)
+                self.assertTrue(ak.array_equal(arr, ref_arr), msg=key)
+
+            stats, ref_stats = out["stats"].load(formatter="json"), ref["stats"].load(formatter="json")
+            self.assertEqual(stats.keys(), ref_stats.keys())
+            self.assertEqual(stats["num_events"], 2500)
+            self.assertEqual(stats["num_events_selected"], ref_stats["num_events_selected"])
+            self.assertEqual(
+                stats["num_events_per_jet_multiplicity"],
+                ref_stats["num_events_per_jet_multiplicity"],
+            )
+            self.assertAlmostEqual(stats["sum_mc_weight"], ref_stats["sum_mc_weight"], places=6)
+
+            throughput = out["throughput"].load(formatter="json")
+            self.assertEqual(throughput["n_chunks"], 5)
+            self.assertEqual(throughput["n_workers"], workers)
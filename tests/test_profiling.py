@@ -0,0 +1,57 @@
+# coding: utf-8
+
+
+__all__ = ["ArrayFunctionProfilerTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hh2bbmumu.profiling.array_functions import ArrayFunctionProfiler
+
+np = maybe_import("numpy")
+
+
+class _Function(object):
+
+    def __init__(self, cls_name: str, n_bytes: int, child: "_Function | None" = None) -> None:
+        self.cls_name = cls_name
+        self.n_bytes = n_bytes
+        self.child = child
+
+    def __call__(self, events):
+        buf = np.ones(self.n_bytes, dtype=np.uint8)
+        if self.child is not None:
+            self.child(events)
+        del buf
+        return events
+
+
+class ArrayFunctionProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = ArrayFunctionProfiler()
+        self.call_orig = _Function.__call__
+        _Function.__call__ = self.profiler.wrap(self.call_orig)
+
+    def tearDown(self):
+        _Function.__call__ = self.call_orig
+        self.profiler.stop()
+
+    def test_peak_memory(self):
+        mb = 1024**2
+        self.profiler.reset()
+        outer = _Function("outer", 1 * mb, _Function("inner", 8 * mb))
+        for _ in range(3):
+            outer(None)
+        _Function("other", 2 * mb)(None)
+
+        tree = self.profiler.to_dict()["tree"]
+        nodes = {node["name"]: node for node in tree["children"]}
+        inner = nodes["outer"]["children"][0]
+        self.assertEqual(nodes["outer"]["calls"], 3)
+
+        # peaks include nested calls, but not memory allocated before or released after calls
+        self.assertAlmostEqual(inner["peak_memory"] / mb, 8, delta=0.1)
+        self.assertAlmostEqual(nodes["outer"]["peak_memory"] / mb, 9, delta=0.1)
+        self.assertAlmostEqual(nodes["other"]["peak_memory"] / mb, 2, delta=0.1)
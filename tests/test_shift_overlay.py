@@ -0,0 +1,77 @@
+# coding: utf-8
+
+
+__all__ = ["ShiftOverlayTest"]
+
+import os
+import tempfile
+import unittest
+
+from columnflow.util import maybe_import
+
+from hh2bbmumu.shift_overlay import write_overlay, read_parquet, get_overlay_info, PLACEHOLDER_COLUMN
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+pq = maybe_import("pyarrow.parquet")
+
+
+class ShiftOverlayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(1)
+        n = 1000
+        counts = rng.integers(0, 4, n)
+        self.base = ak.Array({
+            "event": np.arange(n, dtype=np.uint64),
+            "Jet": ak.zip({
+                "pt": ak.unflatten(rng.uniform(20, 100, counts.sum()), counts),
+                "eta": ak.unflatten(rng.uniform(-2.5, 2.5, counts.sum()), counts),
+            }),
+            "weight": rng.uniform(size=n),
+        })
+        self.base_path = os.path.join(self.tmp_dir, "base.parquet")
+        ak.to_parquet(self.base, self.base_path, row_group_size=300)
+
+    def write(self, array: ak.Array, name: str, row_group_size: int) -> str:
+        path = os.path.join(self.tmp_dir, name)
+        ak.to_parquet(array, path, row_group_size=row_group_size)
+        return path
+
+    def test_overlay(self):
+        # change jet pts in a single row group only, and write with different row groups
+        pt = ak.to_numpy(ak.flatten(self.base.Jet.pt)).copy()
+        first = int(ak.sum(ak.num(self.base.Jet[:700])))
+        pt[first] *= 1.01
+        shifted = ak.with_field(self.base, ak.unflatten(pt, ak.num(self.base.Jet)), ["Jet", "pt"])
+        path = self.write(shifted, "shifted.parquet", 128)
+
+        columns = write_overlay(path, self.base_path)
+        self.assertEqual(columns, ["Jet.pt"])
+        self.assertEqual(get_overlay_info(path)[1], ["Jet.pt"])
+
+        # row groups follow those of the base file
+        metadata = pq.ParquetFile(path).metadata
+        self.assertEqual(
+            [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)],
+            [300, 300, 300, 100],
+        )
+
+        # reading resolves unchanged columns from the base file
+        result = read_parquet(ak.from_parquet, path)
+        self.assertTrue(ak.array_equal(result.Jet.pt, shifted.Jet.pt))
+        self.assertTrue(ak.array_equal(result.Jet.eta, self.base.Jet.eta))
+        self.assertTrue(ak.array_equal(result.weight, self.base.weight))
+
+    def test_unchanged_overlay(self):
+        path = self.write(self.base, "shifted.parquet", 1000)
+        self.assertEqual(write_overlay(path, self.base_path), [])
+        self.assertEqual(pq.read_schema(path).names, [PLACEHOLDER_COLUMN])
+        result = read_parquet(ak.from_parquet, path, columns=["weight"])
+        self.assertTrue(ak.array_equal(result.weight, self.base.weight))
+
+    def test_length_mismatch(self):
+        path = self.write(self.base[:10], "shifted.parquet", 1000)
+        with self.assertRaises(ValueError):
+            write_overlay(path, self.base_path)
@@ -0,0 +1,186 @@
+# coding: utf-8
+
+
+__all__ = ["SparseHistTest"]
+
+import os
+import tempfile
+import unittest
+
+import order as od
+
+from columnflow.hist_util import translate_hist_intcat_to_strcat
+from columnflow.util import maybe_import
+
+from hh2bbmumu.histogramming.dense import DenseHistFiller
+from hh2bbmumu.histogramming.sparse import (
+    SparseHist, LABELS_ATTR, save_sparse_hists, load_sparse_hists, load_sparse_attrs, load_sparse_labels,
+    merge_sparse_hists, add_sparse_hists, prune_sparse_hists, encode_labels, merge_labels,
+)
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+hist = maybe_import("hist")
+
+
+def fill_random(seed: int, n: int = 500) -> DenseHistFiller:
+    variable_insts = [
+        od.Variable("x", expression="x", binning=(10, 0.0, 1.0)),
+        od.Variable("y", expression="y", binning=[0.0, 0.2, 0.5, 1.0]),
+    ]
+    filler = DenseHistFiller(variable_insts, shift_ids=[0, 1, 2])
+    rng = np.random.default_rng(seed)
+    filler.fill(
+        {"x": rng.uniform(size=n), "y": rng.uniform(size=n)},
+        category_ids=ak.Array([[int(c)] for c in rng.choice([11, 12, 13], n)]),
+        process_ids=rng.choice([100, 200], n),
+        weights=np.stack([rng.uniform(size=n), rng.uniform(size=n), rng.uniform(size=n)]).astype(np.float32),
+    )
+    return filler
+
+
+def iter_slices(h: hist.Hist):
+    for cat in h.axes["category"]:
+        for proc in h.axes["process"]:
+            for shift in h.axes["shift"]:
+                yield {"category": hist.loc(cat), "process": hist.loc(proc), "shift": hist.loc(shift)}
+
+
+class SparseHistTest(unittest.TestCase):
+
+    def assert_hists_equal(self, h: hist.Hist, ref: hist.Hist) -> None:
+        for axis in ("category", "process", "shift"):
+            self.assertEqual(set(h.axes[axis]), set(ref.axes[axis]))
+        for loc in iter_slices(ref):
+            np.testing.assert_allclose(h[loc].values(flow=True), ref[loc].values(flow=True))
+            np.testing.assert_allclose(h[loc].variances(flow=True), ref[loc].variances(flow=True))
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.labels = {
+            "category": {11: "cat_a", 12: "cat_b", 13: "cat_c"},
+            "process": {100: "hh", 200: "tt"},
+            "shift": {0: "nominal", 1: "mu_up", 2: "mu_down"},
+        }
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.tmp_dir, name)
+
+    def test_from_dense_keeps_non_empty_slices(self):
+        sumw = np.zeros((2, 2, 3, 4))
+        sumw[0, 1, 2, 1] = 1.0
+        sumw2 = sumw.copy()
+        axis = {"name": "x", "n_bins": 2, "x_min": 0, "x_max": 1}
+        h = SparseHist.from_dense(axis, sumw, sumw2, [5, 6], [7, 8], [0, 1, 2])
+        self.assertEqual(h.keys(), [(5, 8, 2)])
+        np.testing.assert_array_equal(h[(5, 8, 2)], [[0, 1, 0, 0], [0, 1, 0, 0]])
+        # missing slices are empty
+        np.testing.assert_array_equal(h[(6, 7, 0)], np.zeros((2, 4)))
+
+    def test_roundtrip(self):
+        filler = fill_random(1)
+        path = self.path("hists.npz")
+        save_sparse_hists(path, filler.to_sparse_hists(), attrs={"foo": 1})
+        self.assertEqual(load_sparse_attrs(path), {"foo": 1})
+
+        hists = load_sparse_hists(path, variables=["y"])
+        self.assertEqual(list(hists), ["y"])
+        # slices are loaded lazily
+        self.assertEqual(len(hists["y"]._slices), 0)
+        self.assert_hists_equal(hists["y"].to_hist(), filler.to_hist("y"))
+
+    def test_post_processed_roundtrip(self):
+        filler = fill_random(2)
+        path = self.path("hists.npz")
+        save_sparse_hists(path, filler.to_sparse_hists(), attrs={LABELS_ATTR: encode_labels(self.labels)})
+        self.assertEqual(load_sparse_labels(path), self.labels)
+
+        # reference: post-processing as done by cf_default
+        for name in ("x", "y"):
+            ref = filler.to_hist(name)
+            for axis in ("category", "process", "shift"):
+                ref = translate_hist_intcat_to_strcat(ref, axis, self.labels[axis])
+
+            h = load_sparse_hists(path)[name].to_hist(labels=load_sparse_labels(path))
+            for axis in ("category", "process", "shift"):
+                self.assertIsInstance(h.axes[axis], hist.axis.StrCategory)
+            self.assert_hists_equal(h, ref)
+
+        # string axes cannot be stored sparsely
+        with self.assertRaises(ValueError):
+            SparseHist.from_hist(ref)
+
+    def test_merge(self):
+        fillers = [fill_random(3), fill_random(4)]
+        paths = [self.path("a.npz"), self.path("b.npz")]
+        for filler, path in zip(fillers, paths):
+            save_sparse_hists(path, filler.to_sparse_hists())
+
+        merged = merge_sparse_hists(paths)
+        for name in ("x", "y"):
+            h = merged[name].to_hist()
+            refs = [filler.to_hist(name) for filler in fillers]
+            for loc in iter_slices(refs[0]):
+                np.testing.assert_allclose(
+                    h[loc].values(flow=True),
+                    refs[0][loc].values(flow=True) + refs[1][loc].values(flow=True),
+                )
+                np.testing.assert_allclose(
+                    h[loc].variances(flow=True),
+                    refs[0][loc].variances(flow=True) + refs[1][loc].variances(flow=True),
+                )
+
+    def test_add(self):
+        axis = {"name": "x", "n_bins": 2, "x_min": 0, "x_max": 1}
+        a = SparseHist(axis, {(1, 1, 0): [[1, 2, 3, 4], [1, 4, 9, 16]]})
+        b = SparseHist(axis, {(1, 1, 0): [[1, 1, 1, 1], [1, 1, 1, 1]], (2, 1, 0): [[0, 1, 0, 0], [0, 1, 0, 0]]})
+
+        # weights scaled by a factor scale squared weights by its square
+        h = SparseHist(axis).add(b, factor=3.0)
+        np.testing.assert_allclose(h[(1, 1, 0)], [[3, 3, 3, 3], [9, 9, 9, 9]])
+
+        # subtracting restores sums and removes emptied slices
+        h = SparseHist(axis).add(a).add(b, factor=2.0).add(b, factor=-2.0)
+        np.testing.assert_allclose(h[(1, 1, 0)], a[(1, 1, 0)])
+        self.assertEqual(h.keys(), [(1, 1, 0)])
+
+        h = a + b
+        h -= b
+        self.assertEqual(h.keys(), [(1, 1, 0)])
+
+    def test_incremental_update(self):
+        units = {seed: fill_random(seed).to_sparse_hists() for seed in range(5, 9)}
+
+        def rebuild(seeds):
+            merged = {}
+            for seed in seeds:
+                add_sparse_hists(merged, units[seed])
+            return merged
+
+        # add all, then remove two units and change one
+        merged = rebuild(units)
+        add_sparse_hists(merged, units[6], -1.0)
+        add_sparse_hists(merged, units[8], -1.0)
+        add_sparse_hists(merged, units[7], -1.0)
+        units[7] = fill_random(17).to_sparse_hists()
+        add_sparse_hists(merged, units[7])
+        prune_sparse_hists(merged, {
+            name: set().union(*(units[seed][name].keys() for seed in (5, 7)))
+            for name in ("x", "y")
+        })
+
+        ref = rebuild([5, 7])
+        for name in ("x", "y"):
+            self.assertEqual(merged[name].keys(), ref[name].keys())
+            for key in ref[name].keys():
+                np.testing.assert_allclose(merged[name][key], ref[name][key], atol=1e-12)
+
+        # histograms without any remaining slice are removed
+        self.assertEqual(list(prune_sparse_hists(merged, {"x": set()})), ["x"])
+        self.assertEqual(merged["x"].keys(), [])
+
+    def test_merge_labels(self):
+        merged = merge_labels({"process": {1: "a"}}, {"process": {2: "b"}, "shift": {0: "nominal"}})
+        self.assertEqual(merged, {"process": {1: "a", 2: "b"}, "shift": {0: "nominal"}})
+        with self.assertRaises(ValueError):
+            merge_labels({"process": {1: "a"}}, {"process": {1: "b"}})
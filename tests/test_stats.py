@@ -0,0 +1,143 @@
+# coding: utf-8
+
+
+__all__ = ["AccumulateStatsTest"]
+
+import json
+import unittest
+from collections import defaultdict
+
+from columnflow.selection import SelectionResult
+from columnflow.selection.stats import increment_stats
+from columnflow.util import maybe_import
+
+from hh2bbmumu.selection.stats import accumulate_stats
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def increment_stats_ref(events: ak.Array, weight_map: dict, **kwargs) -> defaultdict:
+    """
+    Returns stats as incremented by columnflow's increment_stats, whose setup is done manually.
+    """
+    inst = increment_stats()
+    inst.NUM, inst.SUM = range(2)
+    inst.defaultdicts = {
+        dtype: {
+            1: (lambda dtype=dtype: defaultdict(dtype)),
+            2: (lambda dtype=dtype: defaultdict(lambda: defaultdict(dtype))),
+        }
+        for dtype in (int, float)
+    }
+    stats = defaultdict(float)
+    increment_stats.call_func(inst, events, SelectionResult(), stats, weight_map=weight_map, **kwargs)
+    return stats
+
+
+class AccumulateStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        n = 1000
+        self.events = ak.Array({
+            "mc_weight": rng.normal(1.0, 0.5, n),
+            "process_id": rng.choice([1, 2, 5], n),
+            "njet": rng.integers(0, 4, n),
+        })
+        # no events of process 5 with 3 jets, so that the combination has zero entries
+        drop = (self.events.process_id == 5) & (self.events.njet == 3)
+        self.events = self.events[~drop]
+        self.selected = rng.uniform(size=len(self.events)) > 0.4
+        self.weight_map = {
+            "num_events": Ellipsis,
+            "num_events_selected": self.selected,
+            "sum_mc_weight": self.events.mc_weight,
+            "sum_mc_weight_selected": (self.events.mc_weight, self.selected),
+        }
+
+    def group_map(self, **kwargs) -> dict:
+        events = self.events
+        return {
+            "process": {
+                "values": events.process_id,
+                "mask_fn": (lambda v: events.process_id == v),
+                **kwargs,
+            },
+            "njet": {
+                "values": events.njet,
+                "mask_fn": (lambda v: events.njet == v),
+            },
+        }
+
+    def assert_stats_equal(self, stats, ref, name: str = "") -> None:
+        if isinstance(ref, dict):
+            self.assertEqual(list(stats), list(ref), msg=name)
+            for key in ref:
+                self.assert_stats_equal(stats[key], ref[key], f"{name}.{key}")
+        else:
+            # counts must be exact and integer, sums only close
+            self.assertIs(type(stats), type(ref), msg=name)
+            if isinstance(ref, int):
+                self.assertEqual(stats, ref, msg=name)
+            else:
+                self.assertAlmostEqual(stats, ref, places=8, msg=name)
+
+    def accumulate(self, n_chunks: int = 1, **kwargs) -> defaultdict:
+        stats = defaultdict(float)
+        for idx in np.array_split(np.arange(len(self.events)), n_chunks):
+            weight_map = {
+                name: (
+                    obj if obj is Ellipsis else
+                    tuple(o[idx] for o in obj) if isinstance(obj, tuple) else
+                    obj[idx]
+                )
+                for name, obj in self.weight_map.items()
+            }
+            group_map = {
+                name: {"values": data["values"][idx], **{k: v for k, v in data.items() if k == "combinations_only"}}
+                for name, data in kwargs.get("group_map", {}).items()
+            }
+            accumulate_stats(stats, weight_map, **{**kwargs, "group_map": group_map})
+        return stats
+
+    def test_matches_increment_stats(self):
+        kwargs = {"group_combinations": [("process", "njet")]}
+        ref = increment_stats_ref(self.events, self.weight_map, group_map=self.group_map(), **kwargs)
+        stats = self.accumulate(group_map=self.group_map(), **kwargs)
+        self.assert_stats_equal(stats, ref)
+        self.assertIsInstance(stats["num_events_per_process"]["1"], int)
+        self.assertIs(stats["num_events_per_process_and_njet"]["5"]["3"], 0)
+
+        # identical json representations
+        self.assertEqual(
+            json.loads(json.dumps(stats))["num_events_selected_per_njet"],
+            json.loads(json.dumps(ref))["num_events_selected_per_njet"],
+        )
+
+    def test_options(self):
+        kwargs = {
+            "group_combinations": [("njet", "process")],
+            "skip_func": (lambda weight_name, group_names: weight_name == "num_events" and len(group_names) > 1),
+        }
+        ref = increment_stats_ref(
+            self.events,
+            self.weight_map,
+            group_map=self.group_map(combinations_only=True),
+            **kwargs,
+        )
+        stats = self.accumulate(group_map=self.group_map(combinations_only=True), **kwargs)
+        self.assert_stats_equal(stats, ref)
+        self.assertNotIn("num_events_per_process", stats)
+        self.assertNotIn("num_events_per_njet_and_process", stats)
+
+    def test_chunks(self):
+        # accumulating over chunks yields the same stats
+        kwargs = {"group_map": self.group_map(), "group_combinations": [("process", "njet")]}
+        self.assert_stats_equal(self.accumulate(n_chunks=3, **kwargs), self.accumulate(**kwargs))
+
+    def test_invalid_weights(self):
+        with self.assertRaises(ValueError):
+            accumulate_stats(defaultdict(float), {"events": Ellipsis})
+        with self.assertRaises(ValueError):
+            accumulate_stats(defaultdict(float), {"num_events": (self.events.mc_weight, self.selected)})
@@ -0,0 +1,97 @@
+# coding: utf-8
+
+
+__all__ = ["FingerprintTest"]
+
+import unittest
+
+from columnflow.util import maybe_import
+
+from hh2bbmumu.util import (
+    event_fingerprint, widen_fingerprint, fingerprint_join, fingerprint_isin, FINGERPRINT_RUN_BITS,
+    FINGERPRINT_LUMI_BITS,
+)
+
+np = maybe_import("numpy")
+
+
+def make_events(run, lumi, event):
+    arr = np.empty(len(run), dtype=[("run", "<u4"), ("luminosityBlock", "<u4"), ("event", "<u8")])
+    arr["run"] = run
+    arr["luminosityBlock"] = lumi
+    arr["event"] = event
+    return arr
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(123)
+        n = 1000
+        self.events = make_events(
+            rng.integers(355000, 390000, n),
+            rng.integers(1, 3000, n),
+            rng.integers(0, 2**26, n),
+        )
+        self.event_bits = 64 - FINGERPRINT_RUN_BITS - FINGERPRINT_LUMI_BITS
+
+    def test_narrow_fingerprint(self):
+        fp = event_fingerprint(self.events)
+        self.assertEqual(fp.dtype, np.uint64)
+        self.assertEqual(len(np.unique(fp)), len(np.unique(self.events)))
+
+        # unpack and compare
+        event_bits = np.uint64(self.event_bits)
+        lumi_bits = np.uint64(FINGERPRINT_LUMI_BITS)
+        np.testing.assert_array_equal(fp & ((np.uint64(1) << event_bits) - np.uint64(1)), self.events["event"])
+        np.testing.assert_array_equal(
+            (fp >> event_bits) & ((np.uint64(1) << lumi_bits) - np.uint64(1)),
+            self.events["luminosityBlock"],
+        )
+        np.testing.assert_array_equal(fp >> (event_bits + lumi_bits), self.events["run"])
+
+    def test_wide_fingerprint(self):
+        # event numbers beyond the narrow encoding switch to the wide one automatically
+        events = self.events.copy()
+        events["event"][0] = 2**40
+        fp = event_fingerprint(events)
+        self.assertEqual(fp.dtype.names, ("hi", "lo"))
+        np.testing.assert_array_equal(fp["lo"], events["event"])
+
+        with self.assertRaises(ValueError):
+            event_fingerprint(events, wide=False)
+
+        # widening narrow fingerprints yields the wide encoding
+        narrow = event_fingerprint(self.events)
+        wide = event_fingerprint(self.events, wide=True)
+        np.testing.assert_array_equal(widen_fingerprint(narrow), wide)
+        self.assertIs(widen_fingerprint(wide), wide)
+
+    def test_fingerprint_bounds(self):
+        with self.assertRaises(ValueError):
+            event_fingerprint(make_events([2**FINGERPRINT_RUN_BITS], [1], [1]))
+        with self.assertRaises(ValueError):
+            event_fingerprint(make_events([1], [2**FINGERPRINT_LUMI_BITS], [1]))
+
+    def test_fingerprint_join(self):
+        a = event_fingerprint(self.events)
+        perm = np.random.default_rng(1).permutation(len(a))[:600]
+        b = a[perm]
+
+        idx_a, idx_b = fingerprint_join(a, b)
+        np.testing.assert_array_equal(a[idx_a], b[idx_b])
+        self.assertEqual(len(idx_a), len(np.unique(perm)))
+        np.testing.assert_array_equal(np.sort(idx_a), np.sort(np.unique(perm)))
+
+        # mixed encodings are joined on the same events
+        idx_a_wide, idx_b_wide = fingerprint_join(a, event_fingerprint(self.events[perm], wide=True))
+        np.testing.assert_array_equal(idx_a_wide, idx_a)
+        np.testing.assert_array_equal(idx_b_wide, idx_b)
+
+        # empty inputs
+        self.assertEqual(len(fingerprint_join(a, b[:0])[0]), 0)
+
+    def test_fingerprint_isin(self):
+        a = event_fingerprint(self.events)
+        mask = fingerprint_isin(a, a[::3])
+        np.testing.assert_array_equal(mask, np.isin(a, a[::3]))